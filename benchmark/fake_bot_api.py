@@ -0,0 +1,445 @@
+import argparse
+import json
+import random
+import re
+import socketserver
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer needs python 3.7
+    daemon_threads = True
+
+
+class FakeBotAPI:
+    """Local stand-in for Telegram Bot API.
+
+    Only the methods used by tgcli_server are emulated. Everything else
+    returns `{"ok": true, "result": true}`. Point tgcli_server at it with:
+
+        $ TGCLI_BOT_API_URL=http://127.0.0.1:8081/bot tgcli_server \\
+            --token 123456:FAKE --chat 1
+
+    Args:
+        latency (float): Mean delay of every API call in seconds.
+        jitter (float): Uniform +- jitter added to latency in seconds.
+        error_rate (float): Probability of 500 response.
+        flood_rate (float): Probability of 429 response.
+        retry_after (int): Value of 'retry_after' for 429 responses.
+        reply_after (float): Auto-reply to every sent message after this
+            delay in seconds. Negative value disables auto replies.
+        bandwidth (float): Upload speed in bytes/s to emulate slow
+            uploads, 0 for unlimited.
+    """
+
+    CHAT = {"id": 1, "type": "private", "first_name": "bench"}
+    USER = {"id": 1, "is_bot": False, "first_name": "bench"}
+    BOT = {
+        "id": 123456,
+        "is_bot": True,
+        "first_name": "fake",
+        "username": "fake_bot",
+    }
+
+    MEDIA_METHODS = {
+        "sendPhoto": "photo",
+        "sendVideo": "video",
+        "sendDocument": "document",
+    }
+
+    MAX_POLL_TIMEOUT = 1.0
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        flood_rate: float = 0.0,
+        retry_after: int = 1,
+        reply_after: float = -1,
+        bandwidth: float = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.reply_after = reply_after
+        self.bandwidth = bandwidth
+
+        self.stats = {
+            "calls": 0,
+            "errors": 0,
+            "floods": 0,
+            "bytes_in": 0,
+            # Sent messages, more than successful sends means duplicates
+            "messages": 0,
+            "downloads": 0,
+        }
+
+        self._lock = threading.Lock()
+        self._updates_cv = threading.Condition(self._lock)
+        self._updates = []
+        self._next_update_id = 1
+        self._next_message_id = 1
+        # file_id -> content of files sent by `reply_file`
+        self._files = {}
+
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return "http://%s:%s/bot" % (host, port)
+
+    @property
+    def base_file_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return "http://%s:%s/file/bot" % (host, port)
+
+    def start(self) -> "FakeBotAPI":
+        self._thread = threading.Thread(
+            target=self._httpd.serve_forever, name="FakeBotAPI", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Headers and body are written separately, avoid 40ms delays
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                method = self.path.rsplit("/", 1)[-1]
+                status, payload = api.handle(
+                    method, self.headers.get("Content-Type", ""), body
+                )
+                raw = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(raw)))
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def do_GET(self):
+                if not self.path.startswith("/file/"):
+                    return self.do_POST()
+
+                data = api.download(self.path.rsplit("/", 1)[-1])
+                if data is None:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _next_message(self, **kwargs) -> dict:
+        with self._lock:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+
+        msg = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": self.CHAT,
+        }
+        msg.update(kwargs)
+        return msg
+
+    def _push_update(self, message: dict):
+        with self._updates_cv:
+            self._updates.append(
+                {"update_id": self._next_update_id, "message": message}
+            )
+            self._next_update_id += 1
+            self._updates_cv.notify_all()
+
+    def reply(self, source: dict, text: str = "reply"):
+        """Emulate user reply to `source` message."""
+        self._push_update(
+            self._next_message(
+                text=text, reply_to_message=source, **{"from": self.USER}
+            )
+        )
+
+    def reply_file(
+        self,
+        source: dict,
+        file_name: str,
+        data: bytes,
+        caption: str = "",
+        photo: bool = False,
+    ):
+        """Emulate user reply to `source` message with document or photo."""
+        with self._lock:
+            file_id = "file%d" % (len(self._files) + 1)
+            self._files[file_id] = data
+
+        file = {
+            "file_id": file_id,
+            "file_unique_id": "u" + file_id,
+            "file_size": len(data),
+        }
+        if photo:
+            media = {"photo": [dict(file, width=1, height=1)]}
+        else:
+            media = {
+                "document": dict(
+                    file,
+                    file_name=file_name,
+                    mime_type="application/octet-stream",
+                )
+            }
+        if caption:
+            media["caption"] = caption
+
+        self._push_update(
+            self._next_message(
+                reply_to_message=source, **{"from": self.USER}, **media
+            )
+        )
+
+    def download(self, file_id: str) -> bytes:
+        with self._lock:
+            data = self._files.get(file_id)
+            if data is not None:
+                self.stats["downloads"] += 1
+        return data
+
+    def _get_updates(self, params: dict) -> list:
+        offset = int(params.get("offset") or 0)
+        timeout = min(float(params.get("timeout") or 0), self.MAX_POLL_TIMEOUT)
+        deadline = time.time() + timeout
+
+        with self._updates_cv:
+            self._updates = [
+                u for u in self._updates if u["update_id"] >= offset
+            ]
+            while not self._updates and time.time() < deadline:
+                self._updates_cv.wait(deadline - time.time())
+
+            return list(self._updates)
+
+    def handle(self, method: str, content_type: str, body: bytes):
+        with self._lock:
+            self.stats["calls"] += 1
+            self.stats["bytes_in"] += len(body)
+
+        params = _parse_params(content_type, body)
+
+        if method == "getUpdates":
+            return 200, {"ok": True, "result": self._get_updates(params)}
+
+        delay = self.latency + random.uniform(-self.jitter, self.jitter)
+        if self.bandwidth > 0:
+            delay += len(body) / self.bandwidth
+        if delay > 0:
+            time.sleep(delay)
+
+        roll = random.random()
+        if roll < self.flood_rate:
+            with self._lock:
+                self.stats["floods"] += 1
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": "Too Many Requests: retry after %s"
+                % self.retry_after,
+                "parameters": {"retry_after": self.retry_after},
+            }
+        if roll < self.flood_rate + self.error_rate:
+            with self._lock:
+                self.stats["errors"] += 1
+            return 500, {
+                "ok": False,
+                "error_code": 500,
+                "description": "Internal Server Error",
+            }
+
+        if method == "getMe":
+            return 200, {"ok": True, "result": self.BOT}
+
+        if method == "sendMessage" or method in self.MEDIA_METHODS:
+            extra = {}
+            if method == "sendMessage":
+                extra["text"] = params.get("text", "")
+            else:
+                extra[self.MEDIA_METHODS[method]] = _fake_media(method)
+                if params.get("caption"):
+                    extra["caption"] = params["caption"]
+
+            msg = self._next_message(**extra)
+            with self._lock:
+                self.stats["messages"] += 1
+            if self.reply_after >= 0:
+                timer = threading.Timer(
+                    self.reply_after, self.reply, args=(msg,)
+                )
+                timer.daemon = True
+                timer.start()
+
+            return 200, {"ok": True, "result": msg}
+
+        if method == "getFile":
+            file_id = params.get("file_id", "")
+            with self._lock:
+                data = self._files.get(file_id)
+            if data is None:
+                return 400, {
+                    "ok": False,
+                    "error_code": 400,
+                    "description": "Bad Request: invalid file_id",
+                }
+            return 200, {
+                "ok": True,
+                "result": {
+                    "file_id": file_id,
+                    "file_unique_id": "u" + file_id,
+                    "file_size": len(data),
+                    "file_path": "documents/%s" % file_id,
+                },
+            }
+
+        if method in ("editMessageText", "editMessageMedia"):
+            msg = {
+                "message_id": int(params.get("message_id") or 0),
+                "date": int(time.time()),
+                "chat": self.CHAT,
+            }
+            if method == "editMessageText":
+                msg["text"] = params.get("text", "")
+            return 200, {"ok": True, "result": msg}
+
+        return 200, {"ok": True, "result": True}
+
+
+def _fake_media(method: str):
+    file = {"file_id": "fake", "file_unique_id": "fake", "file_size": 0}
+    if method == "sendPhoto":
+        return [dict(file, width=1, height=1)]
+    if method == "sendVideo":
+        return dict(file, width=1, height=1, duration=1)
+    return file
+
+
+def _parse_params(content_type: str, body: bytes) -> dict:
+    if not body:
+        return {}
+
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+
+    if content_type.startswith("multipart/form-data"):
+        # Text fields only, file parts are skipped
+        params = {}
+        for name, value in re.findall(
+            rb'Content-Disposition: form-data; name="([^"]+)"\r\n\r\n(.*?)\r\n--',
+            body,
+            re.DOTALL,
+        ):
+            params[name.decode()] = value.decode("utf-8", "replace")
+        return params
+
+    return {}
+
+
+def main():
+    description_str = """
+Fake Telegram Bot API for tgcli benchmarks.
+
+Examples:
+    $ python fake_bot_api.py --port 8081 --latency 0.05 --flood-rate 0.01
+    $ TGCLI_BOT_API_URL=http://127.0.0.1:8081/bot tgcli_server -t 123456:FAKE -c 1
+
+"""
+    parser = argparse.ArgumentParser(
+        description=description_str,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    add_args(parser)
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8081, type=int)
+    args = parser.parse_args()
+
+    api = from_args(args, host=args.host, port=args.port).start()
+    print("Fake Bot API: %s" % api.base_url)
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        api.stop()
+
+
+def add_args(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--latency", default=0.0, type=float, help="Mean latency, sec"
+    )
+    parser.add_argument(
+        "--jitter", default=0.0, type=float, help="Latency jitter, sec"
+    )
+    parser.add_argument(
+        "--error-rate", default=0.0, type=float, help="Probability of 500"
+    )
+    parser.add_argument(
+        "--flood-rate", default=0.0, type=float, help="Probability of 429"
+    )
+    parser.add_argument(
+        "--retry-after", default=1, type=int, help="'retry_after' for 429"
+    )
+    parser.add_argument(
+        "--reply-after",
+        default=-1,
+        type=float,
+        help="Auto-reply to sent messages after N sec (-1 to disable)",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        default=0,
+        type=float,
+        help="Upload speed, bytes/s (0 for unlimited)",
+    )
+
+
+def from_args(args, host: str = "127.0.0.1", port: int = 0) -> FakeBotAPI:
+    return FakeBotAPI(
+        host=host,
+        port=port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        flood_rate=args.flood_rate,
+        retry_after=args.retry_after,
+        reply_after=args.reply_after,
+        bandwidth=args.bandwidth,
+    )
+
+
+if __name__ == "__main__":
+    main()
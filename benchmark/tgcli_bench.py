@@ -0,0 +1,550 @@
+import argparse
+import json
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Benchmark the working tree, not the installed package
+sys.path.insert(0, os.path.join(ROOT, "tgcli"))
+
+import tgcli  # noqa: E402
+
+import fake_bot_api  # noqa: E402
+
+FAKE_TOKEN = "123456:FAKE"
+FAKE_CHAT = "1"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _parse_size(size: str) -> int:
+    units = {"k": 1 << 10, "m": 1 << 20}
+    size = size.strip().lower()
+    if size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def _make_png(width: int, height: int, seed: int) -> bytes:
+    """Heatmap-like RGB PNG: gradient with noise, as visualization dumps.
+
+    Pure stdlib, so benchmark doesn't need Pillow on client side.
+    """
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (
+            struct.pack(">I", len(data))
+            + kind
+            + data
+            + struct.pack(">I", zlib.crc32(kind + data))
+        )
+
+    size = width * 3
+    base = bytes((x * 255 // size + seed) % 256 for x in range(size))
+    base_int = int.from_bytes(base, "big")
+    noise_mask = int.from_bytes(b"\x03" * size, "big")
+
+    rows = []
+    for y in range(height):
+        noise = int.from_bytes(os.urandom(size), "big") & noise_mask
+        shift = (y * 3) % size
+        row = (base_int ^ noise).to_bytes(size, "big")
+        rows.append(b"\x00" + row[shift:] + row[:shift])
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", header)
+        + chunk(b"IDAT", zlib.compress(b"".join(rows), 1))
+        + chunk(b"IEND", b"")
+    )
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(q / 100.0 * (len(values) - 1))))
+    return values[idx]
+
+
+class RSSSampler:
+    """Sample VmRSS of a process from /proc on interval."""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _read_rss_kb(self) -> int:
+        try:
+            with open("/proc/%d/status" % self.pid) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1])
+        except OSError:
+            pass
+        return 0
+
+    def _run(self):
+        t0 = time.time()
+        while not self._stop.is_set():
+            self.samples.append((time.time() - t0, self._read_rss_kb()))
+            self._stop.wait(self.interval)
+
+    def start(self) -> "RSSSampler":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class Server:
+    """tgcli_server subprocess pointed at fake Bot API."""
+
+    def __init__(self, cmd: List[str], port: int, base_url: str):
+        self.port = port
+        env = dict(os.environ)
+        env.update(
+            {
+                "TGCLI_TOKEN": FAKE_TOKEN,
+                "TGCLI_CHAT": FAKE_CHAT,
+                "TGCLI_PORT": str(port),
+                "TGCLI_HOST": "127.0.0.1",
+                "TGCLI_BOT_API_URL": base_url,
+            }
+        )
+        env.pop("TGCLI_DEBUG", None)
+        self._proc = subprocess.Popen(
+            cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+    @property
+    def pid(self) -> int:
+        return self._proc.pid
+
+    def wait_ready(self, timeout: float = 30.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self._proc.poll() is not None:
+                raise RuntimeError("tgcli_server exited on start")
+            if tgcli.get_replies([]) is not None:
+                return
+            time.sleep(0.1)
+        raise RuntimeError("tgcli_server is not ready after %ss" % timeout)
+
+    def stop(self):
+        self._proc.terminate()
+        try:
+            self._proc.wait(5)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+
+
+def _run_load(
+    name: str, fn: Callable[[int], bool], requests: int, concurrency: int
+) -> Dict:
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def job(i):
+        t0 = time.perf_counter()
+        ok = fn(i)
+        dt = time.perf_counter() - t0
+        with lock:
+            if ok:
+                latencies.append(dt)
+            else:
+                errors[0] += 1
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(job, range(requests)))
+    wall = time.perf_counter() - t0
+
+    return _result(name, concurrency, latencies, errors[0], wall)
+
+
+def _result(
+    name: str, concurrency: int, latencies: List[float], errors: int, wall
+) -> Dict:
+    return {
+        "scenario": name,
+        "requests": len(latencies) + errors,
+        "concurrency": concurrency,
+        "errors": errors,
+        "wall_s": wall,
+        "throughput_rps": len(latencies) / wall if wall else 0.0,
+        "p50_ms": _percentile(latencies, 50) * 1000,
+        "p99_ms": _percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def bench_send(args) -> List[Dict]:
+    def fn(i):
+        return tgcli.send(text="bench message %d" % i) is not None
+
+    return [_run_load("send", fn, args.requests, args.concurrency)]
+
+
+def bench_upload(args) -> List[Dict]:
+    results = []
+    for size in args.sizes.split(","):
+        data = os.urandom(_parse_size(size))
+
+        def fn(i, data=data):
+            msg_id = tgcli.send(filename="bench_%d.bin" % i, data=data)
+            return msg_id is not None
+
+        requests = max(1, args.requests // 10)
+        results.append(
+            _run_load("upload_%s" % size, fn, requests, args.concurrency)
+        )
+    return results
+
+
+def bench_images(args) -> List[Dict]:
+    """Large distinct PNGs, see TGCLI_IMAGE_WORKERS on server."""
+    width, height = (int(v) for v in args.image_size.lower().split("x"))
+    images = [
+        _make_png(width, height, seed)
+        for seed in range(max(1, args.requests // 50))
+    ]
+
+    def fn(i):
+        msg_id = tgcli.send(filename="plot_%d.png" % i, data=images[i])
+        return msg_id is not None
+
+    return [
+        _run_load(
+            "images_%s" % args.image_size, fn, len(images), args.concurrency
+        )
+    ]
+
+
+def bench_mixed(args) -> List[Dict]:
+    """Text alerts sent one by one while uploads saturate the server."""
+    data = os.urandom(_parse_size(args.sizes.split(",")[-1]))
+    uploads = []
+
+    def upload_fn(i):
+        return tgcli.send(filename="bench_%d.bin" % i, data=data) is not None
+
+    thread = threading.Thread(
+        target=lambda: uploads.append(
+            _run_load(
+                "mixed_upload",
+                upload_fn,
+                max(1, args.requests // 10),
+                args.concurrency,
+            )
+        )
+    )
+    thread.start()
+    latencies = []
+    errors = 0
+    t0 = time.perf_counter()
+    for i in range(args.waiters):
+        # Let uploads fill the queue first, then one alert at a time
+        time.sleep(0.2 if i else 0.5)
+
+        started = time.perf_counter()
+        if tgcli.send(text="alert %d" % i, priority="high") is None:
+            errors += 1
+        else:
+            latencies.append(time.perf_counter() - started)
+    alerts = _result(
+        "mixed_alert", 1, latencies, errors, time.perf_counter() - t0
+    )
+    thread.join()
+
+    return uploads + [alerts]
+
+
+def bench_replies(args) -> List[Dict]:
+    def fn(i):
+        msg_id = tgcli.send(text="bench question %d" % i)
+        if msg_id is None:
+            return False
+
+        deadline = time.time() + args.reply_timeout
+        while time.time() < deadline:
+            res = tgcli.get_replies([msg_id])
+            if res is None:
+                return False
+            if res:
+                return True
+            time.sleep(0.1)
+        return False
+
+    return [_run_load("replies", fn, args.waiters, args.waiters)]
+
+
+def bench_events(args) -> List[Dict]:
+    """One consumer collects replies for many messages with a cursor."""
+    tag = "bench-%d" % os.getpid()
+    cursor = tgcli.get_events(since=0, limit=1)
+    if cursor is None:
+        return []
+    cursor = cursor["cursor"]
+
+    sent_at = {}
+    for i in range(args.waiters):
+        msg_id = tgcli.send(text="bench question %d" % i, tags=[tag])
+        if msg_id is not None:
+            sent_at[msg_id] = time.perf_counter()
+
+    latencies = []
+    polls = 0
+    t0 = time.perf_counter()
+    deadline = time.time() + args.reply_timeout
+    while sent_at and time.time() < deadline:
+        res = tgcli.get_events(since=cursor, tags=[tag])
+        polls += 1
+        if res is None:
+            break
+
+        now = time.perf_counter()
+        for event in res["events"]:
+            if event["reply_to"] in sent_at:
+                latencies.append(now - sent_at.pop(event["reply_to"]))
+        cursor = res["cursor"]
+        time.sleep(0.1)
+    wall = time.perf_counter() - t0
+
+    return [
+        {
+            "scenario": "events",
+            "requests": args.waiters,
+            "concurrency": 1,
+            "errors": args.waiters - len(latencies),
+            "wall_s": wall,
+            "throughput_rps": polls / wall if wall else 0.0,
+            "p50_ms": _percentile(latencies, 50) * 1000,
+            "p99_ms": _percentile(latencies, 99) * 1000,
+            "max_ms": max(latencies) * 1000 if latencies else 0.0,
+        }
+    ]
+
+
+SCENARIOS = {
+    "send": bench_send,
+    "upload": bench_upload,
+    "images": bench_images,
+    "mixed": bench_mixed,
+    "replies": bench_replies,
+    "events": bench_events,
+}
+
+
+def _print_report(results: List[Dict], rss: List, fake_api: Dict = None):
+    header = "%-14s %8s %6s %7s %10s %9s %9s %9s" % (
+        "scenario",
+        "requests",
+        "conc",
+        "errors",
+        "req/s",
+        "p50 ms",
+        "p99 ms",
+        "max ms",
+    )
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            "%-14s %8d %6d %7d %10.1f %9.2f %9.2f %9.2f"
+            % (
+                r["scenario"],
+                r["requests"],
+                r["concurrency"],
+                r["errors"],
+                r["throughput_rps"],
+                r["p50_ms"],
+                r["p99_ms"],
+                r["max_ms"],
+            )
+        )
+
+    if rss:
+        values = [v for _, v in rss]
+        print(
+            "\nserver RSS, MB: start %.1f, peak %.1f, end %.1f (%d samples)"
+            % (
+                values[0] / 1024.0,
+                max(values) / 1024.0,
+                values[-1] / 1024.0,
+                len(values),
+            )
+        )
+
+    if fake_api:
+        print(
+            "fake API: %d calls, %d messages, %d errors, %d floods, "
+            "%.1f MB received"
+            % (
+                fake_api["calls"],
+                fake_api["messages"],
+                fake_api["errors"],
+                fake_api["floods"],
+                fake_api["bytes_in"] / 2**20,
+            )
+        )
+
+
+def main():
+    description_str = """
+Load/latency benchmark for tgcli client and tgcli_server.
+
+tgcli_server is started against a local fake Telegram Bot API, so nothing
+is sent to real Telegram.
+
+Examples:
+    $ python benchmark/tgcli_bench.py
+    $ python benchmark/tgcli_bench.py send -n 2000 -j 16 --latency 0.05
+    $ python benchmark/tgcli_bench.py upload --sizes 1k,1m,10m
+    $ TGCLI_IMAGE_WORKERS=2 python benchmark/tgcli_bench.py images
+    $ python benchmark/tgcli_bench.py mixed --sizes 10m --bandwidth 20e6
+    $ python benchmark/tgcli_bench.py replies --waiters 50 --reply-after 1
+    $ python benchmark/tgcli_bench.py events --waiters 500
+    $ python benchmark/tgcli_bench.py --json before.json
+
+"""
+    parser = argparse.ArgumentParser(
+        description=description_str,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        default=None,
+        help="Scenarios to run: %s (Default: all)" % ", ".join(SCENARIOS),
+    )
+    parser.add_argument("--requests", "-n", default=500, type=int)
+    parser.add_argument("--concurrency", "-j", default=8, type=int)
+    parser.add_argument(
+        "--sizes",
+        default="1k,100k,1m,10m",
+        type=str,
+        help="Upload sizes for 'upload' scenario, the last one for 'mixed'",
+    )
+    parser.add_argument(
+        "--image-size",
+        default="3000x2000",
+        type=str,
+        help="Width x height of PNGs for 'images' scenario",
+    )
+    parser.add_argument(
+        "--waiters",
+        default=20,
+        type=int,
+        help="Reply waiters for 'replies' and 'events', alerts for 'mixed'",
+    )
+    parser.add_argument("--reply-timeout", default=30.0, type=float)
+    parser.add_argument(
+        "--timeout",
+        default=30.0,
+        type=float,
+        help="Client send timeout, sec",
+    )
+    parser.add_argument(
+        "--server-cmd",
+        default="%s %s"
+        % (sys.executable, os.path.join(ROOT, "server", "tgcli_server.py")),
+        type=str,
+        help="Command to start tgcli_server",
+    )
+    parser.add_argument(
+        "--server-port",
+        default=None,
+        type=int,
+        help="Use already running server on this port (with fake API)",
+    )
+    parser.add_argument(
+        "--server-pid",
+        default=None,
+        type=int,
+        help="PID of already running server to sample RSS",
+    )
+    parser.add_argument(
+        "--json", default=None, type=str, help="Save report to file"
+    )
+    fake_bot_api.add_args(parser)
+
+    args = parser.parse_args()
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error("unknown scenario '%s'" % name)
+    if {"replies", "events"} & set(args.scenarios) and args.reply_after < 0:
+        args.reply_after = 0.5
+
+    tgcli.TGCLI_SEND_TIMEOUT = args.timeout
+
+    api = server = sampler = None
+    try:
+        if args.server_port:
+            tgcli.init("127.0.0.1", args.server_port)
+            pid = args.server_pid
+        else:
+            api = fake_bot_api.from_args(args).start()
+            port = _free_port()
+            tgcli.init("127.0.0.1", port)
+            server = Server(args.server_cmd.split(), port, api.base_url)
+            server.wait_ready()
+            pid = server.pid
+
+        if pid:
+            sampler = RSSSampler(pid).start()
+
+        results = []
+        for name in args.scenarios:
+            results += SCENARIOS[name](args)
+    finally:
+        if sampler:
+            sampler.stop()
+        if server:
+            server.stop()
+        if api:
+            api.stop()
+
+    rss = sampler.samples if sampler else []
+    _print_report(results, rss, api.stats if api else None)
+    print("\n" + tgcli._format_stats())
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "args": vars(args),
+                    "results": results,
+                    "rss_kb": rss,
+                    "fake_api": api.stats if api else None,
+                    "client_stats": tgcli.stats(),
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+from typing import Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# These modules must never be imported by `tgcli "text"`
+FORBIDDEN_MODULES = ["requests", "argparse", "urllib3"]
+
+
+def _closed_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _parse_importtime(stderr: str) -> Tuple[float, Dict[str, float]]:
+    """Parse `-X importtime` output.
+
+    Returns:
+        Tuple[float, Dict[str, float]]: total import time of top-level
+            modules and cumulative time of every imported module, ms.
+    """
+    total = 0.0
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+
+        _, cumulative, name = line.split("|")
+        cumulative_ms = int(cumulative) / 1000.0
+        modules[name.strip()] = cumulative_ms
+
+        # Top-level imports are not indented
+        if not name[1:].startswith(" "):
+            total += cumulative_ms
+
+    return total, modules
+
+
+def _run(cmd: List[str], env: dict) -> Tuple[float, float, Dict[str, float]]:
+    t0 = time.perf_counter()
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime"] + cmd,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    wall_ms = (time.perf_counter() - t0) * 1000
+    total, modules = _parse_importtime(res.stderr)
+    return wall_ms, total, modules
+
+
+def main():
+    description_str = """
+Startup time guard for `tgcli "text"`.
+
+Runs the CLI fast path with `-X importtime` against a closed port and
+measures import time on top of bare interpreter startup. Exits with 1 if
+median import time is over budget or forbidden modules were imported.
+
+Examples:
+    $ python benchmark/tgcli_startup.py
+    $ python benchmark/tgcli_startup.py --budget-ms 60 -n 20
+
+"""
+    parser = argparse.ArgumentParser(
+        description=description_str,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument("--runs", "-n", default=10, type=int)
+    parser.add_argument(
+        "--budget-ms",
+        default=75.0,
+        type=float,
+        help="Max median import time on top of bare interpreter, ms",
+    )
+    parser.add_argument(
+        "--top",
+        default=10,
+        type=int,
+        help="Show N slowest modules",
+    )
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.update(
+        {
+            "PYTHONPATH": os.path.join(ROOT, "tgcli"),
+            "TGCLI_HOST": "127.0.0.1",
+            "TGCLI_PORT": str(_closed_port()),
+        }
+    )
+    env.pop("TGCLI_DEBUG", None)
+
+    tgcli_cmd = [os.path.join(ROOT, "tgcli", "tgcli.py"), "startup bench"]
+    bare_cmd = ["-c", "pass"]
+
+    base_totals, totals, walls = [], [], []
+    modules = {}
+    for _ in range(args.runs):
+        base_totals.append(_run(bare_cmd, env)[1])
+        wall_ms, total, modules = _run(tgcli_cmd, env)
+        totals.append(total)
+        walls.append(wall_ms)
+
+    import_ms = statistics.median(totals) - statistics.median(base_totals)
+    print('tgcli "text" (%d runs, median):' % args.runs)
+    print("  wall time:   %.1f ms" % statistics.median(walls))
+    print(
+        "  import time: %.1f ms (budget %.1f ms)" % (import_ms, args.budget_ms)
+    )
+
+    print("\nslowest modules (cumulative, ms):")
+    for name, ms in sorted(modules.items(), key=lambda x: -x[1])[: args.top]:
+        print("  %8.2f  %s" % (ms, name))
+
+    failed = False
+    forbidden = [m for m in FORBIDDEN_MODULES if m in modules]
+    if forbidden:
+        print(
+            "\n[ERROR] forbidden modules imported: %s" % ", ".join(forbidden)
+        )
+        failed = True
+
+    if import_ms > args.budget_ms:
+        print("\n[ERROR] import time is over budget")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,5 +14,7 @@ setup(
         "parsedatetime",
         "fastapi",
         "uvicorn",
+        "pydantic",
     ],
+    extras_require={"fast": ["orjson", "msgpack"], "images": ["Pillow"]},
 )
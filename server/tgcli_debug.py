@@ -0,0 +1,319 @@
+import collections
+import cProfile
+import hmac
+import io
+import logging
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from typing import Callable, Dict
+
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import PlainTextResponse, Response
+
+
+def _thread_names() -> Dict[int, str]:
+    return {t.ident: t.name for t in threading.enumerate()}
+
+
+def format_threads() -> str:
+    """Stacks of all threads, like faulthandler but with thread names."""
+    names = _thread_names()
+    chunks = []
+    for ident, frame in sys._current_frames().items():
+        chunks.append(
+            'Thread "%s" (%s):\n%s'
+            % (
+                names.get(ident, "unknown"),
+                ident,
+                "".join(traceback.format_stack(frame)),
+            )
+        )
+    return "\n".join(chunks)
+
+
+class SamplingProfiler:
+    """Sample stacks of all threads on interval.
+
+    Unlike cProfile, it sees every thread (event loop, outbox workers,
+    Updater polling and dispatcher) and adds almost no overhead. Result
+    is in collapsed format, which can be rendered by flamegraph.pl or
+    speedscope.
+
+    Args:
+        interval (float): Sampling interval in seconds.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self._stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="SamplingProfiler", daemon=True
+        )
+
+    @staticmethod
+    def _collapse(thread_name: str, frame) -> str:
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(
+                "%s (%s:%d)"
+                % (
+                    code.co_name,
+                    os.path.basename(code.co_filename),
+                    frame.f_lineno,
+                )
+            )
+            frame = frame.f_back
+        stack.append(thread_name)
+        return ";".join(reversed(stack))
+
+    def _run(self):
+        own_ident = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = _thread_names()
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                name = names.get(ident, str(ident))
+                self._stacks[self._collapse(name, frame)] += 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "".join(
+            "%s %d\n" % (stack, count)
+            for stack, count in self._stacks.most_common()
+        )
+
+
+class Debugger:
+    """Token-protected debug endpoints for a running server.
+
+    All endpoints are under `/debug` and require `X-TGCLI-Debug-Token`
+    header:
+
+        GET  /debug/stats                   internal queues and stores
+        GET  /debug/threads                 stacks of all threads
+        POST /debug/profile/start           ?mode=sampling|cprofile
+                                            &interval=0.005
+        POST /debug/profile/stop            ?format=text|pstats
+                                            &sort=cumulative&limit=50
+        POST /debug/tracemalloc/start       ?frames=10
+        GET  /debug/tracemalloc/snapshot    ?limit=30&group_by=lineno
+        POST /debug/tracemalloc/stop
+
+    "sampling" profiles all threads and returns collapsed stacks. cProfile
+    profiles only the event loop thread (request decoding and handlers),
+    its stats are returned as text or as binary pstats file for snakeviz.
+    Every tracemalloc snapshot is returned with diff against the previous
+    one.
+
+    Args:
+        token (str): Secret token.
+        stats (Callable[[], Dict]): Returns server internals for `/stats`.
+    """
+
+    def __init__(self, token: str, stats: Callable[[], Dict] = None):
+        self._token = token.encode("utf-8")
+        self._stats = stats
+
+        self._lock = threading.Lock()
+        self._profiler = None
+        self._profiler_mode = None
+        self._profiler_started = 0.0
+        self._snapshot = None
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+        self.router = APIRouter(
+            prefix="/debug", dependencies=[Depends(self._check_token)]
+        )
+        self.router.add_api_route("/stats", self.stats, methods=["GET"])
+        self.router.add_api_route(
+            "/threads",
+            self.threads,
+            methods=["GET"],
+            response_class=PlainTextResponse,
+        )
+        self.router.add_api_route(
+            "/profile/start", self.profile_start, methods=["POST"]
+        )
+        self.router.add_api_route(
+            "/profile/stop", self.profile_stop, methods=["POST"]
+        )
+        self.router.add_api_route(
+            "/tracemalloc/start", self.tracemalloc_start, methods=["POST"]
+        )
+        self.router.add_api_route(
+            "/tracemalloc/snapshot",
+            self.tracemalloc_snapshot,
+            methods=["GET"],
+            response_class=PlainTextResponse,
+        )
+        self.router.add_api_route(
+            "/tracemalloc/stop", self.tracemalloc_stop, methods=["POST"]
+        )
+
+    def _check_token(self, x_tgcli_debug_token: str = Header("")):
+        if not hmac.compare_digest(
+            x_tgcli_debug_token.encode("utf-8"), self._token
+        ):
+            raise HTTPException(status_code=403, detail="Wrong debug token")
+
+    def stats(self):
+        return {
+            "stats": self._stats() if self._stats else {},
+            "threads": len(threading.enumerate()),
+            "profiler": self._profiler_mode,
+            "tracemalloc": tracemalloc.is_tracing(),
+        }
+
+    def threads(self):
+        return format_threads()
+
+    # Profile handlers are async to be called in event loop thread:
+    # cProfile works only in the thread where it was enabled.
+    async def profile_start(
+        self, mode: str = "sampling", interval: float = 0.005
+    ):
+        if mode not in ("sampling", "cprofile"):
+            raise HTTPException(
+                status_code=400, detail="mode is 'sampling' or 'cprofile'"
+            )
+
+        with self._lock:
+            if self._profiler is not None:
+                raise HTTPException(
+                    status_code=409, detail="Profiler is already running"
+                )
+
+            if mode == "sampling":
+                profiler = SamplingProfiler(interval=max(interval, 0.001))
+                profiler.start()
+            else:
+                profiler = cProfile.Profile()
+                profiler.enable()
+
+            self._profiler = profiler
+            self._profiler_mode = mode
+            self._profiler_started = time.time()
+
+        self._logger.warning("Profiler '%s' was started" % mode)
+        return {"status": "ok", "data": {"mode": mode}}
+
+    async def profile_stop(
+        self, format: str = "text", sort: str = "cumulative", limit: int = 50
+    ):
+        with self._lock:
+            profiler, mode = self._profiler, self._profiler_mode
+            if profiler is None:
+                raise HTTPException(
+                    status_code=409, detail="Profiler is not running"
+                )
+            self._profiler = self._profiler_mode = None
+            duration = time.time() - self._profiler_started
+
+        self._logger.warning("Profiler '%s' was stopped" % mode)
+
+        if mode == "sampling":
+            profiler.stop()
+            return PlainTextResponse(
+                "# %d samples in %.1fs, collapsed stacks\n%s"
+                % (profiler.samples, duration, profiler.collapsed())
+            )
+
+        profiler.disable()
+        profiler.create_stats()
+        if format == "pstats":
+            return Response(
+                content=marshal.dumps(profiler.stats),
+                media_type="application/octet-stream",
+                headers={
+                    "Content-Disposition": (
+                        'attachment; filename="tgcli_server.prof"'
+                    )
+                },
+            )
+
+        out = io.StringIO()
+        stats = pstats.Stats(profiler, stream=out)
+        try:
+            stats.sort_stats(sort)
+        except KeyError:
+            raise HTTPException(status_code=400, detail="Unknown sort key")
+        stats.print_stats(limit)
+        return PlainTextResponse(
+            "# %.1fs of event loop thread\n%s" % (duration, out.getvalue())
+        )
+
+    def tracemalloc_start(self, frames: int = 10):
+        if tracemalloc.is_tracing():
+            raise HTTPException(
+                status_code=409, detail="tracemalloc is already tracing"
+            )
+
+        tracemalloc.start(max(frames, 1))
+        self._snapshot = None
+        self._logger.warning("tracemalloc was started")
+        return {"status": "ok", "data": {"frames": frames}}
+
+    def tracemalloc_snapshot(self, limit: int = 30, group_by: str = "lineno"):
+        if not tracemalloc.is_tracing():
+            raise HTTPException(
+                status_code=409, detail="tracemalloc is not tracing"
+            )
+        if group_by not in ("lineno", "filename", "traceback"):
+            raise HTTPException(
+                status_code=400,
+                detail="group_by is 'lineno', 'filename' or 'traceback'",
+            )
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<unknown>"),
+            ]
+        )
+        current, peak = tracemalloc.get_traced_memory()
+
+        lines = [
+            "# traced memory: current %.1f MB, peak %.1f MB"
+            % (current / 2**20, peak / 2**20),
+            "",
+            "# top %d by %s" % (limit, group_by),
+        ]
+        for stat in snapshot.statistics(group_by)[:limit]:
+            lines.append(str(stat))
+            if group_by == "traceback":
+                lines.extend("    " + line for line in stat.traceback.format())
+
+        with self._lock:
+            previous, self._snapshot = self._snapshot, snapshot
+
+        if previous is not None:
+            lines += ["", "# top %d diff with previous snapshot" % limit]
+            diff = snapshot.compare_to(previous, group_by)
+            lines.extend(str(stat) for stat in diff[:limit])
+
+        return "\n".join(lines) + "\n"
+
+    def tracemalloc_stop(self):
+        tracemalloc.stop()
+        self._snapshot = None
+        self._logger.warning("tracemalloc was stopped")
+        return {"status": "ok", "data": {}}
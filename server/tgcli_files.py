@@ -0,0 +1,136 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from typing import Callable
+
+CHUNK_SIZE = 64 * 1024
+
+# Telegram file_unique_id is urlsafe base64
+_UNIQUE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+
+
+def content_disposition(filename: str) -> str:
+    """Attachment header value for any file name.
+
+    Starlette encodes headers as latin-1, so the name goes as ASCII
+    fallback in "filename" and as UTF-8 in "filename*" (RFC 5987).
+    """
+    fallback = "".join(
+        c if " " <= c <= "~" and c not in '"\\' else "_" for c in filename
+    )
+    return "attachment; filename=\"%s\"; filename*=UTF-8''%s" % (
+        fallback or "file",
+        urllib.parse.quote(filename, safe=""),
+    )
+
+
+class FileCache:
+    """Files from Telegram on local disk, keyed by `file_unique_id`.
+
+    Files are streamed to disk in chunks and never held in memory, so
+    serving them doesn't depend on file size. Concurrent requests of the
+    same file wait for a single download. The least recently used files
+    are removed when the cache grows over `max_bytes`.
+
+    Args:
+        dirpath (str): Cache directory.
+        max_bytes (int): Max total size of files.
+        timeout (float): Socket timeout of downloads in seconds.
+    """
+
+    def __init__(
+        self, dirpath: str, max_bytes: int = 2**30, timeout: float = 60.0
+    ):
+        self.dirpath = dirpath
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+
+        os.makedirs(dirpath, exist_ok=True)
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    @staticmethod
+    def is_valid_key(file_unique_id: str) -> bool:
+        return bool(_UNIQUE_ID_RE.match(file_unique_id))
+
+    def _path(self, file_unique_id: str) -> str:
+        if not self.is_valid_key(file_unique_id):
+            raise ValueError("Bad file_unique_id '%s'" % file_unique_id)
+        return os.path.join(self.dirpath, file_unique_id)
+
+    def _key_lock(self, file_unique_id: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(file_unique_id, threading.Lock())
+
+    def _download(self, url: str, path: str):
+        fd, tmp_path = tempfile.mkstemp(dir=self.dirpath, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with urllib.request.urlopen(url, timeout=self.timeout) as res:
+                    while True:
+                        chunk = res.read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        f.write(chunk)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def _evict(self, keep: str):
+        entries = []
+        with os.scandir(self.dirpath) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith(".part"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.unlink(path)
+                total -= size
+            except OSError:
+                pass
+
+    def get(self, file_unique_id: str, get_url: Callable[[], str]) -> str:
+        """Path of cached file. Downloads it on the first call.
+
+        Args:
+            file_unique_id (str): Cache key.
+            get_url (Callable[[], str]): Returns download URL, called only
+                on cache miss.
+        """
+        path = self._path(file_unique_id)
+
+        downloaded = False
+        try:
+            with self._key_lock(file_unique_id):
+                if os.path.exists(path):
+                    # mtime is the last use for eviction
+                    os.utime(path)
+                else:
+                    self._download(get_url(), path)
+                    downloaded = True
+                    self._logger.info(
+                        "File %s was downloaded: %d bytes"
+                        % (file_unique_id, os.path.getsize(path))
+                    )
+        finally:
+            # Waiters keep their reference, the map holds only active keys
+            with self._lock:
+                self._key_locks.pop(file_unique_id, None)
+                if downloaded:
+                    self._evict(keep=path)
+        return path
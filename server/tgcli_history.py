@@ -0,0 +1,303 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Dict, List
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    kind TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    reply_to TEXT NOT NULL DEFAULT '',
+    filename TEXT NOT NULL DEFAULT '',
+    text TEXT NOT NULL DEFAULT '',
+    tags TEXT NOT NULL DEFAULT '[]'
+);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+
+CREATE TABLE IF NOT EXISTS message_tags (
+    tag TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    PRIMARY KEY (tag, id)
+) WITHOUT ROWID;
+
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    text, filename, content='messages', content_rowid='id'
+);
+
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, text, filename)
+    VALUES (new.id, new.text, new.filename);
+END;
+
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, text, filename)
+    VALUES ('delete', old.id, old.text, old.filename);
+END;
+"""
+
+
+def fts_query(text: str) -> str:
+    """Quote user words for MATCH: 'OOM* gpu-1' -> '"OOM"* "gpu-1"'.
+
+    Words are matched whole, trailing "*" matches prefix. User text is
+    never parsed as FTS5 syntax, so any input is valid.
+    """
+    words = []
+    for word in text.split():
+        prefix = word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            words.append(
+                '"%s"%s' % (word.replace('"', '""'), "*" if prefix else "")
+            )
+    return " ".join(words)
+
+
+class History:
+    """Local SQLite history of sent messages and replies.
+
+    Rows are queued by `add` and written in batches by a background
+    thread, so Telegram calls never wait for disk. Text and filenames are
+    indexed with FTS5, tags with a separate table, so searches stay fast
+    with millions of rows.
+
+    Args:
+        path (str): Database file.
+        keep_days (float): Remove older rows once a day, 0 to keep all.
+    """
+
+    BATCH_SIZE = 500
+    FLUSH_INTERVAL = 1.0
+    MAX_QUEUE = 100000
+
+    def __init__(self, path: str, keep_days: float = 0):
+        self.path = path
+        self.keep_days = keep_days
+
+        dirpath = os.path.dirname(os.path.abspath(path))
+        os.makedirs(dirpath, exist_ok=True)
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._queue = queue.Queue(self.MAX_QUEUE)
+        self._dropped = 0
+        self._written = 0
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+        self._thread = threading.Thread(
+            target=self._run, name="History", daemon=True
+        )
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self) -> sqlite3.Connection:
+        """Connection of the current thread for searches."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def add(
+        self,
+        kind: str,
+        message_id: str,
+        text: str = "",
+        filename: str = "",
+        tags: List[str] = [],
+        reply_to: str = "",
+        ts: float = None,
+    ):
+        """Queue message for writing. Never blocks.
+
+        Args:
+            kind (str): "sent" or "reply".
+        """
+        row = (
+            time.time() if ts is None else ts,
+            kind,
+            str(message_id),
+            str(reply_to or ""),
+            filename or "",
+            text or "",
+            list(tags or []),
+        )
+        try:
+            self._queue.put_nowait(("add", row))
+        except queue.Full:
+            self._dropped += 1
+
+    def remove_old(self):
+        if self.keep_days > 0:
+            expire_ts = time.time() - self.keep_days * 24 * 60 * 60
+            self._queue.put(("remove_old", expire_ts))
+
+    def _write(self, conn: sqlite3.Connection, rows: List):
+        with conn:
+            for ts, kind, message_id, reply_to, filename, text, tags in rows:
+                cursor = conn.execute(
+                    "INSERT INTO messages"
+                    " (ts, kind, message_id, reply_to, filename, text, tags)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        ts,
+                        kind,
+                        message_id,
+                        reply_to,
+                        filename,
+                        text,
+                        json.dumps(tags),
+                    ),
+                )
+                conn.executemany(
+                    "INSERT OR IGNORE INTO message_tags (tag, id)"
+                    " VALUES (?, ?)",
+                    [(tag, cursor.lastrowid) for tag in tags],
+                )
+
+    def _remove_old(self, conn: sqlite3.Connection, expire_ts: float):
+        # Ids grow with time, so everything up to the newest expired id
+        # goes. Small transactions keep WAL file small.
+        row = conn.execute(
+            "SELECT id FROM messages WHERE ts < ? ORDER BY ts DESC LIMIT 1",
+            (expire_ts,),
+        ).fetchone()
+        if row is None:
+            return
+
+        while True:
+            with conn:
+                cursor = conn.execute(
+                    "DELETE FROM messages WHERE id IN"
+                    " (SELECT id FROM messages WHERE id <= ? LIMIT 10000)",
+                    (row["id"],),
+                )
+            if cursor.rowcount < 10000:
+                break
+
+        with conn:
+            conn.execute(
+                "DELETE FROM message_tags WHERE id <= ?", (row["id"],)
+            )
+
+    def _next_batch(self) -> List:
+        batch = [self._queue.get()]
+        deadline = time.time() + self.FLUSH_INTERVAL
+        while len(batch) < self.BATCH_SIZE and batch[-1] is not None:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        conn = self._connect()
+        while True:
+            batch = self._next_batch()
+            rows = [item[1] for item in batch if item and item[0] == "add"]
+            try:
+                if rows:
+                    self._write(conn, rows)
+                    self._written += len(rows)
+                for item in batch:
+                    if item and item[0] == "remove_old":
+                        self._remove_old(conn, item[1])
+            except sqlite3.Error as e:
+                self._logger.error("Can't write history: %s" % e)
+
+            if self._dropped:
+                self._logger.warning(
+                    "%d history rows were dropped" % self._dropped
+                )
+                self._dropped = 0
+
+            if batch[-1] is None:
+                conn.close()
+                return
+
+    def search(
+        self,
+        query: str = "",
+        since: float = 0,
+        until: float = 0,
+        tags: List[str] = [],
+        kind: str = "",
+        limit: int = 100,
+    ) -> List[Dict]:
+        """Find messages, the newest first.
+
+        Args:
+            query (str): Words to find in text or filename. Trailing "*"
+                matches prefix: "OOM*" finds "OOMKilled".
+            since (float): Min timestamp.
+            until (float): Max timestamp, 0 for now.
+            tags (List[str]): Messages with any of tags.
+            kind (str): "sent", "reply" or "" for both.
+            limit (int): Max messages count.
+        """
+        where, params = [], []
+
+        source, order = "messages m", "m.id"
+        query = fts_query(query)
+        if query:
+            # FTS5 returns matches in rowid order itself, so LIMIT stops
+            # the scan early instead of sorting all matches
+            source = "messages_fts f CROSS JOIN messages m ON m.id = f.rowid"
+            order = "f.rowid"
+            where.append("messages_fts MATCH ?")
+            params.append(query)
+        if since:
+            where.append("m.ts >= ?")
+            params.append(since)
+        if until:
+            where.append("m.ts <= ?")
+            params.append(until)
+        if kind:
+            where.append("m.kind = ?")
+            params.append(kind)
+        if tags:
+            where.append(
+                "m.id IN (SELECT id FROM message_tags WHERE tag IN (%s))"
+                % ", ".join("?" * len(tags))
+            )
+            params.extend(tags)
+
+        sql = (
+            "SELECT m.ts, m.kind, m.message_id, m.reply_to, m.filename,"
+            " m.text, m.tags FROM %s" % source
+        )
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        # Rows are inserted in time order, so id order is time order
+        sql += " ORDER BY %s DESC LIMIT ?" % order
+        params.append(limit)
+
+        rows = self._reader().execute(sql, params).fetchall()
+        return [dict(row, tags=json.loads(row["tags"])) for row in rows]
+
+    def stats(self) -> Dict:
+        return {
+            "queued": self._queue.qsize(),
+            "written": self._written,
+        }
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join(5)
@@ -0,0 +1,264 @@
+import asyncio
+import collections
+import hashlib
+import io
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# Telegram photo limits: file size, sum of width and height, sides ratio
+MAX_PHOTO_BYTES = 10 * 1024 * 1024
+MAX_PHOTO_SIDES = 10000
+MAX_PHOTO_RATIO = 20
+
+# Extensions which are decoded, other files are sent as is
+FORMATS = [".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"]
+
+ENCODERS = {"jpeg": ("JPEG", ".jpg"), "webp": ("WEBP", ".webp")}
+
+# Results of `normalize`
+KEEP = "keep"
+DOCUMENT = "document"
+PHOTO = "photo"
+
+
+def is_available() -> bool:
+    return Image is not None
+
+
+def _to_8bit(im: "Image.Image") -> "Image.Image":
+    """16-bit and float grayscale to 8-bit, stretched to min/max range."""
+    im = im.convert("F") if im.mode == "F" else im.convert("I")
+    lo, hi = im.getextrema()
+    scale = 255.0 / (hi - lo) if hi > lo else 1.0
+    return im.point(lambda v: v * scale - lo * scale).convert("L")
+
+
+def _flatten(im: "Image.Image", alpha: bool) -> "Image.Image":
+    """Image in mode which encoder supports: "L", "RGB" or "RGBA"."""
+    if im.mode.startswith("I") or im.mode == "F":
+        return _to_8bit(im)
+    if im.mode == "P":
+        im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+    if im.mode in ("LA", "PA", "RGBa", "La"):
+        im = im.convert("RGBA")
+    if im.mode == "RGBA" and not alpha:
+        # JPEG has no alpha, transparent plots should stay readable
+        background = Image.new("RGB", im.size, (255, 255, 255))
+        background.paste(im, mask=im.getchannel("A"))
+        return background
+    if im.mode not in ("L", "RGB", "RGBA"):
+        im = im.convert("RGB")
+    return im
+
+
+def normalize(
+    data: bytes, max_side: int, fmt: str, quality: int
+) -> Tuple[str, bytes]:
+    """Shrink image to Telegram photo limits. Runs in worker process.
+
+    Returns:
+        Tuple[str, bytes]: (PHOTO, content) of encoded photo, (KEEP, b"")
+        if original is already good or isn't an image, (DOCUMENT, b"") if
+        image can't be a photo (too long or too large to decode).
+    """
+    try:
+        im = Image.open(io.BytesIO(data))
+        width, height = im.size
+    except Image.DecompressionBombError:
+        return DOCUMENT, b""
+    except Exception:
+        return KEEP, b""
+
+    if max(width, height) > MAX_PHOTO_RATIO * min(width, height):
+        return DOCUMENT, b""
+
+    fits = (
+        len(data) <= MAX_PHOTO_BYTES
+        and width + height <= MAX_PHOTO_SIDES
+        and im.format in ("JPEG", "PNG")
+    )
+    if fits and im.format == "JPEG" and max(width, height) <= max_side:
+        return KEEP, b""
+
+    pil_format, _ = ENCODERS[fmt]
+    try:
+        # JPEG is decoded right at 1/2, 1/4 or 1/8 scale
+        im.draft("RGB", (max_side, max_side))
+        im = ImageOps.exif_transpose(im)
+        # Palette and 16-bit images can't be resized with filters
+        im = _flatten(im, alpha=pil_format == "WEBP")
+        im.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        out = io.BytesIO()
+        while True:
+            out.seek(0)
+            out.truncate()
+            im.save(out, pil_format, quality=quality)
+            if out.tell() <= MAX_PHOTO_BYTES or quality <= 40:
+                break
+            quality -= 15
+    except Exception:
+        return KEEP, b""
+
+    if out.tell() > MAX_PHOTO_BYTES:
+        return DOCUMENT, b""
+    if fits and out.tell() >= len(data):
+        return KEEP, b""
+    return PHOTO, out.getvalue()
+
+
+class ImageNormalizer:
+    """Images are shrunk to Telegram photo limits before upload.
+
+    Telegram recompresses every photo to JPEG of at most 2560 px, and
+    rejects too large or too long ones, so sending huge PNGs only costs
+    upload time. Images are decoded, downscaled and encoded in a process
+    pool, so neither event loop nor outbox threads wait for CPU. Results
+    are cached by content hash: the same image is encoded once.
+
+    Args:
+        workers (int): Processes count.
+        max_side (int): Max width and height of photo.
+        fmt (str): "jpeg" or "webp".
+        quality (int): Encoder quality, 1-100.
+        cache_bytes (int): Max total size of cached photos.
+    """
+
+    MAX_CACHE_KEYS = 10000
+
+    def __init__(
+        self,
+        workers: int = 1,
+        max_side: int = 2560,
+        fmt: str = "jpeg",
+        quality: int = 85,
+        cache_bytes: int = 64 * 1024 * 1024,
+    ):
+        if fmt not in ENCODERS:
+            raise ValueError("Unknown image format '%s'" % fmt)
+
+        self.workers = workers
+        self.max_side = min(max_side, MAX_PHOTO_SIDES // 2)
+        self.fmt = fmt
+        self.quality = quality
+        self.cache_bytes = cache_bytes
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._pool = self._new_pool()
+        # digest -> (result, content), the least recently used first
+        self._cache = collections.OrderedDict()
+        self._cache_size = 0
+        # digest -> future of `normalize`, concurrent requests share it
+        self._pending = {}
+        self._stats = collections.Counter()
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # Processes are started with "spawn", it's set by server main
+        pool = ProcessPoolExecutor(self.workers)
+        # Start processes now, not on the first image
+        for _ in range(self.workers):
+            pool.submit(is_available)
+        return pool
+
+    def accepts(self, filename: str) -> bool:
+        return os.path.splitext(filename)[1].lower() in FORMATS
+
+    def _cache_put(self, digest: bytes, result: Tuple[str, bytes]):
+        self._cache[digest] = result
+        self._cache_size += len(result[1])
+        while (
+            self._cache_size > self.cache_bytes
+            or len(self._cache) > self.MAX_CACHE_KEYS
+        ):
+            _, (_, content) = self._cache.popitem(last=False)
+            self._cache_size -= len(content)
+
+    async def _normalize(self, data: bytes) -> Tuple[str, bytes]:
+        """Result of worker or None if the worker died."""
+        loop = asyncio.get_event_loop()
+        pool = self._pool
+        try:
+            return await loop.run_in_executor(
+                pool,
+                normalize,
+                data,
+                self.max_side,
+                self.fmt,
+                self.quality,
+            )
+        except BrokenProcessPool:
+            # Worker was killed (ex. OOM), the pool can't be used anymore.
+            # Concurrent failures of the same pool restart it only once.
+            if self._pool is pool:
+                self._logger.error("Image worker died, restarting pool")
+                pool.shutdown(wait=False)
+                self._pool = self._new_pool()
+            return None
+
+    async def normalize(
+        self, filename: str, data: bytes
+    ) -> Tuple[str, bytes, bool]:
+        """Filename and content to upload, and if it's a document.
+
+        Args:
+            filename (str): Filename of image, its extension is replaced
+                by the encoder one.
+            data (bytes): Image content.
+        """
+        loop = asyncio.get_event_loop()
+        digest = await loop.run_in_executor(
+            None, lambda: hashlib.sha256(data).digest()
+        )
+
+        result = self._cache.get(digest)
+        if result is not None:
+            self._cache.move_to_end(digest)
+            self._stats["hits"] += 1
+        else:
+            future = self._pending.get(digest)
+            if future is None:
+                future = asyncio.ensure_future(self._normalize(data))
+                self._pending[digest] = future
+                future.add_done_callback(
+                    lambda _: self._pending.pop(digest, None)
+                )
+                self._stats["misses"] += 1
+            else:
+                self._stats["hits"] += 1
+
+            result = await future
+            if result is None:
+                # Not cached: the next attempt may succeed
+                result = KEEP, b""
+            elif digest not in self._cache:
+                self._cache_put(digest, result)
+
+        action, content = result
+        self._stats[action] += 1
+        if action == DOCUMENT:
+            return filename, data, True
+        if action == KEEP:
+            return filename, data, False
+
+        self._stats["bytes_in"] += len(data)
+        self._stats["bytes_out"] += len(content)
+        ext = ENCODERS[self.fmt][1]
+        return os.path.splitext(filename)[0] + ext, content, False
+
+    def stats(self) -> Dict:
+        return dict(
+            self._stats,
+            cached=len(self._cache),
+            cached_bytes=self._cache_size,
+        )
+
+    def stop(self):
+        self._pool.shutdown(wait=False)
@@ -1,24 +1,53 @@
 import logging
 import base64
+import binascii
+import json
 import time
 import argparse
 import os
 import io
 import gc
+import asyncio
+import collections
+import functools
+import heapq
+import math
+import multiprocessing
+import threading
 import traceback
-from typing import Any, Dict, AnyStr, List
+from concurrent.futures import Future
+from typing import Any, Dict, List, Tuple, Union
 
 from easydict import EasyDict as edict
 
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from uvicorn.supervisors import Multiprocess
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from pydantic import (
+    BaseModel,
+    StrictBool,
+    StrictBytes,
+    StrictFloat,
+    StrictInt,
+    StrictStr,
+    ValidationError,
+    conint,
+    conlist,
+    constr,
+)
 
 from telegram import (
     Update,
     ParseMode,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo,
+    Message,
 )
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     CallbackContext,
     Updater,
@@ -32,13 +61,57 @@ from telegram.ext import (
 import schedule
 from easydict import EasyDict as edict
 
+import tgcli_debug
+import tgcli_files
+import tgcli_history
+import tgcli_images
+import tgcli_shared
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 
 default_cfg = {
     "debug": False,
-    "bot": {"token": "", "chat": ""},
-    "api": {"host": "0.0.0.0", "port": 4444},
+    "bot": {"token": "", "chat": "", "base_url": "", "base_file_url": ""},
+    "api": {
+        "host": "0.0.0.0",
+        "port": 4444,
+        "outbox_workers": 4,
+        "max_uploads": 2,
+        "max_queue": 100,
+        "max_queue_bytes": 256 * 1024 * 1024,
+        "debug_token": "",
+        "workers": 1,
+        "state": "",
+    },
+    "history": {"path": "", "keep_days": 0},
+    "files": {
+        "cache_dir": "~/.cache/tgcli_server/files",
+        "cache_bytes": 1024 * 1024 * 1024,
+    },
+    "images": {
+        "workers": 0,
+        "max_side": 2560,
+        "format": "jpeg",
+        "quality": 85,
+        "cache_bytes": 64 * 1024 * 1024,
+    },
 }
 
+DEFAULT_HISTORY_PATH = "~/.local/share/tgcli/history.db"
+DEFAULT_STATE_PATH = "~/.cache/tgcli_server/state.db"
+
+# Config of parent process for uvicorn workers, see `create_app`
+CFG_ENV = "TGCLI_SERVER_CFG"
+
 
 def setup_logger(cfg: dict):
     logger = logging.getLogger()
@@ -93,6 +166,16 @@ def update_cfg(cfg, args) -> dict:
         cfg.bot.token = str(args.token).strip()
     cfg.bot.token = os.environ.get("TGCLI_TOKEN", cfg.bot.token)
 
+    # Custom Bot API server (ex. local fake API for benchmarks)
+    cfg.bot.base_url = os.environ.get("TGCLI_BOT_API_URL", cfg.bot.base_url)
+    cfg.bot.base_file_url = os.environ.get(
+        "TGCLI_BOT_FILE_URL", cfg.bot.base_file_url
+    )
+    if not cfg.bot.base_file_url and cfg.bot.base_url.endswith("/bot"):
+        # Bot API server layout: <host>/bot<token>/<method> for methods and
+        # <host>/file/bot<token>/<path> for files
+        cfg.bot.base_file_url = cfg.bot.base_url[: -len("bot")] + "file/bot"
+
     # Debug is not a part of args just for compact cli
     cfg.debug = bool(os.environ.get("TGCLI_DEBUG", cfg.debug))
 
@@ -102,6 +185,71 @@ def update_cfg(cfg, args) -> dict:
     cfg.api.host = os.environ.get("TGCLI_HOST", cfg.api.host)
     cfg.api.port = int(os.environ.get("TGCLI_PORT", cfg.api.port))
 
+    # Backpressure: requests over these limits get 503 with Retry-After
+    cfg.api.outbox_workers = int(
+        os.environ.get("TGCLI_OUTBOX_WORKERS", cfg.api.outbox_workers)
+    )
+    cfg.api.max_uploads = int(
+        os.environ.get("TGCLI_MAX_UPLOADS", cfg.api.max_uploads)
+    )
+    cfg.api.max_queue = int(
+        os.environ.get("TGCLI_MAX_QUEUE", cfg.api.max_queue)
+    )
+    cfg.api.max_queue_bytes = int(
+        os.environ.get("TGCLI_MAX_QUEUE_BYTES", cfg.api.max_queue_bytes)
+    )
+
+    # Debug endpoints (profiler, tracemalloc) are enabled only with token
+    cfg.api.debug_token = os.environ.get(
+        "TGCLI_DEBUG_TOKEN", cfg.api.debug_token
+    )
+
+    # Several API processes share replies, idempotency keys and flood
+    # control through SQLite file. Processes with the same TGCLI_STATE
+    # (ex. on several ports) work as one server.
+    cfg.api.workers = int(os.environ.get("TGCLI_WORKERS", cfg.api.workers))
+    cfg.api.state = os.environ.get("TGCLI_STATE", cfg.api.state)
+    if cfg.api.workers > 1 and not cfg.api.state:
+        cfg.api.state = DEFAULT_STATE_PATH
+    cfg.api.state = os.path.expanduser(cfg.api.state)
+
+    # Local full-text history of sent messages and replies, off by default.
+    # Path of SQLite file, or "1" for the default one.
+    cfg.history.path = os.environ.get("TGCLI_HISTORY", cfg.history.path)
+    if cfg.history.path.strip().lower() in ("1", "true", "yes"):
+        cfg.history.path = DEFAULT_HISTORY_PATH
+    cfg.history.path = os.path.expanduser(cfg.history.path.strip())
+    cfg.history.keep_days = float(
+        os.environ.get("TGCLI_HISTORY_DAYS", cfg.history.keep_days)
+    )
+
+    # Files of replies are downloaded from Telegram once and served from disk
+    cfg.files.cache_dir = os.path.expanduser(
+        os.environ.get("TGCLI_FILE_CACHE", cfg.files.cache_dir)
+    )
+    cfg.files.cache_bytes = int(
+        os.environ.get("TGCLI_FILE_CACHE_BYTES", cfg.files.cache_bytes)
+    )
+
+    # Images are shrunk to Telegram photo limits in process pool before
+    # upload, off by default. Requires Pillow.
+    cfg.images.workers = int(
+        os.environ.get("TGCLI_IMAGE_WORKERS", cfg.images.workers)
+    )
+    cfg.images.max_side = int(
+        os.environ.get("TGCLI_IMAGE_MAX_SIDE", cfg.images.max_side)
+    )
+    cfg.images.format = os.environ.get("TGCLI_IMAGE_FORMAT", cfg.images.format)
+    cfg.images.quality = int(
+        os.environ.get("TGCLI_IMAGE_QUALITY", cfg.images.quality)
+    )
+    cfg.images.cache_bytes = int(
+        os.environ.get("TGCLI_IMAGE_CACHE_BYTES", cfg.images.cache_bytes)
+    )
+    if cfg.images.workers > 0 and not tgcli_images.is_available():
+        print("[ERROR] Pillow is not installed, images are sent as is")
+        cfg.images.workers = 0
+
     if not cfg.bot.chat.strip():
         print("[ERROR] Can't read chat id: '%s'" % cfg.bot.chat)
 
@@ -112,10 +260,525 @@ def update_cfg(cfg, args) -> dict:
     return cfg
 
 
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+MSGPACK_CONTENT_TYPES = [MSGPACK_CONTENT_TYPE, "application/x-msgpack"]
+
+
+class Codec:
+    """Body codec for API envelope.
+
+    JSON is decoded with orjson if it is installed. MessagePack is optional
+    and carries file content as raw bytes instead of base64 string.
+    """
+
+    @staticmethod
+    def content_type(header: str) -> str:
+        content_type = (header or JSON_CONTENT_TYPE).split(";")[0].strip()
+        if content_type in MSGPACK_CONTENT_TYPES:
+            return MSGPACK_CONTENT_TYPE
+        return content_type
+
+    @staticmethod
+    def is_supported(content_type: str) -> bool:
+        if content_type == JSON_CONTENT_TYPE:
+            return True
+        return content_type == MSGPACK_CONTENT_TYPE and msgpack is not None
+
+    @staticmethod
+    def loads(body: bytes, content_type: str) -> Any:
+        if content_type == MSGPACK_CONTENT_TYPE:
+            return msgpack.unpackb(body, raw=False)
+        if orjson is not None:
+            return orjson.loads(body)
+        return json.loads(body)
+
+    @staticmethod
+    def dumps(obj: Any, content_type: str) -> bytes:
+        if content_type == MSGPACK_CONTENT_TYPE:
+            return msgpack.packb(obj, use_bin_type=True)
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj).encode("utf-8")
+
+
+class Schema(BaseModel):
+    class Config:
+        extra = "forbid"
+
+
+class Envelope(Schema):
+    v: StrictInt = 1
+    method: StrictStr
+    data: Dict[StrictStr, Any]
+
+
+Priority = constr(strict=True, regex="^(high|normal|low)$")
+
+
+class SendRequest(Schema):
+    text: StrictStr = ""
+    filename: StrictStr = "unknown"
+    # base64 string for JSON, raw bytes for MessagePack
+    filecontent: Union[StrictBytes, StrictStr] = b""
+    markdown: StrictBool = False
+    keyboard_choice: List[StrictStr] = []
+    reply_to_id: Union[StrictStr, StrictInt] = ""
+    tags: List[StrictStr] = []
+    idempotency_key: StrictStr = ""
+    priority: Priority = "normal"
+    original: StrictBool = False
+
+
+class SendBatchRequest(Schema):
+    requests: conlist(SendRequest, min_items=1, max_items=100)
+
+
+class EditRequest(Schema):
+    message_id: Union[StrictStr, StrictInt]
+    text: StrictStr = ""
+    filename: StrictStr = "unknown"
+    # base64 string for JSON, raw bytes for MessagePack
+    filecontent: Union[StrictBytes, StrictStr] = b""
+    markdown: StrictBool = False
+    priority: Priority = "normal"
+    original: StrictBool = False
+
+
+class GetRepliesRequest(Schema):
+    message_ids: List[Union[StrictStr, StrictInt]] = []
+
+
+class GetEventsRequest(Schema):
+    since: StrictInt = 0
+    tags: List[StrictStr] = []
+    limit: conint(strict=True, gt=0, le=10000) = 1000
+
+
+class HistoryRequest(Schema):
+    query: StrictStr = ""
+    since: Union[StrictInt, StrictFloat] = 0
+    until: Union[StrictInt, StrictFloat] = 0
+    tags: List[StrictStr] = []
+    kind: constr(strict=True, regex="^(|sent|reply)$") = ""
+    limit: conint(strict=True, gt=0, le=10000) = 100
+
+
+def add_timing(timings: Dict, name: str, seconds: float):
+    """Add phase duration in ms. Phases of batch requests are summed."""
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds * 1000
+
+
+class Busy(Exception):
+    """Outbox can't accept more work now."""
+
+    def __init__(self, retry_after: float, status_code: int = 503):
+        super().__init__("Server is busy, retry after %.1fs" % retry_after)
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+# priority -> rank, lower is more urgent
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+class _Job:
+    __slots__ = (
+        "fut",
+        "fn",
+        "args",
+        "kwargs",
+        "size",
+        "lane",
+        "rank",
+        "seq",
+        "queued",
+        "timings",
+    )
+
+    def __init__(self, fn, args, kwargs, size, rank, seq, timings):
+        self.fut = Future()
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.size = size
+        self.lane = "media" if size else "text"
+        self.rank = rank
+        self.seq = seq
+        self.queued = time.perf_counter()
+        self.timings = timings
+
+    def __lt__(self, other: "_Job") -> bool:
+        return (self.rank, self.seq) < (other.rank, other.seq)
+
+
+class Outbox:
+    """Queue of outbound Telegram calls with priorities and admission control.
+
+    Calls are executed by worker threads, so API event loop is never
+    blocked by Telegram. Calls with files go to "media" lane, the rest to
+    "text" lane. Every lane is a priority queue, and only `max_uploads`
+    workers can upload at once, so text messages and alerts never wait
+    behind bulk uploads.
+
+    New calls are rejected with `Busy` if the queue is over count or bytes
+    limit and there is no queued call with lower priority to drop instead,
+    or if the call can't be started before client timeout. While Telegram
+    asks to wait after flood (429), low priority calls are rejected and
+    queued ones are dropped, the failed call is returned to the head of
+    its lane and retried.
+
+    Args:
+        workers (int): Concurrent Telegram calls.
+        max_uploads (int): Concurrent calls with files.
+        max_queue (int): Max queued calls.
+        max_queue_bytes (int): Max size of queued files.
+        flood_pause (tgcli_shared.SharedFloodPause): Flood control pause
+            shared with other server processes.
+    """
+
+    def __init__(
+        self,
+        workers: int = 4,
+        max_uploads: int = 2,
+        max_queue: int = 100,
+        max_queue_bytes: int = 256 * 1024 * 1024,
+        flood_pause: tgcli_shared.SharedFloodPause = None,
+    ):
+        self.workers = workers
+        self.flood_pause = flood_pause
+        # Keep at least one worker for text
+        self.max_uploads = max(min(max_uploads, workers - 1), 1)
+        self.max_queue = max_queue
+        self.max_queue_bytes = max_queue_bytes
+
+        self._cv = threading.Condition()
+        self._lanes = {"text": [], "media": []}
+        self._queue_bytes = 0
+        self._in_flight = {"text": 0, "media": 0}
+        self._seq = 0
+        self._paused_until = 0.0
+        # EWMA of one call duration, used to estimate queue wait
+        self._call_time = {"text": 0.1, "media": 1.0}
+        self._running = True
+
+        self._logger = logging.getLogger(self.__class__.__name__)
+        self._threads = [
+            threading.Thread(target=self._run, name="Outbox-%d" % i)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.daemon = True
+            t.start()
+
+    def stats(self) -> Dict:
+        with self._cv:
+            return {
+                "queue": {k: len(v) for k, v in self._lanes.items()},
+                "queue_bytes": self._queue_bytes,
+                "in_flight": dict(self._in_flight),
+                "paused_sec": max(self._paused_until - time.time(), 0),
+                "call_time": dict(self._call_time),
+            }
+
+    def _sync_pause(self):
+        if self.flood_pause is not None:
+            self._paused_until = max(
+                self._paused_until, self.flood_pause.get()
+            )
+
+    def _queue_len(self) -> int:
+        return sum(len(lane) for lane in self._lanes.values())
+
+    def _slots(self, lane: str) -> int:
+        if lane == "media":
+            return self.max_uploads
+        return max(self.workers - self._in_flight["media"], 1)
+
+    def _wait_estimate(self, lane: str, rank: int) -> float:
+        ahead = sum(1 for job in self._lanes[lane] if job.rank <= rank)
+        backlog = ahead + self._in_flight[lane]
+        slots = self._slots(lane)
+        if backlog < slots:
+            return 0.0
+        return (backlog - slots + 1) * self._call_time[lane] / slots
+
+    def _remove(self, jobs: List[_Job]):
+        for job in jobs:
+            lane = self._lanes[job.lane]
+            lane.remove(job)
+            heapq.heapify(lane)
+            self._queue_bytes -= job.size
+
+    def _victims(self, rank: int, size: int) -> List[_Job]:
+        """Queued jobs with lower priority to drop for the new one.
+
+        Returns:
+            List[_Job]: jobs to drop, None if there is no room anyway.
+        """
+        candidates = sorted(
+            (
+                j
+                for jobs in self._lanes.values()
+                for j in jobs
+                if j.rank > rank
+            ),
+            reverse=True,
+        )
+
+        victims = []
+        count, queue_bytes = self._queue_len(), self._queue_bytes
+        while count >= self.max_queue or (
+            size and queue_bytes and queue_bytes + size > self.max_queue_bytes
+        ):
+            # Only media frees bytes
+            media = count < self.max_queue
+            for job in candidates:
+                if job not in victims and (job.lane == "media" or not media):
+                    break
+            else:
+                return None
+
+            victims.append(job)
+            count -= 1
+            queue_bytes -= job.size
+        return victims
+
+    def submit(
+        self,
+        fn,
+        *args,
+        size: int = 0,
+        priority: str = "normal",
+        timeout: float = None,
+        timings: Dict = None,
+        **kwargs
+    ) -> Future:
+        """Queue `fn(*args, **kwargs)`.
+
+        Args:
+            size (int): Payload size in bytes.
+            priority (str): "high", "normal" or "low".
+            timeout (float): Client timeout in seconds. Call is rejected if
+                it most likely will not be finished in time.
+            timings (Dict): "queue" and "telegram" durations are added here.
+
+        Raises:
+            Busy: if call can't be accepted now.
+        """
+        rank = PRIORITIES.get(priority, PRIORITIES["normal"])
+        with self._cv:
+            job = _Job(fn, args, kwargs, size, rank, self._seq, timings)
+            self._seq += 1
+
+            self._sync_pause()
+            pause = max(self._paused_until - time.time(), 0)
+            if pause > 0 and rank >= PRIORITIES["low"]:
+                raise Busy(pause, status_code=429)
+
+            wait = pause + self._wait_estimate(job.lane, rank)
+            busy = Busy(max(wait, 1.0), status_code=429 if pause else 503)
+            if (
+                timeout is not None
+                and wait > 0
+                and wait + self._call_time[job.lane] > timeout
+            ):
+                raise busy
+
+            # Make room by dropping less urgent calls
+            dropped = self._victims(rank, size)
+            if dropped is None:
+                raise busy
+            self._remove(dropped)
+
+            heapq.heappush(self._lanes[job.lane], job)
+            self._queue_bytes += size
+            self._cv.notify()
+
+        for victim in dropped:
+            victim.fut.set_exception(busy)
+        if dropped:
+            self._logger.warning(
+                "%d queued calls were dropped for priority '%s'"
+                % (len(dropped), priority)
+            )
+        return job.fut
+
+    async def run(self, fn, *args, **kwargs):
+        """Submit and wait result without blocking event loop."""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    def _pop(self) -> _Job:
+        candidates = []
+        if self._lanes["text"]:
+            candidates.append(self._lanes["text"][0])
+        media_free = self._in_flight["media"] < self.max_uploads
+        if self._lanes["media"] and media_free:
+            candidates.append(self._lanes["media"][0])
+        if not candidates:
+            return None
+
+        job = min(candidates)
+        heapq.heappop(self._lanes[job.lane])
+        self._queue_bytes -= job.size
+        self._in_flight[job.lane] += 1
+        return job
+
+    def _next_job(self) -> _Job:
+        with self._cv:
+            while self._running:
+                self._sync_pause()
+                pause = self._paused_until - time.time()
+                if pause <= 0:
+                    job = self._pop()
+                    if job is not None:
+                        return job
+                self._cv.wait(pause if pause > 0 else None)
+        return None
+
+    def _on_flood(self, job: _Job, retry_after: float) -> List[_Job]:
+        """Pause, return job to its lane and drop queued low priority."""
+        self._paused_until = max(self._paused_until, time.time() + retry_after)
+
+        job.queued = time.perf_counter()
+        heapq.heappush(self._lanes[job.lane], job)
+        self._queue_bytes += job.size
+
+        dropped = [
+            j
+            for lane in self._lanes.values()
+            for j in lane
+            if j.rank >= PRIORITIES["low"] and j is not job
+        ]
+        self._remove(dropped)
+        return dropped
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            started = time.perf_counter()
+            add_timing(job.timings, "queue", started - job.queued)
+
+            result = error = retry_after = None
+            try:
+                if not job.fut.cancelled():
+                    result = job.fn(*job.args, **job.kwargs)
+            except RetryAfter as e:
+                self._logger.warning("Flood control, wait %ss" % e.retry_after)
+                retry_after = e.retry_after
+            except Exception as e:
+                error = e
+
+            call_time = time.perf_counter() - started
+            # Before the result: waiter reads timings right after it
+            add_timing(job.timings, "telegram", call_time)
+
+            dropped = []
+            with self._cv:
+                self._in_flight[job.lane] -= 1
+                self._call_time[job.lane] = (
+                    0.8 * self._call_time[job.lane] + 0.2 * call_time
+                )
+                if retry_after is not None:
+                    dropped = self._on_flood(job, retry_after)
+                self._cv.notify_all()
+
+            if retry_after is not None and self.flood_pause is not None:
+                self.flood_pause.set(time.time() + retry_after)
+            for j in dropped:
+                j.fut.set_exception(Busy(retry_after, status_code=429))
+            if retry_after is not None or job.fut.cancelled():
+                continue
+            if error is not None:
+                job.fut.set_exception(error)
+            else:
+                job.fut.set_result(result)
+
+    def stop(self):
+        with self._cv:
+            self._running = False
+            self._cv.notify_all()
+
+
+class IdempotencyCache:
+    """Results of requests by client idempotency key.
+
+    Repeated request with the same key gets the original result, and waits
+    for it if the first request is still in flight. Failed requests are
+    forgotten, so they can be retried. Keys expire after `ttl` seconds,
+    the oldest ones are dropped over `max_keys`.
+
+    It is used from event loop only, so there are no locks.
+
+    Args:
+        max_keys (int): Max stored keys.
+        ttl (float): Key lifetime in seconds.
+    """
+
+    def __init__(self, max_keys: int = 100000, ttl: float = 24 * 60 * 60):
+        self.max_keys = max_keys
+        self.ttl = ttl
+
+        # key -> (ts, asyncio.Future), ordered by ts
+        self._items = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _expire(self):
+        expire_ts = time.time() - self.ttl
+        while self._items:
+            ts, _ = next(iter(self._items.values()))
+            if ts > expire_ts and len(self._items) <= self.max_keys:
+                break
+            self._items.popitem(last=False)
+
+    async def run(self, key: str, fn, *args, **kwargs):
+        """Return result of `await fn(*args, **kwargs)` for the key."""
+        if not key:
+            return await fn(*args, **kwargs)
+
+        self._expire()
+        if key in self._items:
+            return await asyncio.shield(self._items[key][1])
+
+        fut = asyncio.get_event_loop().create_future()
+        self._items[key] = (time.time(), fut)
+        try:
+            result = await fn(*args, **kwargs)
+        except asyncio.CancelledError:
+            self._items.pop(key, None)
+            fut.cancel()
+            raise
+        except Exception as e:
+            self._items.pop(key, None)
+            fut.set_exception(e)
+            # Mark as retrieved: nobody may wait for it
+            fut.exception()
+            raise
+
+        fut.set_result(result)
+        return result
+
+
 class API:
     """
+    Request body is JSON ("Content-Type: application/json") or MessagePack
+    ("Content-Type: application/msgpack"). Response is encoded with the same
+    codec. "filecontent" is base64 string for JSON and raw bytes for
+    MessagePack. Unknown fields are rejected with 400. Every response has
+    "Server-Timing" header with durations of request phases in ms: "parse"
+    (body decode and validation), "b64" (file decode), "image" (image
+    normalization), "queue" (wait for outbox worker), "telegram" (Bot API
+    calls) and "total".
+
     --->
     {
+        "v": 1,
         "method": "send",
         "data": {
             "text": "",
@@ -123,10 +786,20 @@ class API:
             "filecontent": "",
             "keyboard_choice": [],
             "markdown": false,
-            "reply_to_id": ""
+            "reply_to_id": "",
+            "tags": ["job-1"],
+            "idempotency_key": "4f0c5d2e...",
+            "priority": "normal",
+            "original": false
         }
     }
     <---
+    Message is sent once per "idempotency_key": repeated request gets the
+    same "message_id", so client can safely retry on timeout. "priority"
+    is "high", "normal" or "low": messages with files never delay text
+    ones, and low priority is dropped first on overload. Images may be
+    shrunk and re-encoded by server (TGCLI_IMAGE_WORKERS), "original"
+    sends file untouched as document.
     {
         "status": "ok",
         "data": {
@@ -134,7 +807,51 @@ class API:
         }
     }
     --->
+    Send messages in order. Processing stops on the first error, so
+    "results" may be shorter than "requests".
+    {
+        "v": 1,
+        "method": "send_batch",
+        "data": {
+            "requests": [{"text": "one"}, {"text": "two"}]
+        }
+    }
+    <---
+    {
+        "status": "ok",
+        "data": {
+            "results": [
+                {"status": "ok", "message_id": "26"},
+                {"status": "error", "detail": "Something went wrong"}
+            ]
+        }
+    }
+    --->
+    Replace text or file of sent message. File type can't be changed from
+    photo/video to document and back.
     {
+        "v": 1,
+        "method": "edit",
+        "data": {
+            "message_id": "25",
+            "text": "",
+            "filename": "",
+            "filecontent": "",
+            "markdown": false,
+            "priority": "low",
+            "original": false
+        }
+    }
+    <---
+    {
+        "status": "ok",
+        "data": {
+            "message_id": "25"
+        }
+    }
+    --->
+    {
+        "v": 1,
         "method": "get_replies",
         "data": {
             "message_ids": ["25"]
@@ -150,88 +867,621 @@ class API:
         }
     }
     <---
+    Document and photo replies have "file" with metadata, "text" is their
+    caption. File content is served by "GET /files/<file_unique_id>".
+    {
+        "status": "ok",
+        "data": {
+            "replies": {
+                "25": [
+                    {
+                        "ts": 1634567890.1,
+                        "message_id": "27",
+                        "text": "new config",
+                        "file": {
+                            "file_unique_id": "AgADxwADn1qhSw",
+                            "file_name": "config.yaml",
+                            "mime_type": "application/x-yaml",
+                            "file_size": 1520
+                        }
+                    }
+                ]
+            },
+        }
+    }
+    <---
     {
         "status": "none",
         "data": {
             "replies": {}
         }
     }
+    --->
+    Replies are not removed by "get_events", so any number of clients can
+    read them. Pass "cursor" from previous response as "since" to get only
+    new events. Events are filtered by tags of source message.
+    {
+        "v": 1,
+        "method": "get_events",
+        "data": {
+            "since": 0,
+            "tags": ["job-1"],
+            "limit": 1000
+        }
+    }
+    <---
+    {
+        "status": "ok",
+        "data": {
+            "events": [
+                {
+                    "offset": 1634567890123,
+                    "ts": 1634567890.1,
+                    "message_id": "26",
+                    "reply_to": "25",
+                    "text": "one",
+                    "tags": ["job-1"]
+                }
+            ],
+            "cursor": 1634567890124
+        }
+    }
+    --->
+    Search local history of sent messages and replies, the newest first.
+    Enabled on server by TGCLI_HISTORY. Words of "query" are matched whole
+    in text, caption and filename, a word ending with "*" matches prefix.
+    "since" and "until" are unix timestamps, "kind" is "sent", "reply" or
+    "" for both.
+    {
+        "v": 1,
+        "method": "history",
+        "data": {
+            "query": "OOM",
+            "since": 1634000000,
+            "tags": ["job-1"],
+            "limit": 100
+        }
+    }
+    <---
+    {
+        "status": "ok",
+        "data": {
+            "messages": [
+                {
+                    "ts": 1634567890.1,
+                    "kind": "sent",
+                    "message_id": "25",
+                    "reply_to": "",
+                    "filename": "",
+                    "text": "job-1: OOM killed",
+                    "tags": ["job-1"]
+                }
+            ]
+        }
+    }
     """
 
+    VERSION = 1
+
     api = FastAPI()
     tg_bot = None
+    outbox = None
+    images = None
+    idempotency = IdempotencyCache()
+    shared_state = False
 
     @staticmethod
-    def _handle_send(data: Dict[AnyStr, Any]):
-        args = {
-            "text": "",
-            "filename": "",
-            "filecontent": "",
-            "keyboard_choice": [],
-            "markdown": False,
-            "reply_to_id": "",
-        }
-        args.update(data)
+    def _filecontent(req: Union[SendRequest, EditRequest], ctx: Dict) -> bytes:
+        if not isinstance(req.filecontent, str):
+            return req.filecontent
+
+        started = time.perf_counter()
+        try:
+            return base64.b64decode(req.filecontent, validate=True)
+        except binascii.Error:
+            raise HTTPException(
+                status_code=400, detail="filecontent is not base64"
+            )
+        finally:
+            add_timing(ctx["timings"], "b64", time.perf_counter() - started)
+
+    @staticmethod
+    async def _normalize(
+        req: Union[SendRequest, EditRequest], filecontent: bytes, ctx: Dict
+    ) -> Tuple[str, bytes, bool]:
+        """Filename, content and document flag of file to upload."""
+        if (
+            req.original
+            or API.images is None
+            or not filecontent
+            or not API.images.accepts(req.filename)
+        ):
+            return req.filename, filecontent, req.original
+
+        started = time.perf_counter()
+        try:
+            return await API.images.normalize(req.filename, filecontent)
+        finally:
+            add_timing(ctx["timings"], "image", time.perf_counter() - started)
+
+    @staticmethod
+    async def _handle_send(req: SendRequest, ctx: Dict):
+        return await API.idempotency.run(
+            req.idempotency_key, API._send, req, ctx
+        )
+
+    @staticmethod
+    async def _send(req: SendRequest, ctx: Dict):
+        filename, filecontent, as_document = await API._normalize(
+            req, API._filecontent(req, ctx), ctx
+        )
+        message_id = await API.outbox.run(
+            API.tg_bot.send,
+            size=len(filecontent),
+            priority=req.priority,
+            timeout=ctx["timeout"],
+            timings=ctx["timings"],
+            text=req.text,
+            filename=filename,
+            filecontent=filecontent,
+            markdown=req.markdown,
+            keyboard_choice=req.keyboard_choice,
+            reply_to_id=str(req.reply_to_id),
+            tags=req.tags,
+            as_document=as_document,
+        )
+        if message_id is None:
+            raise HTTPException(status_code=500, detail="Something went wrong")
+
+        return {"status": "ok", "data": {"message_id": str(message_id)}}
 
-        message_id = API.tg_bot.send(**args)
+    @staticmethod
+    async def _handle_send_batch(req: SendBatchRequest, ctx: Dict):
+        results = []
+        for send_req in req.requests:
+            try:
+                res = await API._handle_send(send_req, ctx)
+                results.append(
+                    {"status": "ok", "message_id": res["data"]["message_id"]}
+                )
+            except Busy:
+                if not results:
+                    raise
+                results.append({"status": "error", "detail": "busy"})
+                break
+            except Exception as e:
+                detail = e.detail if isinstance(e, HTTPException) else str(e)
+                results.append({"status": "error", "detail": detail})
+                # Keep order: the rest will be retried by client
+                break
+
+        return {"status": "ok", "data": {"results": results}}
+
+    @staticmethod
+    async def _handle_edit(req: EditRequest, ctx: Dict):
+        filename, filecontent, as_document = await API._normalize(
+            req, API._filecontent(req, ctx), ctx
+        )
+        message_id = await API.outbox.run(
+            API.tg_bot.edit,
+            size=len(filecontent),
+            priority=req.priority,
+            timeout=ctx["timeout"],
+            timings=ctx["timings"],
+            message_id=str(req.message_id),
+            text=req.text,
+            filename=filename,
+            filecontent=filecontent,
+            markdown=req.markdown,
+            as_document=as_document,
+        )
         if message_id is None:
             raise HTTPException(status_code=500, detail="Something went wrong")
 
         return {"status": "ok", "data": {"message_id": str(message_id)}}
 
     @staticmethod
-    def _handle_get_replies(data: Dict[AnyStr, Any]):
-        args = {
-            "message_ids": [],
-        }
-        args.update(data)
+    async def _call_store(fn, *args, **kwargs):
+        """Call reply store method of `tg_bot`.
+
+        Shared store is SQLite, which may wait for locks held by other
+        workers, so it's called in a thread to keep event loop running.
+        """
+        if not API.shared_state:
+            return fn(*args, **kwargs)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            None, functools.partial(fn, *args, **kwargs)
+        )
 
-        replies = API.tg_bot.get_replies(**args)
+    @staticmethod
+    async def _handle_get_replies(req: GetRepliesRequest, ctx: Dict):
+        replies = await API._call_store(
+            API.tg_bot.get_replies, message_ids=req.message_ids
+        )
         return {"status": "ok", "data": {"replies": replies}}
 
-    @api.post("/")
-    async def root(req: Dict[AnyStr, Any] = None):
-        if not req or b"method" not in req.keys():
+    @staticmethod
+    async def _handle_get_events(req: GetEventsRequest, ctx: Dict):
+        events, cursor = await API._call_store(
+            API.tg_bot.get_events,
+            since=req.since,
+            tags=req.tags,
+            limit=req.limit,
+        )
+        return {"status": "ok", "data": {"events": events, "cursor": cursor}}
+
+    @staticmethod
+    async def _handle_history(req: HistoryRequest, ctx: Dict):
+        if API.tg_bot.history is None:
+            raise HTTPException(
+                status_code=404,
+                detail="History is disabled, set TGCLI_HISTORY on server",
+            )
+
+        # SQLite query shouldn't block event loop
+        loop = asyncio.get_event_loop()
+        messages = await loop.run_in_executor(
+            None,
+            lambda: API.tg_bot.history.search(
+                query=req.query,
+                since=req.since,
+                until=req.until,
+                tags=req.tags,
+                kind=req.kind,
+                limit=req.limit,
+            ),
+        )
+        return {"status": "ok", "data": {"messages": messages}}
+
+    # version -> method -> (schema, handler)
+    METHODS = {
+        1: {
+            "send": (SendRequest, _handle_send.__func__),
+            "send_batch": (SendBatchRequest, _handle_send_batch.__func__),
+            "edit": (EditRequest, _handle_edit.__func__),
+            "get_replies": (GetRepliesRequest, _handle_get_replies.__func__),
+            "get_events": (GetEventsRequest, _handle_get_events.__func__),
+            "history": (HistoryRequest, _handle_history.__func__),
+        }
+    }
+
+    @staticmethod
+    def _decode(body: bytes, content_type: str):
+        if not body:
             raise HTTPException(
                 status_code=404, detail="'method' keyword was not found"
             )
 
-        data = req.get(b"data", {})
-        if not data:
+        try:
+            raw = Codec.loads(body, content_type)
+        except Exception:
+            raise HTTPException(status_code=400, detail="Can't decode body")
+
+        if not isinstance(raw, dict) or "method" not in raw:
+            raise HTTPException(
+                status_code=404, detail="'method' keyword was not found"
+            )
+        if not raw.get("data"):
             raise HTTPException(status_code=400, detail="data was not found")
 
-        ret = {"status": "unknown_error"}
-        if req[b"method"] == "send":
-            ret = API._handle_send(data)
-        elif req[b"method"] == "get_replies":
-            ret = API._handle_get_replies(data)
-        else:
+        try:
+            envelope = Envelope.parse_obj(raw)
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=e.errors())
+
+        methods = API.METHODS.get(envelope.v)
+        if methods is None:
+            raise HTTPException(
+                status_code=400,
+                detail="Unsupported API version: %s" % envelope.v,
+            )
+        if envelope.method not in methods:
             raise HTTPException(status_code=404, detail="Unknown method")
 
+        schema, handler = methods[envelope.method]
+        try:
+            return handler, schema.parse_obj(envelope.data)
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=e.errors())
+
+    @staticmethod
+    def _server_timing(timings: Dict, started: float) -> str:
+        add_timing(timings, "total", time.perf_counter() - started)
+        return ", ".join(
+            "%s;dur=%.2f" % (name, ms) for name, ms in timings.items()
+        )
+
+    @api.post("/")
+    async def root(request: Request):
+        started = time.perf_counter()
+
+        content_type = Codec.content_type(request.headers.get("content-type"))
+        if not Codec.is_supported(content_type):
+            raise HTTPException(
+                status_code=415,
+                detail="Unsupported content type '%s'" % content_type,
+            )
+
+        body = await request.body()
+
+        # Phase durations in ms, returned in Server-Timing header
+        ctx = {"timeout": None, "timings": {}}
+        parse_started = time.perf_counter()
+        handler, req = API._decode(body, content_type)
+        add_timing(
+            ctx["timings"], "parse", time.perf_counter() - parse_started
+        )
+
+        try:
+            ctx["timeout"] = float(request.headers["x-tgcli-timeout"])
+        except (KeyError, ValueError):
+            pass
+
+        try:
+            ret = await handler(req, ctx)
+        except Busy as e:
+            retry_after = math.ceil(e.retry_after)
+            return Response(
+                content=Codec.dumps(
+                    {"status": "busy", "data": {"retry_after": retry_after}},
+                    content_type,
+                ),
+                status_code=e.status_code,
+                headers={
+                    "Retry-After": str(retry_after),
+                    "Server-Timing": API._server_timing(
+                        ctx["timings"], started
+                    ),
+                },
+                media_type=content_type,
+            )
+
         if ret["status"] != "ok":
             raise HTTPException(status_code=500, detail="Something went wrong")
 
-        return ret
+        return Response(
+            content=Codec.dumps(ret, content_type),
+            media_type=content_type,
+            headers={
+                "Server-Timing": API._server_timing(ctx["timings"], started)
+            },
+        )
+
+    @api.get("/files/{file_unique_id}")
+    async def files(file_unique_id: str):
+        """Stream file of reply. It's downloaded from Telegram only once."""
+        info = await API._call_store(API.tg_bot.get_file_info, file_unique_id)
+        if info is None:
+            raise HTTPException(status_code=404, detail="Unknown file")
+
+        loop = asyncio.get_event_loop()
+        try:
+            path = await loop.run_in_executor(
+                None, API.tg_bot.download_file, file_unique_id
+            )
+        except BadRequest as e:
+            # Ex. Bot API can't download files larger than 20 MB
+            raise HTTPException(status_code=413, detail=str(e))
+        except OSError as e:
+            raise HTTPException(
+                status_code=502, detail="Can't download file: %s" % e
+            )
+
+        # Opened file is readable even if cache removes it meanwhile
+        f = open(path, "rb")
+        size = os.fstat(f.fileno()).st_size
+
+        def chunks():
+            with f:
+                while True:
+                    chunk = f.read(tgcli_files.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+
+        return StreamingResponse(
+            chunks(),
+            media_type=info["mime_type"] or "application/octet-stream",
+            headers={
+                "Content-Length": str(size),
+                "Content-Disposition": tgcli_files.content_disposition(
+                    info["file_name"] or file_unique_id
+                ),
+            },
+        )
 
-    def __init__(self, cfg: dict, tg_bot: ExtBot):
+    def __init__(
+        self,
+        cfg: dict,
+        tg_bot: ExtBot,
+        state: tgcli_shared.SharedState = None,
+        images: tgcli_images.ImageNormalizer = None,
+    ):
         self.cfg = cfg
         API.tg_bot = tg_bot
+        API.images = images
+        API.outbox = Outbox(
+            workers=cfg.outbox_workers,
+            max_uploads=cfg.max_uploads,
+            max_queue=cfg.max_queue,
+            max_queue_bytes=cfg.max_queue_bytes,
+            flood_pause=(
+                tgcli_shared.SharedFloodPause(state) if state else None
+            ),
+        )
+        if state is not None:
+            API.idempotency = tgcli_shared.SharedIdempotencyCache(state)
+        API.shared_state = state is not None
         self._logger = logging.getLogger(self.__class__.__name__)
 
+        if cfg.debug_token:
+            self._logger.warning("Debug endpoints are enabled at /debug")
+            debugger = tgcli_debug.Debugger(cfg.debug_token, stats=API.stats)
+            self.api.include_router(debugger.router)
+
+    @staticmethod
+    def stats() -> Dict:
+        return {
+            "outbox": API.outbox.stats(),
+            "idempotency_keys": len(API.idempotency),
+            "replies": API.tg_bot.stats(),
+            "history": (
+                API.tg_bot.history.stats() if API.tg_bot.history else None
+            ),
+            "images": API.images.stats() if API.images else None,
+        }
+
     def run(self):
         uvicorn.run(
             self.api, host=self.cfg.host, port=self.cfg.port, log_level="error"
         )
 
 
+class ReplyStore:
+    """Replies to sent messages.
+
+    Every reply is appended to event log with monotonically increasing
+    offset, so any number of clients can read it with a cursor. Offsets
+    start from current time in ms to stay monotonic over server restarts.
+
+    Legacy `get_replies` map is kept for old clients: it returns replies
+    only once.
+    """
+
+    MAX_EVENTS = 100000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._replies_map = {}
+        self._tags = {}
+        # file_unique_id -> (ts, file_id, file info)
+        self._files = {}
+        self._events = []
+        self._first_offset = int(time.time() * 1000)
+
+    @property
+    def next_offset(self) -> int:
+        return self._first_offset + len(self._events)
+
+    def add_tags(self, message_id: str, tags: List[str]):
+        if not tags:
+            return
+
+        with self._lock:
+            self._tags[str(message_id)] = (time.time(), list(tags))
+
+    def add_reply(self, source_id: str, reply: dict) -> Dict:
+        """Returns event with tags of source message."""
+        source_id = str(source_id)
+        with self._lock:
+            self._replies_map.setdefault(source_id, []).append(reply)
+
+            tags = self._tags.get(source_id, (None, []))[1]
+            event = dict(reply, reply_to=source_id, tags=tags)
+            event["offset"] = self.next_offset
+            self._events.append(event)
+
+            if len(self._events) > self.MAX_EVENTS:
+                self._trim_events(len(self._events) - self.MAX_EVENTS)
+
+        return event
+
+    def add_file(self, file_id: str, info: dict):
+        with self._lock:
+            self._files[info["file_unique_id"]] = (time.time(), file_id, info)
+
+    def get_file(self, file_unique_id: str) -> Tuple[str, Dict]:
+        """Returns file_id and file info or (None, None)."""
+        with self._lock:
+            return self._files.get(file_unique_id, (None, None, None))[1:]
+
+    def get_replies(self, message_ids: List[str]) -> Dict:
+        new_map = {}
+
+        with self._lock:
+            for message_id in message_ids:
+                message_id = str(message_id)
+                if message_id in self._replies_map:
+                    new_map[message_id] = self._replies_map.pop(message_id)
+
+        return new_map
+
+    def get_events(
+        self, since: int = 0, tags: List[str] = [], limit: int = 1000
+    ) -> Tuple[List[Dict], int]:
+        """Get events with offset >= since.
+
+        Returns:
+            Tuple[List[Dict], int]: events and cursor for the next call.
+        """
+        with self._lock:
+            start = max(since - self._first_offset, 0)
+            events = self._events[start:]
+            cursor = self.next_offset
+
+        if tags:
+            tags = set(tags)
+            events = [e for e in events if tags.intersection(e["tags"])]
+
+        if len(events) > limit:
+            events = events[:limit]
+            cursor = events[-1]["offset"] + 1
+
+        return events, cursor
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "replies_map": len(self._replies_map),
+                "replies_map_items": sum(
+                    len(v) for v in self._replies_map.values()
+                ),
+                "tags": len(self._tags),
+                "files": len(self._files),
+                "events": len(self._events),
+            }
+
+    def _trim_events(self, count: int):
+        del self._events[:count]
+        self._first_offset += count
+
+    def remove_old(self, keep_after_ts: float):
+        with self._lock:
+            new_map = {}
+            for k, replies in self._replies_map.items():
+                new_list = [v for v in replies if v["ts"] > keep_after_ts]
+                if new_list:
+                    new_map[k] = new_list
+            self._replies_map = new_map
+
+            self._tags = {
+                k: v for k, v in self._tags.items() if v[0] > keep_after_ts
+            }
+            self._files = {
+                k: v for k, v in self._files.items() if v[0] > keep_after_ts
+            }
+
+            old_count = 0
+            for event in self._events:
+                if event["ts"] > keep_after_ts:
+                    break
+                old_count += 1
+            self._trim_events(old_count)
+
+
 class TelegramBot:
 
-    IMG_FORMATS = [".jpg", ".jpeg", ".png"]
+    IMG_FORMATS = [".jpg", ".jpeg", ".png", ".webp"]
     VIDEO_FORMATS = [".mp4", ".avi", ".mov"]
 
     SAVE_REPLIES_DAYS = 2
     SAVE_REPLIES_SEC = SAVE_REPLIES_DAYS * 24 * 60 * 60
 
+    # How often other processes check if poller is alive
+    ELECTION_INTERVAL = 5.0
+
     def _command_start(self, update: Update, context: CallbackContext) -> None:
         if not update.message:
             return
@@ -256,19 +1506,52 @@ class TelegramBot:
         if not source_msg:
             return None
 
-        message_id = str(source_msg.message_id)
-        if message_id not in self._replies_map:
-            self._replies_map[message_id] = []
-        self._replies_map[message_id].append(
-            {
-                "ts": time.time(),
-                "message_id": str(update.message.message_id),
-                "text": update.message.text,
-            }
+        reply = {
+            "ts": time.time(),
+            "message_id": str(update.message.message_id),
+            "text": update.message.text or update.message.caption or "",
+        }
+        file_id, file_info = self._file_info(update.message)
+        if file_id is not None:
+            self._store.add_file(file_id, file_info)
+            reply["file"] = file_info
+
+        event = self._store.add_reply(source_msg.message_id, reply)
+        self._add_history(
+            "reply",
+            update.message.message_id,
+            text=reply["text"],
+            filename=file_info["file_name"] if file_info else "",
+            tags=event["tags"],
+            reply_to=source_msg.message_id,
         )
 
         self._scheduler.run_pending()
 
+    @staticmethod
+    def _file_info(message: Message) -> Tuple[str, Dict]:
+        """file_id and metadata of document or photo, (None, None) if none."""
+        if message.document:
+            doc = message.document
+            return doc.file_id, {
+                "file_unique_id": doc.file_unique_id,
+                "file_name": doc.file_name or doc.file_unique_id,
+                "mime_type": doc.mime_type or "",
+                "file_size": doc.file_size or 0,
+            }
+
+        if message.photo:
+            # Sizes are sorted, the last one is the original
+            photo = message.photo[-1]
+            return photo.file_id, {
+                "file_unique_id": photo.file_unique_id,
+                "file_name": "photo_%s.jpg" % message.message_id,
+                "mime_type": "image/jpeg",
+                "file_size": photo.file_size or 0,
+            }
+
+        return None, None
+
     def _reply_handler(self, update: Update, context: CallbackContext) -> None:
         msg = update.callback_query.message
         self.bot.edit_message_text(
@@ -278,15 +1561,20 @@ class TelegramBot:
             reply_markup=None,
         )
 
-        message_id = str(msg.message_id)
-        if message_id not in self._replies_map:
-            self._replies_map[message_id] = []
-        self._replies_map[message_id].append(
+        event = self._store.add_reply(
+            msg.message_id,
             {
                 "ts": time.time(),
-                "message_id": message_id,
+                "message_id": str(msg.message_id),
                 "text": update.callback_query.data,
-            }
+            },
+        )
+        self._add_history(
+            "reply",
+            msg.message_id,
+            text=update.callback_query.data,
+            tags=event["tags"],
+            reply_to=msg.message_id,
         )
 
         self._scheduler.run_pending()
@@ -301,12 +1589,28 @@ class TelegramBot:
         tb_string = "".join(tb_list)
         self._logger.error("Traceback: %s" % tb_string)
 
-    def __init__(self, cfg: edict):
+    def __init__(
+        self,
+        cfg: edict,
+        history: tgcli_history.History = None,
+        file_cache: tgcli_files.FileCache = None,
+        store: ReplyStore = None,
+        poller_lock: tgcli_shared.PollerLock = None,
+    ):
         self.cfg = cfg
+        self.history = history
+        self.file_cache = file_cache
+        self._poller_lock = poller_lock
+        self._stopped = threading.Event()
         self._logger = logging.getLogger(self.__class__.__name__)
         self._logger.info("Starting with cfg: %s" % self.cfg)
 
-        self._updater = Updater(self.cfg.token, use_context=True)
+        self._updater = Updater(
+            self.cfg.token,
+            base_url=self.cfg.base_url or None,
+            base_file_url=self.cfg.base_file_url or None,
+            use_context=True,
+        )
 
         dp = self._updater.dispatcher
         self.bot = self._updater.bot
@@ -316,7 +1620,7 @@ class TelegramBot:
         dp.add_handler(
             MessageHandler(
                 Filters.reply
-                & Filters.text
+                & (Filters.text | Filters.document | Filters.photo)
                 & ~Filters.command
                 & ~Filters.update.edited_message,
                 self._message_handler,
@@ -327,23 +1631,34 @@ class TelegramBot:
         self._scheduler = schedule.Scheduler()
         self._scheduler.every(1).days.do(self._remove_old_replies)
 
-        self._replies_map = {}
-        self._updater.start_polling()
+        self._store = store if store is not None else ReplyStore()
+        if poller_lock is None:
+            self._updater.start_polling()
+        else:
+            threading.Thread(
+                target=self._poll_when_elected,
+                name="PollerElection",
+                daemon=True,
+            ).start()
+
+    def _poll_when_elected(self):
+        """Only one process of shared state can poll updates."""
+        while not self._stopped.is_set():
+            if self._poller_lock.acquire():
+                self._updater.start_polling()
+                return
+            self._stopped.wait(self.ELECTION_INTERVAL)
 
     def _remove_old_replies(self):
-        new_map = {}
-        keep_after_ts = time.time() - self.SAVE_REPLIES_SEC
-        for k in self._replies_map:
-            new_list = [
-                v for v in self._replies_map[k] if v["ts"] > keep_after_ts
-            ]
-
-            if new_list:
-                new_map[k] = new_map
-
-        self._replies_map = new_map
+        self._store.remove_old(time.time() - self.SAVE_REPLIES_SEC)
+        if self.history is not None:
+            self.history.remove_old()
         gc.collect()
 
+    def _add_history(self, kind: str, message_id: str, **kwargs):
+        if self.history is not None:
+            self.history.add(kind, message_id, **kwargs)
+
     def _get_keyboard(self, keyboard_choice: List[str]):
         return InlineKeyboardMarkup(
             [
@@ -353,24 +1668,39 @@ class TelegramBot:
         )
 
     def get_replies(self, message_ids: List[str]) -> Dict:
-        new_map = {}
+        return self._store.get_replies(message_ids)
 
-        for message_id in message_ids:
-            message_id = str(message_id)
-            if message_id in self._replies_map:
-                new_map[message_id] = self._replies_map[message_id]
-                del self._replies_map[message_id]
+    def get_events(
+        self, since: int = 0, tags: List[str] = [], limit: int = 1000
+    ) -> Tuple[List[Dict], int]:
+        return self._store.get_events(since=since, tags=tags, limit=limit)
 
-        return new_map
+    def stats(self) -> Dict:
+        return self._store.stats()
+
+    def get_file_info(self, file_unique_id: str) -> Dict:
+        return self._store.get_file(file_unique_id)[1]
+
+    def download_file(self, file_unique_id: str) -> str:
+        """Path of reply file in local cache."""
+        file_id, _ = self._store.get_file(file_unique_id)
+        if file_id is None:
+            raise KeyError(file_unique_id)
+
+        return self.file_cache.get(
+            file_unique_id, lambda: self.bot.get_file(file_id).file_path
+        )
 
     def send(
         self,
         text: str = "",
         filename: str = "unknown",
-        filecontent: str = "",
+        filecontent: bytes = b"",
         markdown: bool = False,
         keyboard_choice: List[str] = [],
         reply_to_id: str = "",
+        tags: List[str] = [],
+        as_document: bool = False,
     ) -> str:
         if not self.cfg.chat:
             return None
@@ -395,13 +1725,21 @@ class TelegramBot:
                 reply_markup=reply_markup,
                 reply_to_message_id=reply_to_id,
             )
+            self._store.add_tags(msg.message_id, tags)
+            self._add_history(
+                "sent",
+                msg.message_id,
+                text=text,
+                tags=tags,
+                reply_to=reply_to_id,
+            )
             return msg.message_id
 
-        bio = io.BytesIO(base64.b64decode(filecontent))
+        bio = io.BytesIO(filecontent)
 
         method = self.bot.send_document
         if filename and str(filename).find(".") != -1:
-            ext = os.path.splitext(filename)[1]
+            ext = "" if as_document else os.path.splitext(filename)[1]
             if ext in self.IMG_FORMATS:
                 method = self.bot.send_photo
             elif ext in self.VIDEO_FORMATS:
@@ -419,19 +1757,117 @@ class TelegramBot:
         )
         bio.close()
 
+        self._store.add_tags(msg.message_id, tags)
+        self._add_history(
+            "sent",
+            msg.message_id,
+            text=text,
+            filename=filename,
+            tags=tags,
+            reply_to=reply_to_id,
+        )
         return msg.message_id
 
+    def edit(
+        self,
+        message_id: str,
+        text: str = "",
+        filename: str = "unknown",
+        filecontent: bytes = b"",
+        markdown: bool = False,
+        as_document: bool = False,
+    ) -> str:
+        if not self.cfg.chat:
+            return None
+
+        parse_mode = ParseMode.MARKDOWN if markdown else None
+        text = text or None
+
+        try:
+            if not filecontent:
+                if text is None:
+                    return None
+
+                self.bot.edit_message_text(
+                    chat_id=self.cfg.chat,
+                    message_id=int(message_id),
+                    text=text,
+                    parse_mode=parse_mode,
+                )
+                return message_id
+
+            bio = io.BytesIO(filecontent)
+            bio.name = filename
+
+            media_cls = InputMediaDocument
+            ext = "" if as_document else os.path.splitext(filename)[1]
+            if ext in self.IMG_FORMATS:
+                media_cls = InputMediaPhoto
+            elif ext in self.VIDEO_FORMATS:
+                media_cls = InputMediaVideo
+
+            self.bot.edit_message_media(
+                chat_id=self.cfg.chat,
+                message_id=int(message_id),
+                media=media_cls(bio, caption=text, parse_mode=parse_mode),
+            )
+            bio.close()
+        except BadRequest as e:
+            # Same content, nothing to do
+            if "not modified" not in str(e):
+                raise
+
+        return message_id
+
     def stop(self):
         self._logger.info("Stopping telegram bot...")
+        self._stopped.set()
         self._updater.stop()
+        if self._poller_lock is not None:
+            self._poller_lock.release()
 
 
 class App:
     def __init__(self, cfg: edict):
         self._logger = logging.getLogger(self.__class__.__name__)
 
-        self.tg_bot = TelegramBot(cfg.bot)
-        self.api = API(cfg.api, self.tg_bot)
+        self.history = None
+        if cfg.history.path:
+            self._logger.info("History is written to %s" % cfg.history.path)
+            self.history = tgcli_history.History(
+                cfg.history.path, keep_days=cfg.history.keep_days
+            )
+
+        state = store = poller_lock = None
+        if cfg.api.state:
+            self._logger.info("Shared state is %s" % cfg.api.state)
+            state = tgcli_shared.SharedState(cfg.api.state)
+            store = tgcli_shared.SharedReplyStore(state)
+            poller_lock = tgcli_shared.PollerLock(cfg.api.state + ".lock")
+
+        self.tg_bot = TelegramBot(
+            cfg.bot,
+            history=self.history,
+            file_cache=tgcli_files.FileCache(
+                cfg.files.cache_dir, max_bytes=cfg.files.cache_bytes
+            ),
+            store=store,
+            poller_lock=poller_lock,
+        )
+        self.images = None
+        if cfg.images.workers > 0:
+            self._logger.info(
+                "Images are normalized by %d processes" % cfg.images.workers
+            )
+            self.images = tgcli_images.ImageNormalizer(
+                workers=cfg.images.workers,
+                max_side=cfg.images.max_side,
+                fmt=cfg.images.format,
+                quality=cfg.images.quality,
+                cache_bytes=cfg.images.cache_bytes,
+            )
+
+        self.api = API(cfg.api, self.tg_bot, state=state, images=self.images)
 
         self._logger.info("All modules were inited")
 
@@ -439,7 +1875,54 @@ class App:
         self.api.run()
 
     def stop(self) -> None:
+        self.api.outbox.stop()
         self.tg_bot.stop()
+        if self.history is not None:
+            self.history.stop()
+        if self.images is not None:
+            self.images.stop()
+
+
+def create_app() -> FastAPI:
+    """App of uvicorn worker process, cfg is passed by parent in env."""
+    cfg = edict(json.loads(os.environ[CFG_ENV]))
+    setup_logger(cfg)
+
+    app = App(cfg)
+    app.api.api.add_event_handler("shutdown", app.stop)
+    return app.api.api
+
+
+class Workers(Multiprocess):
+    """uvicorn supervisor which stops workers on its own signal.
+
+    uvicorn only waits for workers, they stop by themselves only if signal
+    was sent to the whole process group (Ctrl+C in terminal).
+    """
+
+    def shutdown(self) -> None:
+        for process in self.processes:
+            process.terminate()
+        super().shutdown()
+
+
+def run_workers(cfg: edict):
+    """Run `cfg.api.workers` processes on one port.
+
+    Every process has its own event loop and outbox, and they share state
+    in `cfg.api.state`. Only one of them polls Telegram updates.
+    """
+    os.environ[CFG_ENV] = json.dumps(cfg)
+    config = uvicorn.Config(
+        "tgcli_server:create_app",
+        factory=True,
+        host=cfg.api.host,
+        port=cfg.api.port,
+        workers=cfg.api.workers,
+        log_level="error",
+    )
+    server = uvicorn.Server(config=config)
+    Workers(config, target=server.run, sockets=[config.bind_socket()]).run()
 
 
 def main():
@@ -447,12 +1930,19 @@ def main():
     cfg = update_cfg(default_cfg, args)
     setup_logger(cfg)
 
+    # Server has threads, forked image workers could copy their locks in
+    # locked state. Set globally: `mp_context` of pools needs python 3.7.
+    multiprocessing.set_start_method("spawn", force=True)
+
     logger = logging.getLogger()
     logger.info("Starting with cfg: %s" % cfg)
 
-    app = App(cfg)
-    app.run()
-    app.stop()
+    if cfg.api.workers > 1:
+        run_workers(cfg)
+    else:
+        app = App(cfg)
+        app.run()
+        app.stop()
 
     logger.info("Finished!")
 
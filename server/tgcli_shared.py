@@ -0,0 +1,455 @@
+import asyncio
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Tuple
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    message_id TEXT PRIMARY KEY,
+    ts REAL NOT NULL,
+    tags TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS replies (
+    id INTEGER PRIMARY KEY,
+    source_id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    reply TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS replies_source_id ON replies (source_id);
+
+CREATE TABLE IF NOT EXISTS events (
+    offset INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    event TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS files (
+    file_unique_id TEXT PRIMARY KEY,
+    ts REAL NOT NULL,
+    file_id TEXT NOT NULL,
+    info TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS idempotency (
+    key TEXT PRIMARY KEY,
+    ts REAL NOT NULL,
+    result TEXT
+);
+
+CREATE TABLE IF NOT EXISTS flood (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    paused_until REAL NOT NULL
+);
+"""
+
+
+class SharedState:
+    """SQLite database shared by server processes on one host.
+
+    Every thread has its own connection in autocommit mode, writes are
+    done in `BEGIN IMMEDIATE` transactions, so read-modify-write is atomic
+    between processes. WAL lets readers work while somebody writes.
+
+    Args:
+        path (str): Database file. It must be on local disk: SQLite
+            locks are not reliable on network filesystems.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+        self._local = threading.local()
+        self.conn().executescript("BEGIN IMMEDIATE;\n%sCOMMIT;" % SCHEMA)
+
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+
+class SharedReplyStore:
+    """`ReplyStore` in `SharedState`, for several server processes.
+
+    Same interface and semantics: events have monotonically increasing
+    offsets starting from creation time in ms, legacy `get_replies`
+    returns every reply only once, even if several processes ask for it.
+    """
+
+    MAX_EVENTS = 100000
+
+    def __init__(self, state: SharedState):
+        self._state = state
+        with state.transaction() as conn:
+            # AUTOINCREMENT continues from here and never reuses offsets
+            conn.execute(
+                "INSERT INTO sqlite_sequence (name, seq)"
+                " SELECT 'events', ? WHERE NOT EXISTS"
+                " (SELECT 1 FROM sqlite_sequence WHERE name = 'events')",
+                (int(time.time() * 1000),),
+            )
+
+    def add_tags(self, message_id: str, tags: List[str]):
+        if not tags:
+            return
+
+        with self._state.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO tags (message_id, ts, tags)"
+                " VALUES (?, ?, ?)",
+                (str(message_id), time.time(), json.dumps(list(tags))),
+            )
+
+    def add_reply(self, source_id: str, reply: dict) -> Dict:
+        """Returns event with tags of source message."""
+        source_id = str(source_id)
+        with self._state.transaction() as conn:
+            conn.execute(
+                "INSERT INTO replies (source_id, ts, reply) VALUES (?, ?, ?)",
+                (source_id, reply["ts"], json.dumps(reply)),
+            )
+
+            row = conn.execute(
+                "SELECT tags FROM tags WHERE message_id = ?", (source_id,)
+            ).fetchone()
+            tags = json.loads(row["tags"]) if row else []
+
+            event = dict(reply, reply_to=source_id, tags=tags)
+            cursor = conn.execute(
+                "INSERT INTO events (ts, event) VALUES (?, '')",
+                (reply["ts"],),
+            )
+            event["offset"] = cursor.lastrowid
+            conn.execute(
+                "UPDATE events SET event = ? WHERE offset = ?",
+                (json.dumps(event), event["offset"]),
+            )
+
+            conn.execute(
+                "DELETE FROM events WHERE offset <= ?",
+                (event["offset"] - self.MAX_EVENTS,),
+            )
+        return event
+
+    def add_file(self, file_id: str, info: dict):
+        with self._state.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO files"
+                " (file_unique_id, ts, file_id, info) VALUES (?, ?, ?, ?)",
+                (
+                    info["file_unique_id"],
+                    time.time(),
+                    file_id,
+                    json.dumps(info),
+                ),
+            )
+
+    def get_file(self, file_unique_id: str) -> Tuple[str, Dict]:
+        """Returns file_id and file info or (None, None)."""
+        row = (
+            self._state.conn()
+            .execute(
+                "SELECT file_id, info FROM files WHERE file_unique_id = ?",
+                (file_unique_id,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None, None
+        return row["file_id"], json.loads(row["info"])
+
+    def get_replies(self, message_ids: List[str]) -> Dict:
+        message_ids = [str(message_id) for message_id in message_ids]
+        if not message_ids:
+            return {}
+
+        where = "source_id IN (%s)" % ", ".join("?" * len(message_ids))
+
+        # Waiters poll often, don't take write lock while there is nothing
+        row = (
+            self._state.conn()
+            .execute(
+                "SELECT 1 FROM replies WHERE %s LIMIT 1" % where, message_ids
+            )
+            .fetchone()
+        )
+        if row is None:
+            return {}
+
+        new_map = {}
+        with self._state.transaction() as conn:
+            rows = conn.execute(
+                "SELECT id, source_id, reply FROM replies"
+                " WHERE %s ORDER BY id" % where,
+                message_ids,
+            ).fetchall()
+            if rows:
+                conn.executemany(
+                    "DELETE FROM replies WHERE id = ?",
+                    [(row["id"],) for row in rows],
+                )
+
+        for row in rows:
+            new_map.setdefault(row["source_id"], []).append(
+                json.loads(row["reply"])
+            )
+        return new_map
+
+    def get_events(
+        self, since: int = 0, tags: List[str] = [], limit: int = 1000
+    ) -> Tuple[List[Dict], int]:
+        """Get events with offset >= since.
+
+        Returns:
+            Tuple[List[Dict], int]: events and cursor for the next call.
+        """
+        tags = set(tags)
+        events = []
+
+        conn = self._state.conn()
+        # One read transaction: cursor matches scanned events
+        conn.execute("BEGIN")
+        rows = None
+        try:
+            row = conn.execute(
+                "SELECT seq FROM sqlite_sequence WHERE name = 'events'"
+            ).fetchone()
+            cursor = row["seq"] + 1
+
+            rows = conn.execute(
+                "SELECT event FROM events WHERE offset >= ? ORDER BY offset",
+                (since,),
+            )
+            for row in rows:
+                event = json.loads(row["event"])
+                if tags and not tags.intersection(event["tags"]):
+                    continue
+                events.append(event)
+                if len(events) == limit:
+                    cursor = event["offset"] + 1
+                    break
+        finally:
+            if rows is not None:
+                rows.close()
+            conn.execute("COMMIT")
+
+        return events, cursor
+
+    def stats(self) -> Dict:
+        conn = self._state.conn()
+        stats = {}
+        for table in ("replies", "tags", "files", "events"):
+            row = conn.execute("SELECT count(*) FROM %s" % table).fetchone()
+            stats[table] = row[0]
+        return stats
+
+    def remove_old(self, keep_after_ts: float):
+        with self._state.transaction() as conn:
+            for table in ("replies", "tags", "files", "events"):
+                conn.execute(
+                    "DELETE FROM %s WHERE ts <= ?" % table, (keep_after_ts,)
+                )
+
+
+class SharedIdempotencyCache:
+    """`IdempotencyCache` in `SharedState`, for several server processes.
+
+    The first request with a key claims it, the others poll for its
+    result, so a retry which comes to another process doesn't send the
+    message again. Failed requests are forgotten. A claim of a process
+    which died is taken over after `claim_ttl` seconds.
+
+    Args:
+        state (SharedState): Shared database.
+        ttl (float): Key lifetime in seconds.
+        claim_ttl (float): Max time of one request in seconds.
+    """
+
+    POLL_INTERVAL = 0.05
+    EXPIRE_EVERY = 1000
+
+    def __init__(
+        self,
+        state: SharedState,
+        ttl: float = 24 * 60 * 60,
+        claim_ttl: float = 300.0,
+    ):
+        self.ttl = ttl
+        self.claim_ttl = claim_ttl
+        self._state = state
+        self._claims = 0
+
+    def __len__(self) -> int:
+        return (
+            self._state.conn()
+            .execute("SELECT count(*) FROM idempotency")
+            .fetchone()[0]
+        )
+
+    def _claim(self, key: str) -> Tuple[bool, Dict]:
+        """Returns (True, None) if claimed, (False, result) if done."""
+        now = time.time()
+        with self._state.transaction() as conn:
+            self._claims += 1
+            if self._claims % self.EXPIRE_EVERY == 0:
+                conn.execute(
+                    "DELETE FROM idempotency WHERE ts < ?", (now - self.ttl,)
+                )
+
+            row = conn.execute(
+                "SELECT ts, result FROM idempotency WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and row["result"] is not None:
+                if row["ts"] > now - self.ttl:
+                    return False, json.loads(row["result"])
+            elif row is not None and row["ts"] > now - self.claim_ttl:
+                return False, None
+
+            conn.execute(
+                "INSERT OR REPLACE INTO idempotency (key, ts, result)"
+                " VALUES (?, ?, NULL)",
+                (key, now),
+            )
+            return True, None
+
+    def _save(self, key: str, result: Dict):
+        with self._state.transaction() as conn:
+            conn.execute(
+                "UPDATE idempotency SET ts = ?, result = ? WHERE key = ?",
+                (time.time(), json.dumps(result), key),
+            )
+
+    def _forget(self, key: str):
+        with self._state.transaction() as conn:
+            conn.execute("DELETE FROM idempotency WHERE key = ?", (key,))
+
+    async def run(self, key: str, fn, *args, **kwargs):
+        """Return result of `await fn(*args, **kwargs)` for the key."""
+        if not key:
+            return await fn(*args, **kwargs)
+
+        loop = asyncio.get_event_loop()
+        while True:
+            claimed, result = await loop.run_in_executor(
+                None, self._claim, key
+            )
+            if claimed:
+                break
+            if result is not None:
+                return result
+            # In flight in another process or request
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException:
+            await loop.run_in_executor(None, self._forget, key)
+            raise
+
+        await loop.run_in_executor(None, self._save, key, result)
+        return result
+
+
+class SharedFloodPause:
+    """Telegram flood control pause shared by all processes.
+
+    Telegram limits are per bot, so when one process gets 429, the others
+    have to wait too. The value is cached for `max_age` seconds to keep
+    database out of every Telegram call.
+
+    Args:
+        state (SharedState): Shared database.
+        max_age (float): Cache time of the value in seconds.
+    """
+
+    def __init__(self, state: SharedState, max_age: float = 0.5):
+        self.max_age = max_age
+        self._state = state
+        self._value = 0.0
+        self._read_at = 0.0
+
+    def get(self) -> float:
+        now = time.time()
+        if now - self._read_at > self.max_age:
+            row = (
+                self._state.conn()
+                .execute("SELECT paused_until FROM flood WHERE id = 0")
+                .fetchone()
+            )
+            self._value = row["paused_until"] if row else 0.0
+            self._read_at = now
+        return self._value
+
+    def set(self, paused_until: float):
+        with self._state.transaction() as conn:
+            conn.execute(
+                "INSERT INTO flood (id, paused_until) VALUES (0, ?)"
+                " ON CONFLICT (id) DO UPDATE SET"
+                " paused_until = max(paused_until, excluded.paused_until)",
+                (paused_until,),
+            )
+        self._value = max(self._value, paused_until)
+
+
+class PollerLock:
+    """Election of the process which polls Telegram updates.
+
+    Telegram allows only one `getUpdates` consumer per bot. The process
+    which holds exclusive `flock` on the file polls, the others check it
+    on interval and take over when it dies: OS releases the lock of dead
+    process.
+
+    Args:
+        path (str): Lock file on local disk.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def acquire(self) -> bool:
+        """Non-blocking. Returns True if this process holds the lock."""
+        if self._fd is not None:
+            return True
+
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+
+        os.ftruncate(fd, 0)
+        os.write(fd, b"%d\n" % os.getpid())
+        self._fd = fd
+        self._logger.info("Process %d polls updates" % os.getpid())
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -5,7 +5,14 @@ setup(
     name="tgcli",
     version="1.0",
     description="TGCLI - send messages and files to telegram",
-    py_modules=["tgcli"],
+    py_modules=[
+        "tgcli",
+        "tgcli_metrics",
+        "tgcli_spool",
+        "tgcli_run",
+        "tgcli_logging",
+        "tgcli_history_cli",
+    ],
     entry_points={"console_scripts": ["tgcli=tgcli:main"]},
-    install_requires=["requests"],
+    install_requires=[],
 )
@@ -1,15 +1,8 @@
-import logging
-import base64
+# Keep module-level imports minimal: `tgcli "text"` is often called in shell
+# loops, so heavy modules are imported lazily where they are needed.
 import os
-import time
-import traceback
-import argparse
 import sys
 
-from typing import Dict, List
-
-import requests
-
 
 def init(host: str = None, port: int = None):
     """Set configuration for TGCLI Client.
@@ -32,8 +25,14 @@ def send(
     filename: str = "unknown",
     data: bytes = None,
     markdown: bool = False,
-    keyboard_choice: List[str] = [],
+    keyboard_choice: list = [],
     reply_to_id: str = None,
+    tags: list = None,
+    filepath: str = None,
+    spool: bool = True,
+    idempotency_key: str = None,
+    priority: str = "normal",
+    original: bool = False,
 ) -> str:
     """Send to telegram.
 
@@ -57,31 +56,113 @@ def send(
         filename (str, optional): This name will be displayed in telegram.
         data (bytes, optional): File content.
         markdown (bool, optional): Should telegram parse special chars or no
-        keyboard_choice (List[str], optional): Keyboard with this list will be
+        keyboard_choice (list, optional): Keyboard with this list will be
             created in telegram. You can read answer to this message later.
         reply_to_id (str, optional): Message id
+        tags (list, optional): Replies to this message will have these tags,
+            so you can filter them in `get_events`.
+        filepath (str, optional): Read file content from this path instead
+            of `data`. In case of spool, only path will be saved.
+        spool (bool, optional): Save message to local spool if server is
+            unavailable (only with 'TGCLI_SPOOL' enviroment variable).
+            Spooled messages are sent in order on the next call.
+        idempotency_key (str, optional): Server sends only one message per
+            key, repeats get the same message id. Random by default, so
+            retries of this call never produce duplicates.
+        priority (str, optional): "high" for alerts, "normal" or "low" for
+            bulk uploads. Low priority messages are dropped first if server
+            is overloaded.
+        original (bool, optional): Send file untouched as document. Server
+            may shrink and re-encode images otherwise (TGCLI_IMAGE_WORKERS).
+
+    Returns:
+        str: message id or None (also if message was spooled)
+    """
+    request = None
+    spooler = _get_spool() if spool and not keyboard_choice else None
+    try:
+        if filepath is not None:
+            with open(filepath, "rb") as f:
+                data = f.read()
+
+        send_data = {
+            "text": text or "",
+            "filename": filename,
+            "filecontent": bytes(data) if data is not None else "",
+            "markdown": markdown,
+            "keyboard_choice": keyboard_choice,
+            "reply_to_id": reply_to_id or "",
+            "idempotency_key": idempotency_key or _new_idempotency_key(),
+        }
+        if tags:
+            send_data["tags"] = list(tags)
+        if priority != "normal":
+            send_data["priority"] = priority
+        if original:
+            send_data["original"] = True
+
+        request = {"method": "send", "data": send_data}
+
+        # Keep order: spooled messages should be sent first
+        if spooler is not None and not spooler.drain():
+            spooler.append(request, filepath)
+            spooler.drain_in_background()
+            return None
+
+        res = _send(request, retries=TGCLI_SEND_RETRIES)
+        if not res or res["status"] != "ok":
+            return None
+
+        return res["data"]["message_id"]
+
+    except Exception as e:
+        _debug_exc(e)
+        if request is not None and spooler is not None and _is_unavailable(e):
+            spooler.append(request, filepath)
+            spooler.drain_in_background()
+
+    return None
+
+
+def edit(
+    message_id: str,
+    text: str = None,
+    filename: str = "unknown",
+    data: bytes = None,
+    markdown: bool = False,
+    priority: str = "normal",
+    original: bool = False,
+) -> str:
+    """Replace text or file of sent message.
+
+    Args:
+        message_id (str): Message id returned by `send`.
+        text (str, optional): New text or caption in case of file.
+        filename (str, optional): This name will be displayed in telegram.
+        data (bytes, optional): New file content. File type can't be
+            changed from photo/video to document and back.
+        markdown (bool, optional): Should telegram parse special chars or no
+        priority (str, optional): "high", "normal" or "low".
+        original (bool, optional): Send file untouched as document.
 
     Returns:
         str: message id or None
     """
     try:
-        filecontent = (
-            base64.b64encode(bytes(data)).decode("utf-8")
-            if data is not None
-            else ""
-        )
+        edit_data = {
+            "message_id": str(message_id),
+            "text": text or "",
+            "filename": filename,
+            "filecontent": bytes(data) if data is not None else "",
+            "markdown": markdown,
+        }
+        if priority != "normal":
+            edit_data["priority"] = priority
+        if original:
+            edit_data["original"] = True
+
         res = _send(
-            {
-                "method": "send",
-                "data": {
-                    "text": text or "",
-                    "filename": filename,
-                    "filecontent": filecontent,
-                    "markdown": markdown,
-                    "keyboard_choice": keyboard_choice,
-                    "reply_to_id": reply_to_id or "",
-                },
-            }
+            {"method": "edit", "data": edit_data}, retries=TGCLI_SEND_RETRIES
         )
         if not res or res["status"] != "ok":
             return None
@@ -89,16 +170,66 @@ def send(
         return res["data"]["message_id"]
 
     except Exception as e:
-        _debug("%s: %s" % (e, traceback.format_exc()))
+        _debug_exc(e)
 
     return None
 
 
-def get_replies(message_ids: List[str] = []) -> Dict:
+def log_metric(name: str, value: float, step: int = None) -> None:
+    """Log metric value to be plotted in telegram.
+
+    All metrics are rendered into one chart, which is sent once and then
+    updated in place every `TGCLI_METRIC_INTERVAL` seconds (and on exit).
+    Logging only appends value to in-memory buffer, so it can be called
+    inside the inner training loop. Requires numpy and matplotlib.
+
+    Example:
+        for step in range(100000):
+            loss = train_step()
+            tgcli.log_metric("loss", loss, step)
+
+    Args:
+        name (str): Metric name. Every metric has its own plot.
+        value (float): Metric value.
+        step (int, optional): X axis value. Defaults to previous step + 1.
+    """
+    global _metrics_logger
+
+    if _metrics_logger is None:
+        import tgcli_metrics
+
+        _metrics_logger = tgcli_metrics.MetricsLogger(
+            interval=TGCLI_METRIC_INTERVAL
+        )
+
+    _metrics_logger.log(name, value, step)
+
+
+def flush_metrics() -> None:
+    """Render and send logged metrics now."""
+    if _metrics_logger is not None:
+        _metrics_logger.flush()
+
+
+def TelegramHandler(*args, **kwargs):
+    """Create `tgcli_logging.TelegramHandler`, see its arguments.
+
+    Factory instead of the class itself, so `tgcli "text"` doesn't import
+    logging (module `__getattr__` needs python 3.7).
+
+    Example:
+        logging.getLogger().addHandler(tgcli.TelegramHandler(interval=10))
+    """
+    from tgcli_logging import TelegramHandler
+
+    return TelegramHandler(*args, **kwargs)
+
+
+def get_replies(message_ids: list = []) -> dict:
     """Receive replies.
 
     Returns:
-        Dict: messages or None
+        dict: messages or None
     """
     try:
         res = _send(
@@ -110,29 +241,658 @@ def get_replies(message_ids: List[str] = []) -> Dict:
         return res["data"]["replies"]
 
     except Exception as e:
-        _debug("%s: %s" % (e, traceback.format_exc()))
+        _debug_exc(e)
 
     return None
 
 
+def get_events(since: int = 0, tags: list = None, limit: int = 1000) -> dict:
+    """Receive replies as events.
+
+    Unlike `get_replies`, events are not removed on the server, so several
+    clients can read the same replies. Pass returned cursor as `since` to
+    receive only new events.
+
+    Example:
+        cursor = 0
+        while True:
+            res = tgcli.get_events(since=cursor, tags=["job-1"])
+            for event in res["events"]:
+                print(event["reply_to"], event["text"])
+            cursor = res["cursor"]
+            time.sleep(1)
+
+    Args:
+        since (int, optional): Cursor from previous call.
+        tags (list, optional): Only replies to messages with any of tags.
+        limit (int, optional): Max events count.
+
+    Returns:
+        dict: {"events": [...], "cursor": int} or None
+    """
+    try:
+        res = _send(
+            {
+                "method": "get_events",
+                "data": {"since": since, "tags": tags or [], "limit": limit},
+            }
+        )
+        if not res or res["status"] != "ok":
+            return None
+
+        return res["data"]
+
+    except Exception as e:
+        _debug_exc(e)
+
+    return None
+
+
+def download_reply(reply: dict, dirpath: str = ".", filename: str = None):
+    """Save file of document or photo reply to disk.
+
+    File is streamed from server in chunks and appears at the path only
+    when it's complete.
+
+    Example:
+        message_id = tgcli.send(text="Reply with new config")
+        res = tgcli.get_events(since=0)
+        for event in res["events"]:
+            if "file" in event:
+                path = tgcli.download_reply(event, dirpath="configs")
+
+    Args:
+        reply (dict): Reply from `get_replies` or `get_events`.
+        dirpath (str, optional): Directory to save file.
+        filename (str, optional): Name of file instead of original one.
+
+    Returns:
+        str: Path of file or None, reason of failure is logged to "tgcli"
+            logger.
+    """
+    import http.client
+    import shutil
+    import tempfile
+    import urllib.parse
+
+    if not reply.get("file"):
+        return None
+
+    file = reply["file"]
+    name = file.get("file_name") or file.get("file_unique_id")
+    conn = None
+    try:
+        filename = os.path.basename(filename or file["file_name"] or "")
+        path = os.path.join(dirpath, filename or file["file_unique_id"])
+
+        conn = http.client.HTTPConnection(
+            TGCLI_HOST, TGCLI_PORT, timeout=TGCLI_DOWNLOAD_TIMEOUT
+        )
+        conn.request(
+            "GET", "/files/%s" % urllib.parse.quote(file["file_unique_id"])
+        )
+        res = conn.getresponse()
+        if res.status != 200:
+            _error(
+                "Can't download file '%s': %s %s"
+                % (name, res.status, res.read()[:200])
+            )
+            return None
+
+        os.makedirs(dirpath, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=dirpath, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(res, f, 64 * 1024)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+        return path
+
+    except Exception as e:
+        _error("Can't download file '%s': %s" % (name, e))
+        _debug_exc(e)
+    finally:
+        if conn is not None:
+            conn.close()
+
+    return None
+
+
+def history(
+    query: str = "",
+    since: float = 0,
+    until: float = 0,
+    tags: list = None,
+    kind: str = "",
+    limit: int = 100,
+) -> list:
+    """Search history of sent messages and replies, the newest first.
+
+    History is kept by server only if TGCLI_HISTORY is set there.
+
+    Example:
+        # When did job-1 report the last time?
+        last = tgcli.history(tags=["job-1"], kind="sent", limit=1)
+
+        # Everything about OOM for the last week
+        week_ago = time.time() - 7 * 24 * 60 * 60
+        for msg in tgcli.history("OOM", since=week_ago):
+            print(msg["ts"], msg["text"])
+
+    Args:
+        query (str, optional): Words to find in text, caption or filename.
+            Words are matched whole, "OOM*" matches prefix.
+        since (float, optional): Min unix timestamp.
+        until (float, optional): Max unix timestamp.
+        tags (list, optional): Only messages with any of tags.
+        kind (str, optional): "sent", "reply" or "" for both.
+        limit (int, optional): Max messages count.
+
+    Returns:
+        list: messages or None
+    """
+    try:
+        res = _send(
+            {
+                "method": "history",
+                "data": {
+                    "query": query,
+                    "since": since,
+                    "until": until,
+                    "tags": tags or [],
+                    "kind": kind,
+                    "limit": limit,
+                },
+            }
+        )
+        if not res or res["status"] != "ok":
+            return None
+
+        return res["data"]["messages"]
+
+    except Exception as e:
+        _debug_exc(e)
+
+    return None
+
+
+def stats() -> dict:
+    """Latency of requests to server in this process, ms.
+
+    Client phases: "encode" (request serialization), "connect" (new
+    connection to server, reused ones are not counted) and "rtt" (HTTP
+    round trip). Server phases from "Server-Timing" header are prefixed with
+    "server.": "parse", "b64", "queue" (wait for free Telegram worker),
+    "telegram" (Bot API call) and "total". Percentiles are computed over
+    the last 1024 requests.
+
+    Example:
+        >>> tgcli.stats()["rtt"]
+        {'count': 120, 'mean': 3.1, 'p50': 2.8, 'p90': 4.0, 'p99': 9.7,
+         'max': 12.3}
+
+    Returns:
+        dict: phase -> {"count", "mean", "p50", "p90", "p99", "max"}
+    """
+    return {name: h.summary() for name, h in sorted(_histograms.items())}
+
+
+def _format_stats() -> str:
+    columns = ["count", "mean", "p50", "p90", "p99", "max"]
+    lines = ["%-16s %7s" % ("tgcli stats, ms", "count")]
+    lines[0] += "".join(" %9s" % c for c in columns[1:])
+    for name, summary in stats().items():
+        line = "%-16s %7d" % (name, summary["count"])
+        line += "".join(" %9.2f" % summary[c] for c in columns[1:])
+        lines.append(line)
+    return "\n".join(lines)
+
+
+class _Histogram:
+    """Rolling window of the last `size` values.
+
+    Adding is O(1) and cheap enough for every request, percentiles are
+    computed only on `summary`.
+    """
+
+    def __init__(self, size: int = 1024):
+        import array
+        import threading
+
+        self.size = size
+        self.count = 0
+        self.max = 0.0
+        self._values = array.array("d")
+        self._lock = threading.Lock()
+
+    def add(self, value: float):
+        with self._lock:
+            if len(self._values) < self.size:
+                self._values.append(value)
+            else:
+                self._values[self.count % self.size] = value
+            self.count += 1
+            self.max = max(self.max, value)
+
+    def summary(self) -> dict:
+        with self._lock:
+            values = sorted(self._values)
+            count, max_value = self.count, self.max
+
+        def percentile(q):
+            if not values:
+                return 0.0
+            return values[min(len(values) - 1, int(q * len(values)))]
+
+        return {
+            "count": count,
+            "mean": sum(values) / len(values) if values else 0.0,
+            "p50": percentile(0.5),
+            "p90": percentile(0.9),
+            "p99": percentile(0.99),
+            "max": max_value,
+        }
+
+
+def _add_timing(name: str, ms: float):
+    histogram = _histograms.get(name)
+    if histogram is None:
+        histogram = _histograms.setdefault(name, _Histogram())
+    histogram.add(ms)
+
+
+def _add_server_timing(header: str):
+    """Parse "Server-Timing: parse;dur=0.12, telegram;dur=48.10"."""
+    if not header:
+        return
+
+    for metric in header.split(","):
+        name, _, params = metric.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "dur":
+                try:
+                    _add_timing("server." + name, float(value))
+                except ValueError:
+                    pass
+
+
 def _debug(text: str):
     if TGCLI_DEBUG:
+        import logging
+
         logging.getLogger("tgcli").error(text)
 
 
-def _send(data: dict) -> bool:
-    req = requests.post(
-        _get_connection_string(), json=data, timeout=TGCLI_SEND_TIMEOUT
-    )
+def _error(text: str):
+    """Report failure which can't be seen from None result alone."""
+    import logging
+
+    logging.getLogger("tgcli").error(text)
+
+
+def _debug_exc(e: Exception):
+    if TGCLI_DEBUG:
+        import traceback
+
+        _debug("%s: %s" % (e, traceback.format_exc()))
+
+
+class ServerError(Exception):
+    """Server is reachable, but can't process request now."""
 
-    if req.status_code != 200:
+    def __init__(self, status: int):
+        super().__init__("Server error: %s" % status)
+        self.status = status
+
+
+class ConnectError(ConnectionError):
+    """Server is unreachable after all connect retries."""
+
+
+def _is_unavailable(e: Exception) -> bool:
+    import http.client
+
+    return isinstance(e, (OSError, ServerError, http.client.HTTPException))
+
+
+def _get_spool():
+    """Get spool if 'TGCLI_SPOOL' is set, otherwise None."""
+    global _spool
+
+    if not TGCLI_SPOOL:
         return None
 
-    return req.json()
+    if _spool is None:
+        try:
+            import tgcli_spool
+
+            dirpath = TGCLI_SPOOL
+            if dirpath == "1":
+                dirpath = os.path.join(
+                    os.path.expanduser("~"), ".cache", "tgcli"
+                )
+            _spool = tgcli_spool.Spool(dirpath)
+        except Exception as e:
+            _debug_exc(e)
+            return None
+
+    return _spool
+
+
+def drain_spool() -> bool:
+    """Send messages from local spool.
+
+    Returns:
+        bool: True if spool is empty now.
+    """
+    spooler = _get_spool()
+    return spooler is None or spooler.drain()
+
+
+def _new_idempotency_key() -> str:
+    # Not uuid: its import is noticeable in `tgcli "text"` startup
+    return os.urandom(16).hex()
+
+
+def _json_default(obj):
+    if isinstance(obj, (bytes, bytearray)):
+        import base64
+
+        return base64.b64encode(obj).decode("utf-8")
+
+    raise TypeError("%s is not JSON serializable" % type(obj).__name__)
+
+
+def _get_content_type(data: dict) -> str:
+    """Choose codec for request.
+
+    MessagePack carries file content without base64, but it is an optional
+    dependency on both sides. In 'auto' mode it is used only for requests
+    with bytes, so simple text messages don't pay for msgpack import.
+    """
+    global _msgpack_supported
+
+    if TGCLI_CODEC == "json" or not _msgpack_supported:
+        return JSON_CONTENT_TYPE
+
+    if TGCLI_CODEC == "auto" and not any(
+        isinstance(v, (bytes, bytearray)) for v in data["data"].values()
+    ):
+        return JSON_CONTENT_TYPE
+
+    try:
+        import msgpack  # noqa: F401
+    except ImportError:
+        _msgpack_supported = False
+        return JSON_CONTENT_TYPE
+
+    return MSGPACK_CONTENT_TYPE
+
+
+def _encode(data: dict, content_type: str) -> bytes:
+    if content_type == MSGPACK_CONTENT_TYPE:
+        import msgpack
+
+        return msgpack.packb(data, use_bin_type=True)
+
+    import json
+
+    return json.dumps(data, default=_json_default).encode("utf-8")
+
+
+def _decode(body: bytes, content_type: str) -> dict:
+    if content_type == MSGPACK_CONTENT_TYPE:
+        import msgpack
+
+        return msgpack.unpackb(body, raw=False)
+
+    import json
+
+    return json.loads(body)
+
+
+def _read_timeout() -> float:
+    # TGCLI_SEND_TIMEOUT is the old name of read timeout
+    return TGCLI_READ_TIMEOUT or TGCLI_SEND_TIMEOUT
+
+
+class _ConnectionPool:
+    """Keep-alive connections to server, shared by threads of process.
+
+    Only connect is retried here: request didn't reach server yet, so it
+    is safe for any method. Idle connections are dropped before server
+    closes them (uvicorn does it after 5 seconds).
+
+    Args:
+        host (str): Server host.
+        port (int): Server port.
+    """
+
+    IDLE_TIMEOUT = 4.0
+
+    def __init__(self, host: str, port: int):
+        import threading
+
+        self.host = host
+        self.port = port
+        # Child process after fork creates its own pool, see `_get_pool`
+        self.pid = os.getpid()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        import http.client
+        import random
+        import time
+
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            conn = http.client.HTTPConnection(
+                self.host, self.port, timeout=TGCLI_CONNECT_TIMEOUT
+            )
+            try:
+                conn.connect()
+                break
+            except OSError as e:
+                conn.close()
+                if attempt >= TGCLI_CONNECT_RETRIES:
+                    raise ConnectError(
+                        "Can't connect to %s:%s: %s"
+                        % (self.host, self.port, e)
+                    ) from e
+
+                delay = TGCLI_CONNECT_BACKOFF * 2**attempt
+                delay *= random.uniform(0.5, 1.5)
+                _debug("Can't connect (%s), retry in %.2fs" % (e, delay))
+                time.sleep(delay)
+                attempt += 1
+
+        _add_timing("connect", (time.perf_counter() - started) * 1000)
+        return conn
+
+    def get(self):
+        """Connection and whether it was used before."""
+        import time
+
+        now = time.monotonic()
+        conn = None
+        with self._lock:
+            while self._idle and conn is None:
+                conn, released = self._idle.pop()
+                if now - released >= self.IDLE_TIMEOUT:
+                    conn.close()
+                    conn = None
+
+        reused = conn is not None
+        if not reused:
+            conn = self._connect()
+        conn.sock.settimeout(_read_timeout())
+        return conn, reused
+
+    def put(self, conn, res):
+        """Return connection after its response was read."""
+        import time
+
+        if not res.will_close and conn.sock is not None:
+            with self._lock:
+                if len(self._idle) < TGCLI_POOL_SIZE:
+                    self._idle.append((conn, time.monotonic()))
+                    return
+        conn.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            conn.close()
+
+
+def _get_pool() -> _ConnectionPool:
+    global _pool
+
+    pool = _pool
+    if (
+        pool is None
+        or pool.pid != os.getpid()
+        or (pool.host, pool.port) != (TGCLI_HOST, TGCLI_PORT)
+    ):
+        # Sockets of parent process are never shared with forked child
+        pool = _pool = _ConnectionPool(TGCLI_HOST, TGCLI_PORT)
+    return pool
+
+
+def _post(body: bytes, content_type: str, repeatable: bool = False):
+    """Post request with keep-alive connection.
+
+    Request on reused connection is sent again on a new one if server
+    closed it without any response. Other connection errors are repeated
+    only for `repeatable` requests: server may have processed it already.
+    """
+    import http.client
+
+    pool = _get_pool()
+    while True:
+        conn, reused = pool.get()
+        try:
+            conn.request(
+                "POST",
+                "/",
+                body=body,
+                headers={
+                    "Content-Type": content_type,
+                    "Accept": content_type,
+                    "X-TGCLI-Timeout": str(_read_timeout()),
+                },
+            )
+            res = conn.getresponse()
+            res_body = res.read()
+        except ConnectionError as e:
+            conn.close()
+            if not reused or not (
+                repeatable or isinstance(e, http.client.RemoteDisconnected)
+            ):
+                raise
+            # Server closed idle connection before it got the request,
+            # the others are likely closed too
+            pool.clear()
+            continue
+        except BaseException:
+            conn.close()
+            raise
+
+        pool.put(conn, res)
+        return res, res_body
+
+
+def _busy_delay(res, attempt: int) -> float:
+    """Jittered exponential backoff, not less than server's Retry-After."""
+    import random
+
+    try:
+        retry_after = float(res.getheader("Retry-After"))
+    except (TypeError, ValueError):
+        retry_after = 1.0
+
+    delay = min(max(retry_after, 0.5 * 2**attempt), 30.0)
+    return delay * random.uniform(1.0, 1.5)
+
+
+def _send(data: dict, retries: int = 0) -> dict:
+    """Send request to server.
+
+    Args:
+        data (dict): Request without API version.
+        retries (int, optional): Repeat request on timeout or dropped
+            connection. Only for requests which are safe to repeat
+            (ex. with idempotency key).
+    """
+    import socket
+    import time
+    import http.client
+
+    global _msgpack_supported
 
+    data = dict(data, v=TGCLI_API_VERSION)
+    content_type = _get_content_type(data)
 
-def _get_connection_string():
-    return "http://%s:%s" % (TGCLI_HOST, TGCLI_PORT)
+    started = time.perf_counter()
+    body = _encode(data, content_type)
+    _add_timing("encode", (time.perf_counter() - started) * 1000)
+
+    busy_deadline = None
+    attempt = 0
+    while True:
+        try:
+            started = time.perf_counter()
+            res, res_body = _post(
+                body, content_type, data["method"] in REPEATABLE_METHODS
+            )
+            _add_timing("rtt", (time.perf_counter() - started) * 1000)
+            _add_server_timing(res.getheader("Server-Timing"))
+        except (
+            socket.timeout,
+            ConnectionResetError,
+            http.client.RemoteDisconnected,
+        ) as e:
+            if retries <= 0:
+                raise
+            # Server may be still processing the first attempt, repeat
+            # with the same idempotency key will wait for its result
+            _debug("Retry after %s" % (e or type(e).__name__))
+            retries -= 1
+            continue
+
+        if res.status not in (429, 503):
+            break
+
+        # Server is overloaded: wait instead of dropping message
+        if busy_deadline is None:
+            busy_deadline = time.time() + TGCLI_BUSY_TIMEOUT
+        delay = _busy_delay(res, attempt)
+        if time.time() + delay > busy_deadline:
+            raise ServerError(res.status)
+
+        _debug("Server is busy, retry in %.1fs" % delay)
+        time.sleep(delay)
+        attempt += 1
+
+    if res.status == 415 and content_type == MSGPACK_CONTENT_TYPE:
+        # Server without msgpack support, fallback to JSON for this process
+        _msgpack_supported = False
+        return _send(data, retries=retries)
+
+    if res.status >= 500:
+        raise ServerError(res.status)
+
+    if res.status != 200:
+        return None
+
+    return _decode(res_body, content_type)
 
 
 def _default_init():
@@ -144,17 +904,116 @@ def _default_init():
     global TGCLI_DEBUG
     TGCLI_DEBUG = bool(os.environ.get("TGCLI_DEBUG", TGCLI_DEBUG))
 
+    global TGCLI_CODEC
+    TGCLI_CODEC = os.environ.get("TGCLI_CODEC", TGCLI_CODEC)
+
+    global TGCLI_BUSY_TIMEOUT
+    TGCLI_BUSY_TIMEOUT = float(
+        os.environ.get("TGCLI_BUSY_TIMEOUT", TGCLI_BUSY_TIMEOUT)
+    )
+
+    global TGCLI_DOWNLOAD_TIMEOUT
+    TGCLI_DOWNLOAD_TIMEOUT = float(
+        os.environ.get("TGCLI_DOWNLOAD_TIMEOUT", TGCLI_DOWNLOAD_TIMEOUT)
+    )
+
+    global TGCLI_SEND_RETRIES
+    TGCLI_SEND_RETRIES = int(
+        os.environ.get("TGCLI_SEND_RETRIES", TGCLI_SEND_RETRIES)
+    )
+
+    global TGCLI_SEND_TIMEOUT
+    TGCLI_SEND_TIMEOUT = float(
+        os.environ.get("TGCLI_SEND_TIMEOUT", TGCLI_SEND_TIMEOUT)
+    )
+
+    global TGCLI_CONNECT_TIMEOUT
+    TGCLI_CONNECT_TIMEOUT = float(
+        os.environ.get("TGCLI_CONNECT_TIMEOUT", TGCLI_CONNECT_TIMEOUT)
+    )
+
+    global TGCLI_READ_TIMEOUT
+    TGCLI_READ_TIMEOUT = float(
+        os.environ.get("TGCLI_READ_TIMEOUT", TGCLI_READ_TIMEOUT)
+    )
+
+    global TGCLI_CONNECT_RETRIES
+    TGCLI_CONNECT_RETRIES = int(
+        os.environ.get("TGCLI_CONNECT_RETRIES", TGCLI_CONNECT_RETRIES)
+    )
+
+    global TGCLI_POOL_SIZE
+    TGCLI_POOL_SIZE = int(os.environ.get("TGCLI_POOL_SIZE", TGCLI_POOL_SIZE))
+
+    global TGCLI_SPOOL
+    TGCLI_SPOOL = os.environ.get("TGCLI_SPOOL", TGCLI_SPOOL)
+
+    global TGCLI_METRIC_INTERVAL
+    TGCLI_METRIC_INTERVAL = float(
+        os.environ.get("TGCLI_METRIC_INTERVAL", TGCLI_METRIC_INTERVAL)
+    )
+
 
 TGCLI_PORT = 4444
 TGCLI_HOST = "127.0.0.1"
 
-TGCLI_SEND_TIMEOUT = 1
+# Socket timeouts of requests to server, seconds. Server answers within
+# read timeout: it is sent in "X-TGCLI-Timeout" header. 0 - use
+# TGCLI_SEND_TIMEOUT, the old name of read timeout.
+TGCLI_CONNECT_TIMEOUT = 1.0
+TGCLI_READ_TIMEOUT = 0.0
+TGCLI_SEND_TIMEOUT = 1.0
 TGCLI_DEBUG = False
 
+# Retries of refused or timed out connect with jittered exponential backoff
+# from TGCLI_CONNECT_BACKOFF seconds. Safe for any request. When server is
+# down, 2 retries add ~150 ms to every call, so `tgcli "text"` doesn't
+# retry unless it is set in environment.
+TGCLI_CONNECT_RETRIES = 2
+TGCLI_CONNECT_BACKOFF = 0.05
+
+# Max idle keep-alive connections to server, 0 - connection per request
+TGCLI_POOL_SIZE = 8
+
+# Retries of `send`/`edit` on timeout, safe because of idempotency keys
+TGCLI_SEND_RETRIES = 2
+
+# Max time to wait for busy server (429/503) before giving up, seconds
+TGCLI_BUSY_TIMEOUT = 60.0
+
+# Socket timeout of `download_reply`: server downloads file from Telegram
+# before the first byte
+TGCLI_DOWNLOAD_TIMEOUT = 60.0
+
+# "auto" - msgpack for requests with files if it is installed, "json", "msgpack"
+TGCLI_CODEC = "auto"
+TGCLI_API_VERSION = 1
+
+TGCLI_METRIC_INTERVAL = 60.0
+
+# "" - disabled, "1" - ~/.cache/tgcli, or path to spool directory
+TGCLI_SPOOL = ""
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+# Safe to send again after connection error: sends have idempotency keys,
+# the others don't change state. `get_replies` consumes replies.
+REPEATABLE_METHODS = ["send", "send_batch", "edit", "get_events", "history"]
+
+_msgpack_supported = True
+_metrics_logger = None
+_spool = None
+_pool = None
+# Timing name -> _Histogram, see `stats`
+_histograms = {}
+
 _default_init()
 
 
 def _parse_args():
+    import argparse
+
     description_str = """
 CLI for telegram server. You can send file or message.
 
@@ -180,6 +1039,10 @@ Examples:
     $ should_run=$(tgcli "Run another one script?" -c "yes;no")
     $ echo $should_run
 
+* Get file from telegram (reply with document or photo):
+    $ config=$(tgcli "Send new config" -r --save-to ./configs)
+    $ python train.py --config $config
+
 To find more details and examples: https://github.com/rkorv/tgcli
 """
 
@@ -218,6 +1081,13 @@ filename will be taken as basename of filepath.""",
         action="store_true",
         help="Wait 1 reply message",
     )
+    parser.add_argument(
+        "--save-to",
+        type=str,
+        default=None,
+        help="""Wait 1 reply and save its file (document or photo) to
+directory. Path of file is printed instead of text.""",
+    )
     parser.add_argument(
         "--choice",
         "-c",
@@ -225,11 +1095,42 @@ filename will be taken as basename of filepath.""",
         default=None,
         help='Wait 1 reply message from list. Example: -c "yes;no"',
     )
+    parser.add_argument(
+        "--drain",
+        action="store_true",
+        help="Send messages from local spool (see TGCLI_SPOOL) and exit",
+    )
+    parser.add_argument(
+        "--tags",
+        type=str,
+        default=None,
+        help='Tags to filter replies in get_events. Example: --tags "a;b"',
+    )
+    parser.add_argument(
+        "--priority",
+        "-p",
+        type=str,
+        default="normal",
+        choices=["high", "normal", "low"],
+        help="Alerts with 'high' are sent before queued uploads",
+    )
+    parser.add_argument(
+        "--original",
+        action="store_true",
+        help="Send file untouched as document, images are not shrunk",
+    )
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Print latency of client and server phases to stderr on exit",
+    )
 
     return parser.parse_args()
 
 
-def _wait_replies(message_ids: str) -> None:
+def _wait_replies(message_ids: list) -> dict:
+    import time
+
     while True:
         res = get_replies(message_ids)
         if res is None:
@@ -259,32 +1160,52 @@ def _run_from_stdin() -> None:
 
 def _run_from_args() -> None:
     args = _parse_args()
+    if args.stats:
+        import atexit
+
+        atexit.register(lambda: print(_format_stats(), file=sys.stderr))
+
+    if args.drain:
+        sys.exit(0 if drain_spool() else 1)
+
+    if args.stats and not args.filepath and not args.text:
+        # `cmd | tgcli --stats`
+        return
+
     if not args.filepath and not args.text:
         print("--filename/-f or text required!")
         sys.exit(1)
 
-    send_args = {"text": args.text or ""}
+    send_args = {"text": args.text or "", "priority": args.priority}
 
     if args.filepath:
         if not os.path.isfile(args.filepath):
             print("File '%s' doesn't exist!" % args.filepath)
             sys.exit(1)
 
-        send_args["data"] = open(args.filepath, "rb").read()
+        send_args["filepath"] = args.filepath
         send_args["filename"] = args.filename or args.filepath
+        send_args["original"] = args.original
 
     if args.choice:
         send_args["keyboard_choice"] = args.choice.split(";")
 
-    if args.wait_reply or args.choice:
+    if args.tags:
+        send_args["tags"] = args.tags.split(";")
+
+    wait_reply = args.wait_reply or args.choice or args.save_to
+    if wait_reply:
         send_args["text"] = (
-            "*❓ REPLY TO THIS MESSAGE: *\n---\n```\n%s\n```" % send_args["text"]
+            "*❓ REPLY TO THIS MESSAGE: *\n---\n```\n%s\n```"
+            % send_args["text"]
         )
         send_args["markdown"] = True
+        # Question is useless if nobody waits for the answer
+        send_args["spool"] = False
 
     message_id = send(**send_args)
 
-    if args.wait_reply or args.choice:
+    if wait_reply:
         if message_id is None:
             print("[ERROR] Got error while sending")
             sys.exit(1)
@@ -294,11 +1215,46 @@ def _run_from_args() -> None:
             print("[ERROR] Got error while receiving answer")
             sys.exit(1)
 
-        print(answer[message_id][0]["text"])
+        reply = answer[message_id][0]
+        if not args.save_to:
+            print(reply["text"])
+        elif not reply.get("file"):
+            print("[ERROR] Reply has no file: '%s'" % reply["text"])
+            sys.exit(1)
+        else:
+            path = download_reply(reply, args.save_to)
+            if path is None:
+                print("[ERROR] Got error while downloading file")
+                sys.exit(1)
+            print(path)
+
+
+def _run_fast_path() -> bool:
+    """`tgcli "text"` without argparse. Returns False for other commands."""
+    if len(sys.argv) != 2 or not sys.argv[1] or sys.argv[1].startswith("-"):
+        return False
+
+    # One-shot message: down server shouldn't cost ~150 ms of retries
+    if "TGCLI_CONNECT_RETRIES" not in os.environ:
+        global TGCLI_CONNECT_RETRIES
+        TGCLI_CONNECT_RETRIES = 0
+
+    send(text=sys.argv[1])
+    return True
 
 
 def main():
-    if len(sys.argv) > 1:
+    if len(sys.argv) >= 2 and sys.argv[1] == "run":
+        import tgcli_run
+
+        sys.exit(tgcli_run.main(sys.argv[2:]))
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "history":
+        import tgcli_history_cli
+
+        sys.exit(tgcli_history_cli.main(sys.argv[2:]))
+
+    if len(sys.argv) > 1 and not _run_fast_path():
         _run_from_args()
 
     _run_from_stdin()
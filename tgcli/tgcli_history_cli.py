@@ -0,0 +1,137 @@
+import argparse
+import datetime
+import json
+import shutil
+import time
+
+import tgcli
+import tgcli_run
+
+TIME_FORMATS = [
+    "%Y-%m-%d",
+    "%Y-%m-%d %H:%M",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M",
+    "%Y-%m-%dT%H:%M:%S",
+]
+
+
+def parse_time(value: str) -> float:
+    """Parse '7d', '12h' (ago) or '2021-10-18', '2021-10-18 12:00' to ts."""
+    try:
+        return time.time() - tgcli_run.parse_interval(value)
+    except argparse.ArgumentTypeError:
+        pass
+
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(value.strip(), fmt).timestamp()
+        except ValueError:
+            pass
+
+    raise argparse.ArgumentTypeError("Can't parse time '%s'" % value)
+
+
+def format_message(msg: dict, width: int) -> str:
+    line = "%s  %-5s  #%-6s " % (
+        datetime.datetime.fromtimestamp(msg["ts"]).strftime(
+            "%Y-%m-%d %H:%M:%S"
+        ),
+        msg["kind"],
+        msg["message_id"],
+    )
+    if msg["reply_to"]:
+        line += "↩%s " % msg["reply_to"]
+    if msg["tags"]:
+        line += "[%s] " % ";".join(msg["tags"])
+    if msg["filename"]:
+        line += "📎%s " % msg["filename"]
+
+    text = " ".join(msg["text"].split())
+    line += text
+    if len(line) > width:
+        line = line[: width - 3] + "..."
+    return line
+
+
+def main(argv: list = None) -> int:
+    description_str = """
+Search history of sent messages and replies kept by server
+(enabled on server by TGCLI_HISTORY). The newest messages go first.
+Words of query are matched whole in text, caption and filename,
+"OOM*" matches prefix.
+
+Examples:
+    $ tgcli history search "OOM*" --since 7d
+    $ tgcli history search --tags job-1 --kind sent --limit 1
+    $ tgcli history search "checkpoint" --since 2021-10-01 --json
+
+"""
+    parser = argparse.ArgumentParser(
+        prog="tgcli history",
+        description=description_str,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    # `required` argument of add_subparsers needs python 3.7
+    subparsers = parser.add_subparsers(dest="command")
+
+    search = subparsers.add_parser("search", help="Find messages")
+    search.add_argument("query", nargs="?", default="", help="Words to find")
+    search.add_argument(
+        "--since",
+        type=parse_time,
+        default=0,
+        help="Interval ago or date. Example: 7d, 12h, 2021-10-01",
+    )
+    search.add_argument(
+        "--until",
+        type=parse_time,
+        default=0,
+        help="Interval ago or date",
+    )
+    search.add_argument(
+        "--tags",
+        type=str,
+        default=None,
+        help='Messages with any of tags. Example: --tags "a;b"',
+    )
+    search.add_argument(
+        "--kind",
+        type=str,
+        default="",
+        choices=["sent", "reply"],
+        help="Only sent messages or only replies",
+    )
+    search.add_argument(
+        "--limit", type=int, default=50, help="Max messages count"
+    )
+    search.add_argument(
+        "--json", action="store_true", help="Print one JSON per line"
+    )
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("the following arguments are required: command")
+
+    messages = tgcli.history(
+        query=args.query,
+        since=args.since,
+        until=args.until,
+        tags=args.tags.split(";") if args.tags else None,
+        kind=args.kind,
+        limit=args.limit,
+    )
+    if messages is None:
+        print(
+            "[ERROR] Can't search history. Is server running with "
+            "TGCLI_HISTORY?"
+        )
+        return 1
+
+    width = shutil.get_terminal_size((120, 20)).columns
+    for msg in messages:
+        if args.json:
+            print(json.dumps(msg, ensure_ascii=False))
+        else:
+            print(format_message(msg, width))
+    return 0
@@ -0,0 +1,308 @@
+import collections
+import hashlib
+import logging
+import socket
+import threading
+import time
+import traceback
+
+import tgcli
+
+# Telegram message limit is 4096 chars
+MAX_MESSAGE_LEN = 4000
+
+
+class _Group:
+    """Records with the same fingerprint."""
+
+    def __init__(self, fingerprint: str, summary: str):
+        self.fingerprint = fingerprint
+        self.summary = summary
+        self.detail = None
+        self.last_reported = None
+        self.pending = 0
+        # (digest ts, count) for counts over sliding window
+        self.buckets = collections.deque()
+
+    def add(self, count: int, now: float):
+        self.pending += count
+        if self.buckets and self.buckets[-1][0] == now:
+            count += self.buckets.pop()[1]
+        self.buckets.append((now, count))
+
+    def count_since(self, since: float) -> int:
+        while self.buckets and self.buckets[0][0] < since:
+            self.buckets.popleft()
+        return sum(count for _, count in self.buckets)
+
+
+class TelegramHandler(logging.Handler):
+    """Send log records to telegram as digests.
+
+    `emit` appends fingerprint and summary of record to a bounded deque,
+    so logging call never waits for network, and queued records don't keep
+    traceback frames alive. Background thread sends one digest every
+    `interval` seconds. Records are grouped by fingerprint: exception type
+    with traceback frames (files, functions and lines), or logger, level
+    and message template for records without exception. Only the first
+    record of a group is formatted with traceback, repeats within `window`
+    are collapsed into "×1,234 in last 5 min" counters.
+
+    Records of tgcli own loggers are ignored to avoid loops.
+
+    Example:
+        import logging
+        import tgcli
+
+        logging.getLogger().addHandler(tgcli.TelegramHandler())
+
+    Args:
+        level (int, optional): Min level of records.
+        interval (float, optional): Digest interval in seconds.
+        window (float, optional): Repeats are counted in this window, and
+            group traceback is sent again after it.
+        max_per_hour (int, optional): Max digest messages per hour. Over
+            the limit records are counted and sent with the next digest.
+        max_queue (int, optional): Max records waiting for digest, the
+            oldest are dropped over it.
+        max_details (int, optional): Max tracebacks in one digest.
+        tags (list, optional): Tags of digest messages.
+        priority (str, optional): Priority of digest messages.
+    """
+
+    def __init__(
+        self,
+        level: int = logging.ERROR,
+        interval: float = 10.0,
+        window: float = 300.0,
+        max_per_hour: int = 60,
+        max_queue: int = 10000,
+        max_details: int = 5,
+        tags: list = None,
+        priority: str = "high",
+    ):
+        super().__init__(level)
+        self.setFormatter(
+            logging.Formatter("%(levelname)s [%(name)s] %(message)s")
+        )
+
+        self.interval = interval
+        self.window = window
+        self.max_per_hour = max_per_hour
+        self.max_details = max_details
+        self.tags = tags
+        self.priority = priority
+
+        self._queue = collections.deque(maxlen=max_queue)
+        # fingerprint -> time its record was formatted with traceback
+        self._formatted = {}
+        # fingerprint -> (summary, traceback) waiting for digest, apart from
+        # the queue, so they are not dropped with it
+        self._details = {}
+        self._dropped = 0
+        self._groups = collections.OrderedDict()
+        self._sent = collections.deque()
+        self._flush_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="tgcli_logging", daemon=True
+        )
+        self._thread.start()
+
+    def emit(self, record: logging.LogRecord):
+        if record.name == "tgcli" or record.name.startswith("tgcli."):
+            return
+
+        # Like QueueHandler.prepare: args and exc_info may change or keep
+        # big objects alive until the digest. Repeats aren't formatted, it's
+        # the most expensive part.
+        try:
+            fingerprint = self.fingerprint(record)
+            summary = self._summary(record)
+            now = time.time()
+            formatted = self._formatted.get(fingerprint)
+            if formatted is None or now - formatted > self.window:
+                self._formatted[fingerprint] = now
+                self._details[fingerprint] = (summary, self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+
+        # Approximate: deque drops the oldest record itself
+        if len(self._queue) == self._queue.maxlen:
+            self._dropped += 1
+        self._queue.append((fingerprint, summary))
+
+    @staticmethod
+    def fingerprint(record: logging.LogRecord) -> str:
+        if record.exc_info and record.exc_info[0] is not None:
+            exc_type, _, tb = record.exc_info
+            # Without linecache, unlike traceback.extract_tb
+            frames = [
+                (f.f_code.co_filename, f.f_code.co_name, lineno)
+                for f, lineno in traceback.walk_tb(tb)
+            ]
+            key = "%s.%s %s" % (
+                exc_type.__module__,
+                exc_type.__qualname__,
+                frames,
+            )
+        else:
+            key = "%s %s %s %s:%s" % (
+                record.name,
+                record.levelno,
+                record.msg,
+                record.pathname,
+                record.lineno,
+            )
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:8]
+
+    def _summary(self, record: logging.LogRecord) -> str:
+        if record.exc_info and record.exc_info[0] is not None:
+            exc_type, exc, _ = record.exc_info
+            text = "%s: %s" % (exc_type.__name__, exc)
+        else:
+            text = "%s [%s] %s" % (
+                record.levelname,
+                record.name,
+                record.getMessage(),
+            )
+        text = text.strip().split("\n")[0]
+        return text if len(text) <= 200 else text[:197] + "..."
+
+    def _group(self, fingerprint: str, summary: str) -> _Group:
+        group = self._groups.get(fingerprint)
+        if group is None:
+            group = _Group(fingerprint, summary)
+            self._groups[fingerprint] = group
+        return group
+
+    def _collect(self, now: float):
+        self.acquire()
+        try:
+            details, self._details = self._details, {}
+        finally:
+            self.release()
+
+        # emit formats one record of group per window
+        for fingerprint, (summary, detail) in details.items():
+            group = self._group(fingerprint, summary)
+            if group.detail is None:
+                group.detail = detail
+
+        while True:
+            try:
+                fingerprint, summary = self._queue.popleft()
+            except IndexError:
+                break
+
+            self._group(fingerprint, summary).add(1, now)
+
+    def _digest(self, now: float):
+        """Returns digest text and groups sent with traceback."""
+        groups = [g for g in self._groups.values() if g.pending]
+        total = sum(g.pending for g in groups)
+
+        lines = [
+            "🚨 %s log records on %s"
+            % (format(total, ","), socket.gethostname())
+        ]
+        if self._dropped:
+            lines[0] += " (%s dropped)" % format(self._dropped, ",")
+
+        details = [g for g in groups if g.detail is not None]
+        details = details[: self.max_details]
+        for group in details:
+            count = group.count_since(now - self.window)
+            text = group.detail
+            if len(text) > 1500:
+                text = "..." + text[-1500:]
+            lines.append("---\n[%s] %s" % (group.fingerprint, text))
+            if count > 1:
+                lines.append(self._counter(count))
+
+        counters = [g for g in groups if g not in details]
+        if counters:
+            lines.append("---")
+        for group in counters:
+            lines.append(
+                "[%s] %s %s"
+                % (
+                    group.fingerprint,
+                    group.summary,
+                    self._counter(group.count_since(now - self.window)),
+                )
+            )
+
+        text = "\n".join(lines)
+        if len(text) > MAX_MESSAGE_LEN:
+            text = text[: MAX_MESSAGE_LEN - 3] + "..."
+        return text, details
+
+    def _counter(self, count: int) -> str:
+        minutes = self.window / 60.0
+        return "×%s in last %s" % (
+            format(count, ","),
+            "%g min" % minutes if minutes >= 1 else "%g s" % self.window,
+        )
+
+    def _can_send(self, now: float) -> bool:
+        while self._sent and self._sent[0] < now - 3600:
+            self._sent.popleft()
+        return len(self._sent) < self.max_per_hour
+
+    def _forget_old(self, now: float):
+        for fingerprint in list(self._groups):
+            group = self._groups[fingerprint]
+            if group.pending or group.count_since(now - self.window):
+                continue
+            if group.last_reported and now - group.last_reported < self.window:
+                continue
+            del self._groups[fingerprint]
+
+        self.acquire()
+        try:
+            for fingerprint, formatted in list(self._formatted.items()):
+                if now - formatted > self.window:
+                    del self._formatted[fingerprint]
+        finally:
+            self.release()
+
+    def flush(self):
+        """Send digest of collected records now, if rate limit allows."""
+        with self._flush_lock:
+            now = time.time()
+            self._collect(now)
+
+            if not any(g.pending for g in self._groups.values()):
+                self._forget_old(now)
+                return
+            if not self._can_send(now):
+                return
+
+            text, details = self._digest(now)
+            self._sent.append(now)
+            self._dropped = 0
+            for group in self._groups.values():
+                group.pending = 0
+            for group in details:
+                group.detail = None
+                group.last_reported = now
+            self._forget_old(now)
+
+        tgcli.send(text=text, tags=self.tags, priority=self.priority)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                tgcli._debug_exc(e)
+
+    def close(self):
+        self._stop.set()
+        try:
+            self.flush()
+        finally:
+            super().close()
@@ -0,0 +1,243 @@
+import array
+import atexit
+import io
+import math
+import threading
+import time
+
+import tgcli
+
+
+class Series:
+    """Metric values downsampled on the fly into a bounded number of buckets.
+
+    Every bucket keeps sum of steps, min, sum and max of values and count
+    of points in compact arrays of doubles. Each bucket takes `stride`
+    points. When `capacity` buckets are filled, neighbour buckets are
+    merged in pairs and stride is doubled, so memory and snapshot cost
+    don't grow with run length.
+
+    Args:
+        capacity (int): Max buckets count, should be even.
+    """
+
+    __slots__ = (
+        "capacity",
+        "stride",
+        "step_sums",
+        "mins",
+        "sums",
+        "maxs",
+        "counts",
+        "last_step",
+        "last_value",
+    )
+
+    def __init__(self, capacity: int = 2000):
+        self.capacity = capacity
+        self.stride = 1
+        self.step_sums = array.array("d")
+        self.mins = array.array("d")
+        self.sums = array.array("d")
+        self.maxs = array.array("d")
+        self.counts = array.array("d")
+        self.last_step = None
+        self.last_value = None
+
+    def append(self, step: float, value: float):
+        self.last_step = step
+        self.last_value = value
+
+        if self.counts and self.counts[-1] < self.stride:
+            self.step_sums[-1] += step
+            self.sums[-1] += value
+            self.counts[-1] += 1
+            if value < self.mins[-1]:
+                self.mins[-1] = value
+            if value > self.maxs[-1]:
+                self.maxs[-1] = value
+            return
+
+        if len(self.counts) >= self.capacity:
+            self._compact()
+
+        self.step_sums.append(step)
+        self.mins.append(value)
+        self.sums.append(value)
+        self.maxs.append(value)
+        self.counts.append(1)
+
+    def _compact(self):
+        n = len(self.counts) // 2 * 2
+        for name, merge in (
+            ("step_sums", lambda a, b: a + b),
+            ("mins", min),
+            ("sums", lambda a, b: a + b),
+            ("maxs", max),
+            ("counts", lambda a, b: a + b),
+        ):
+            old = getattr(self, name)
+            new = array.array(
+                "d", [merge(old[i], old[i + 1]) for i in range(0, n, 2)]
+            )
+            new.extend(old[n:])
+            setattr(self, name, new)
+        self.stride *= 2
+
+
+def downsample(step_sums, mins, sums, maxs, counts, buckets: int):
+    """Reduce series buckets to `buckets` points with min/mean/max.
+
+    Args:
+        step_sums (np.ndarray): Sum of X values per bucket.
+        mins (np.ndarray): Min of Y values per bucket.
+        sums (np.ndarray): Sum of Y values per bucket.
+        maxs (np.ndarray): Max of Y values per bucket.
+        counts (np.ndarray): Points count per bucket.
+        buckets (int): Max points count.
+
+    Returns:
+        Tuple[np.ndarray, ...]: steps, min, mean, max
+    """
+    import numpy as np
+
+    n = len(counts)
+    if n > buckets:
+        starts = np.linspace(0, n, buckets + 1).astype(np.int64)[:-1]
+
+        mins = np.minimum.reduceat(mins, starts)
+        maxs = np.maximum.reduceat(maxs, starts)
+        sums = np.add.reduceat(sums, starts)
+        step_sums = np.add.reduceat(step_sums, starts)
+        counts = np.add.reduceat(counts, starts)
+
+    return step_sums / counts, mins, sums / counts, maxs
+
+
+class MetricsLogger:
+    """Buffer metrics and keep one chart message up to date.
+
+    `log` only adds value to bounded series buckets under a lock, so memory
+    and render cost don't grow with run length. Background thread renders
+    all series into one image every `interval` seconds, if anything was
+    logged, and edits the message sent on first render.
+
+    Args:
+        interval (float): Render interval in seconds.
+        buckets (int): Max points per series on chart.
+        title (str): Chart message caption.
+    """
+
+    def __init__(
+        self,
+        interval: float = 60.0,
+        buckets: int = 500,
+        title: str = "Metrics",
+    ):
+        self.interval = interval
+        self.buckets = buckets
+        self.title = title
+
+        self._series = {}
+        self._capacity = buckets * 4
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._dirty = False
+        self._message_id = None
+
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="tgcli_metrics", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, name: str, value: float, step: int = None):
+        with self._lock:
+            series = self._series.get(name)
+            if series is None:
+                series = self._series[name] = Series(self._capacity)
+
+            if step is None:
+                step = 0 if series.last_step is None else series.last_step + 1
+
+            series.append(step, value)
+            self._dirty = True
+
+    def _snapshot(self):
+        import numpy as np
+
+        with self._lock:
+            self._dirty = False
+            return {
+                name: (
+                    (s.last_step, s.last_value),
+                    [
+                        np.array(a)
+                        for a in (s.step_sums, s.mins, s.sums, s.maxs, s.counts)
+                    ],
+                )
+                for name, s in self._series.items()
+            }
+
+    def render(self) -> bytes:
+        """Render all series to PNG."""
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        snapshot = self._snapshot()
+
+        cols = min(len(snapshot), 2) or 1
+        rows = max(int(math.ceil(len(snapshot) / cols)), 1)
+        fig = Figure(figsize=(6 * cols, 3.5 * rows), dpi=100)
+        FigureCanvasAgg(fig)
+
+        for i, (name, (last, buckets)) in enumerate(sorted(snapshot.items())):
+            x, mins, means, maxs = downsample(*buckets, self.buckets)
+
+            ax = fig.add_subplot(rows, cols, i + 1)
+            ax.fill_between(x, mins, maxs, alpha=0.3, linewidth=0)
+            ax.plot(x, means, linewidth=1, marker="." if len(x) < 50 else None)
+            ax.set_title("%s: %.6g (step %d)" % (name, last[1], last[0]))
+            ax.grid(alpha=0.3)
+
+        fig.tight_layout()
+
+        buf = io.BytesIO()
+        fig.savefig(buf, format="png")
+        return buf.getvalue()
+
+    def flush(self):
+        """Render and send chart, if anything was logged after last flush."""
+        with self._flush_lock:
+            if not self._dirty:
+                return
+
+            try:
+                png = self.render()
+            except Exception as e:
+                tgcli._debug_exc(e)
+                return
+
+            caption = "%s (%s)" % (self.title, time.strftime("%H:%M:%S"))
+            if self._message_id is not None:
+                if tgcli.edit(
+                    self._message_id,
+                    text=caption,
+                    filename="metrics.png",
+                    data=png,
+                    priority="low",
+                ):
+                    return
+
+            self._message_id = tgcli.send(
+                text=caption, filename="metrics.png", data=png, priority="low"
+            )
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
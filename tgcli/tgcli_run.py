@@ -0,0 +1,387 @@
+import argparse
+import collections
+import gzip
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import tgcli
+
+# Telegram bots can't upload files larger than 50 MB
+MAX_LOG_BYTES = 45 * 1024 * 1024
+
+# Wait for output after command exit. Pipes may be held open by its
+# background children, which shouldn't block the summary.
+PUMP_JOIN_TIMEOUT = 2.0
+
+
+class TailBuffer:
+    """Last lines of output with constant memory.
+
+    Keeps at most `max_lines` lines and `max_bytes` bytes. Only the part
+    after the last carriage return is kept for every line, as terminal
+    shows it for progress bars.
+
+    Args:
+        max_lines (int): Max lines count.
+        max_bytes (int): Max total size of lines.
+    """
+
+    def __init__(self, max_lines: int = 30, max_bytes: int = 3000):
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+
+        self._lines = collections.deque()
+        self._size = 0
+        self._partial = b""
+
+    def _tail(self, line: bytes) -> bytes:
+        # Line with its newline should fit into max_bytes
+        return line[max(len(line) - self.max_bytes + 1, 0) :]
+
+    def _append(self, line: bytes):
+        line = self._tail(line.rstrip(b"\r").rsplit(b"\r", 1)[-1])
+        self._lines.append(line)
+        self._size += len(line) + 1
+
+        while self._lines and (
+            len(self._lines) > self.max_lines or self._size > self.max_bytes
+        ):
+            self._size -= len(self._lines.popleft()) + 1
+
+    def write(self, chunk: bytes):
+        lines = (self._partial + chunk).split(b"\n")
+        for line in lines[:-1]:
+            self._append(line)
+
+        # Don't let a line without newline grow forever
+        self._partial = self._tail(lines[-1])
+
+    def getvalue(self) -> str:
+        lines = list(self._lines)
+        if self._partial:
+            lines.append(self._partial.rsplit(b"\r", 1)[-1])
+        return b"\n".join(lines).decode("utf-8", errors="replace")
+
+
+class LogFile:
+    """Full output compressed on the fly into temporary file.
+
+    Args:
+        max_bytes (int): Max compressed size, the rest of output is dropped.
+    """
+
+    def __init__(self, max_bytes: int = MAX_LOG_BYTES):
+        self.max_bytes = max_bytes
+        self.truncated = False
+
+        self._file = tempfile.TemporaryFile()
+        self._gzip = gzip.GzipFile(fileobj=self._file, mode="wb")
+
+    def write(self, chunk: bytes):
+        if self.truncated:
+            return
+
+        if self._file.tell() + len(chunk) > self.max_bytes:
+            self._gzip.write(b"\n[tgcli run: log was truncated]\n")
+            self.truncated = True
+            return
+
+        self._gzip.write(chunk)
+
+    def read(self) -> bytes:
+        self._gzip.close()
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self):
+        self._gzip.close()
+        self._file.close()
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, seconds = divmod(rest, 60)
+    if hours:
+        return "%dh %02dm %02ds" % (hours, minutes, seconds)
+    if minutes:
+        return "%dm %02ds" % (minutes, seconds)
+    return "%ds" % seconds
+
+
+def parse_interval(value: str) -> float:
+    """Parse '90', '30s', '10m', '1h' to seconds."""
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    value = value.strip().lower()
+    try:
+        if value and value[-1] in units:
+            return float(value[:-1]) * units[value[-1]]
+        return float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("Can't parse interval '%s'" % value)
+
+
+class Runner:
+    """Run command and report its result to telegram.
+
+    Output is streamed through unchanged. Only the tail is kept in memory,
+    the full output goes to compressed temporary file, which is sent only
+    if the command failed.
+
+    Args:
+        cmd (list): Command with arguments.
+        name (str): Title of messages. Defaults to the command.
+        lines (int): Lines of output tail in summary.
+        max_bytes (int): Max size of output tail in summary.
+        heartbeat (float): Interval of "still running" message updates in
+            seconds, 0 to disable.
+        tags (list): Tags of summary message for `get_events`.
+    """
+
+    def __init__(
+        self,
+        cmd: list,
+        name: str = None,
+        lines: int = 30,
+        max_bytes: int = 3000,
+        heartbeat: float = 0,
+        tags: list = None,
+    ):
+        self.cmd = cmd
+        self.name = name or " ".join(shlex.quote(c) for c in cmd)
+        if len(self.name) > 200:
+            self.name = self.name[:197] + "..."
+        self.heartbeat = heartbeat
+        self.tags = tags
+
+        self._tail = TailBuffer(lines, max_bytes)
+        self._log = LogFile()
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._detached = False
+        self._started = 0.0
+
+    def _pump(self, src, dst):
+        fd = src.fileno()
+        while True:
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError:
+                break
+            if not chunk or self._detached:
+                break
+
+            try:
+                dst.write(chunk)
+                dst.flush()
+            except (BrokenPipeError, ValueError):
+                pass
+
+            with self._lock:
+                if self._detached:
+                    break
+                self._tail.write(chunk)
+                self._log.write(chunk)
+
+    def _heartbeat(self):
+        message_id = None
+        while not self._done.wait(self.heartbeat):
+            with self._lock:
+                tail = self._tail.getvalue()
+
+            text = "⏳ %s\nRunning for %s on %s\n---\n%s" % (
+                self.name,
+                format_duration(time.time() - self._started),
+                socket.gethostname(),
+                "\n".join(tail.splitlines()[-5:]),
+            )
+            if (
+                message_id is None
+                or tgcli.edit(message_id, text, priority="low") is None
+            ):
+                message_id = tgcli.send(text=text, spool=False, priority="low")
+
+    def _wait(self, proc: subprocess.Popen):
+        """Wait process with resource usage. Signals are passed to it."""
+
+        def forward(signum, frame):
+            proc.send_signal(signum)
+
+        signal.signal(signal.SIGTERM, forward)
+        signal.signal(signal.SIGHUP, forward)
+
+        while True:
+            try:
+                _, status, rusage = os.wait4(proc.pid, 0)
+                break
+            except KeyboardInterrupt:
+                # Child got SIGINT from terminal too, wait for its exit
+                continue
+
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+        return rusage
+
+    def _summary(self, returncode: int, wall: float, rusage) -> str:
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        maxrss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+
+        if returncode == 0:
+            status = "✅ %s\nFinished" % self.name
+        elif returncode < 0:
+            status = "❌ %s\nKilled by signal %d" % (self.name, -returncode)
+        else:
+            status = "❌ %s\nFailed with exit code %d" % (
+                self.name,
+                returncode,
+            )
+
+        return (
+            "%s on %s\n"
+            "Wall time: %s\n"
+            "CPU time: %.1fs user, %.1fs system\n"
+            "Peak RSS: %.1f MB\n"
+            "---\n%s"
+            % (
+                status,
+                socket.gethostname(),
+                format_duration(wall),
+                rusage.ru_utime,
+                rusage.ru_stime,
+                maxrss / 2**20,
+                self._tail.getvalue() or "(no output)",
+            )
+        )
+
+    def run(self) -> int:
+        """Run command and send summary.
+
+        Returns:
+            int: Exit code of command, 128 + signal if it was killed.
+        """
+        self._started = time.time()
+        try:
+            proc = subprocess.Popen(
+                self.cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+            )
+        except OSError as e:
+            print("[ERROR] Can't run '%s': %s" % (self.name, e))
+            tgcli.send(text="❌ %s\nCan't run: %s" % (self.name, e))
+            return 127
+
+        pumps = [
+            threading.Thread(
+                target=self._pump, args=(proc.stdout, sys.stdout.buffer)
+            ),
+            threading.Thread(
+                target=self._pump, args=(proc.stderr, sys.stderr.buffer)
+            ),
+        ]
+        for t in pumps:
+            t.daemon = True
+            t.start()
+
+        if self.heartbeat > 0:
+            threading.Thread(target=self._heartbeat, daemon=True).start()
+
+        rusage = self._wait(proc)
+        wall = time.time() - self._started
+        deadline = time.time() + PUMP_JOIN_TIMEOUT
+        for t in pumps:
+            t.join(max(deadline - time.time(), 0))
+        with self._lock:
+            # Stop pumps still blocked on pipes of grandchildren, their fds
+            # are closed below and may be reused
+            self._detached = True
+        proc.stdout.close()
+        proc.stderr.close()
+        self._done.set()
+
+        message_id = tgcli.send(
+            text=self._summary(proc.returncode, wall, rusage),
+            tags=self.tags,
+        )
+
+        if proc.returncode != 0:
+            tgcli.send(
+                text="Full log%s"
+                % (" (truncated)" if self._log.truncated else ""),
+                filename="%s.log.gz" % os.path.basename(self.cmd[0]),
+                data=self._log.read(),
+                reply_to_id=message_id,
+                tags=self.tags,
+            )
+        self._log.close()
+
+        if proc.returncode < 0:
+            return 128 - proc.returncode
+        return proc.returncode
+
+
+def main(argv: list = None) -> int:
+    description_str = """
+Run command and send one summary to telegram: exit code, wall and CPU time,
+peak RSS and the tail of output. Full compressed log is attached only if
+command failed. Output is passed through unchanged.
+
+Examples:
+    $ tgcli run -- ./build.sh --release
+    $ tgcli run --heartbeat 30m --name "train resnet" -- python train.py
+    $ tgcli run --lines 50 -- make test
+
+"""
+    parser = argparse.ArgumentParser(
+        prog="tgcli run",
+        description=description_str,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+    parser.add_argument(
+        "--name", type=str, default=None, help="Title instead of command"
+    )
+    parser.add_argument(
+        "--lines", type=int, default=30, help="Lines of output in summary"
+    )
+    parser.add_argument(
+        "--bytes",
+        type=int,
+        default=3000,
+        help="Max size of output in summary (telegram limit is 4096)",
+    )
+    parser.add_argument(
+        "--heartbeat",
+        type=parse_interval,
+        default=0,
+        help='Update "still running" message on interval. Example: 30m',
+    )
+    parser.add_argument(
+        "--tags",
+        type=str,
+        default=None,
+        help='Tags to filter replies in get_events. Example: --tags "a;b"',
+    )
+    parser.add_argument("cmd", nargs=argparse.REMAINDER, help="Command")
+
+    args = parser.parse_args(argv)
+
+    cmd = args.cmd[1:] if args.cmd[:1] == ["--"] else args.cmd
+    if not cmd:
+        parser.error("command is required: tgcli run -- <cmd>")
+
+    runner = Runner(
+        cmd,
+        name=args.name,
+        lines=args.lines,
+        max_bytes=args.bytes,
+        heartbeat=args.heartbeat,
+        tags=args.tags.split(";") if args.tags else None,
+    )
+    return runner.run()
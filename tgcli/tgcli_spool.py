@@ -0,0 +1,223 @@
+import contextlib
+import fcntl
+import getpass
+import json
+import os
+import socket
+import threading
+import time
+from typing import Tuple
+
+import tgcli
+
+
+class Spool:
+    """Append-only local queue of messages which were not delivered.
+
+    One JSON line per message in `spool-<user>@<host>.jsonl`. Appends and
+    rewrites are guarded by flock, so it is safe for concurrent processes.
+    Only one process drains at a time. Files sent by path are stored as
+    path and read on drain.
+
+    Args:
+        dirpath (str): Spool directory.
+    """
+
+    BATCH_SIZE = 20
+    MAX_ATTEMPTS = 5
+
+    def __init__(self, dirpath: str):
+        os.makedirs(dirpath, exist_ok=True)
+
+        name = "spool-%s@%s" % (getpass.getuser(), socket.gethostname())
+        self.path = os.path.join(dirpath, name + ".jsonl")
+        self._lock_path = os.path.join(dirpath, name + ".lock")
+        self._drain_lock_path = os.path.join(dirpath, name + ".drain.lock")
+
+        self._drain_thread = None
+
+    @contextlib.contextmanager
+    def _flock(self, path: str, blocking: bool = True):
+        with open(path, "a") as f:
+            flags = (
+                fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            )
+            try:
+                fcntl.flock(f, flags)
+            except BlockingIOError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def is_empty(self) -> bool:
+        try:
+            return os.path.getsize(self.path) == 0
+        except OSError:
+            return True
+
+    def append(self, request: dict, filepath: str = None):
+        record = {"ts": time.time(), "attempts": 0, "request": request}
+        if filepath:
+            record["request"] = dict(
+                request, data=dict(request["data"], filecontent="")
+            )
+            record["filepath"] = os.path.abspath(filepath)
+
+        line = json.dumps(record, default=tgcli._json_default) + "\n"
+        with self._flock(self._lock_path):
+            with open(self.path, "a") as f:
+                f.write(line)
+
+        tgcli._debug("Message was saved to spool '%s'" % self.path)
+
+    def _read(self) -> list:
+        if self.is_empty():
+            return []
+
+        with self._flock(self._lock_path):
+            with open(self.path) as f:
+                lines = f.readlines()
+
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Broken line after crash during write, will be skipped
+                records.append(None)
+        return records
+
+    def _remove_head(self, count: int, head: dict = None):
+        """Remove `count` records and update attempts of the next one."""
+        with self._flock(self._lock_path):
+            with open(self.path) as f:
+                lines = f.readlines()
+
+            lines = lines[count:]
+            if head is not None and lines:
+                lines[0] = json.dumps(head) + "\n"
+
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.writelines(lines)
+            os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _load(record: dict) -> dict:
+        data = record["request"]["data"]
+        if record.get("filepath"):
+            with open(record["filepath"], "rb") as f:
+                data = dict(data, filecontent=f.read())
+        return data
+
+    def _send_head(self, records: list) -> Tuple[int, str]:
+        """Send records from head of spool in one batch.
+
+        Returns:
+            Tuple[int, str]: count of processed records and error of the
+                next one: None if all were sent, "busy" if server was
+                overloaded, otherwise error detail.
+
+        Raises:
+            Exception: in case of unavailable server.
+        """
+        requests = []
+        for record in records:
+            try:
+                requests.append(self._load(record))
+            except (OSError, TypeError, KeyError) as e:
+                if requests:
+                    break
+
+                # Broken record or removed file, nothing to send
+                tgcli._debug("Skip spooled message %s: %s" % (record, e))
+                return 1, None
+
+        # Requests keep idempotency keys, so they can be safely repeated
+        res = tgcli._send(
+            {"method": "send_batch", "data": {"requests": requests}},
+            retries=tgcli.TGCLI_SEND_RETRIES,
+        )
+        if not res or res["status"] != "ok":
+            return 0, "error"
+
+        results = res["data"]["results"]
+        sent = sum(1 for r in results if r["status"] == "ok")
+        if sent == len(requests):
+            return sent, None
+        if sent < len(results):
+            return sent, results[sent].get("detail") or "error"
+        return sent, "busy"
+
+    def drain(self) -> bool:
+        """Send spooled messages in order.
+
+        Returns:
+            bool: False if there are messages left because of unavailable
+                or busy server, or if another process is draining now.
+                True otherwise.
+        """
+        if self.is_empty():
+            return True
+
+        with self._flock(self._drain_lock_path, blocking=False) as locked:
+            if not locked:
+                # Another process is draining, new messages should be
+                # spooled to keep order
+                return False
+
+            records = self._read()
+            while records:
+                try:
+                    sent, error = self._send_head(records[: self.BATCH_SIZE])
+                except Exception as e:
+                    tgcli._debug_exc(e)
+                    return False
+
+                if error == "busy":
+                    # Overload is transient, don't count it as attempt
+                    if sent:
+                        self._remove_head(sent)
+                    return False
+
+                head = None
+                if error is not None:
+                    head = records[sent]
+                    head["attempts"] = head.get("attempts", 0) + 1
+                    if head["attempts"] >= self.MAX_ATTEMPTS:
+                        tgcli._debug("Drop spooled message: %s" % head)
+                        sent += 1
+                        head = None
+
+                self._remove_head(sent, head)
+                records = records[sent:]
+                if head is not None:
+                    return False
+
+                if not records:
+                    # Pick up messages spooled by others while draining
+                    records = self._read()
+
+            return self.is_empty()
+
+    def drain_in_background(self):
+        """Retry drain with backoff until spool is empty."""
+        if self._drain_thread is not None and self._drain_thread.is_alive():
+            return
+
+        def run():
+            delay = 2.0
+            while True:
+                time.sleep(delay)
+                if self.drain():
+                    return
+                delay = min(delay * 2, 60.0)
+
+        self._drain_thread = threading.Thread(
+            target=run, name="tgcli_spool", daemon=True
+        )
+        self._drain_thread.start()
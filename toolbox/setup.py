@@ -11,7 +11,14 @@ setup(
             "tgcli_monitor_file=tgcli_monitor_file:main",
             "tgcli_monitor_dir=tgcli_monitor_dir:main",
             "tgcli_monitor_tail=tgcli_monitor_tail:main",
+            "tgcli_monitor=tgcli_monitor:main",
         ]
     },
-    install_requires=["parsedatetime", "watchdog", "schedule"],
+    install_requires=[
+        "parsedatetime",
+        "watchdog",
+        "schedule",
+        "pyyaml",
+        'tomli; python_version < "3.11"',
+    ],
 )
@@ -0,0 +1,360 @@
+import argparse
+import os
+import signal
+import threading
+import time
+
+import schedule
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
+
+from utils import str_to_interval, send_file, publish_tail
+
+MONITOR_TYPES = ["file", "tail", "dir"]
+
+
+def load_config(path):
+    """Read monitors list from YAML or TOML file.
+
+    Example (YAML):
+        monitors:
+          - type: file
+            path: ./image.png
+            interval: 10m     # or 'onchange' (default)
+          - type: tail
+            path: ./my_app.log
+            interval: 5s
+            lines: 30
+          - type: dir
+            path: ./results
+            recursive: false
+
+    Example (TOML):
+        [[monitors]]
+        type = "tail"
+        path = "./my_app.log"
+        interval = "5s"
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+
+    if os.path.splitext(path)[1] == ".toml":
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise Exception(
+                    "TOML config requires python>=3.11 or 'pip install tomli'"
+                )
+
+        cfg = tomllib.loads(content.decode("utf-8"))
+    else:
+        import yaml
+
+        cfg = yaml.safe_load(content)
+
+    monitors = (cfg or {}).get("monitors") or []
+    return [_check_monitor(m) for m in monitors]
+
+
+def _check_monitor(cfg):
+    if not isinstance(cfg, dict) or cfg.get("type") not in MONITOR_TYPES:
+        raise Exception(
+            "Monitor type should be one of %s: %s" % (MONITOR_TYPES, cfg)
+        )
+    if not cfg.get("path"):
+        raise Exception("Monitor path is required: %s" % cfg)
+
+    monitor = {
+        "type": cfg["type"],
+        "path": os.path.realpath(os.path.expanduser(str(cfg["path"]))),
+        "interval": str(
+            cfg.get("interval", "30m" if cfg["type"] == "tail" else "onchange")
+        ),
+        "lines": int(cfg.get("lines", 30)),
+        "recursive": bool(cfg.get("recursive", False)),
+    }
+
+    if monitor["type"] == "dir":
+        monitor["interval"] = "onchange"
+    if monitor["type"] == "tail" and monitor["interval"] == "onchange":
+        raise Exception("Tail monitor requires interval: %s" % cfg)
+    if monitor["interval"] != "onchange":
+        monitor["seconds"] = str_to_interval(monitor["interval"])
+
+    return monitor
+
+
+def _monitor_key(monitor):
+    return tuple(sorted(monitor.items()))
+
+
+class ChangeHandler(FileSystemEventHandler):
+    """One handler for all watched paths of the shared observer."""
+
+    def __init__(self, daemon):
+        self._daemon = daemon
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return None
+
+        if event.event_type in ("created", "modified"):
+            self._daemon.on_change(event.src_path, event.event_type)
+        elif event.event_type == "moved":
+            self._daemon.on_change(event.dest_path, "created")
+
+
+class MonitorDaemon:
+    """Run many monitors in one process.
+
+    Interval monitors share one scheduler, and the main loop sleeps until
+    the next deadline instead of polling. Change monitors share one
+    watchdog observer, and changes are debounced, so a file written in
+    several chunks is sent once. Config is reloaded on SIGHUP or when the
+    config file is changed.
+    """
+
+    DEBOUNCE_SEC = 1.0
+
+    def __init__(self, config_path):
+        self.config_path = os.path.realpath(config_path)
+
+        self._scheduler = schedule.Scheduler()
+        self._observer = Observer()
+        self._handler = ChangeHandler(self)
+
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._reload_requested = False
+        self._running = True
+
+        self._monitors = {}
+        self._jobs = {}
+
+    def on_change(self, path, event_type):
+        path = os.path.realpath(path)
+
+        if path == self.config_path:
+            self.request_reload()
+            return
+
+        with self._lock:
+            if path not in self._pending:
+                self._pending[path] = [0, event_type]
+            self._pending[path][0] = time.time() + self.DEBOUNCE_SEC
+        self._wakeup.set()
+
+    def request_reload(self):
+        self._reload_requested = True
+        self._wakeup.set()
+
+    def stop(self):
+        self._running = False
+        self._wakeup.set()
+
+    def reload(self):
+        try:
+            monitors = load_config(self.config_path)
+        except Exception as e:
+            print("[ERROR] Can't load config '%s': %s" % (self.config_path, e))
+            return
+
+        new_monitors = {_monitor_key(m): m for m in monitors}
+
+        for key in list(self._monitors):
+            if key not in new_monitors:
+                job = self._jobs.pop(key, None)
+                if job is not None:
+                    self._scheduler.cancel_job(job)
+                del self._monitors[key]
+
+        for key, monitor in new_monitors.items():
+            if key in self._monitors:
+                continue
+
+            self._monitors[key] = monitor
+            if monitor["interval"] != "onchange":
+                job = self._scheduler.every(monitor["seconds"]).seconds.do(
+                    self._run_interval, monitor
+                )
+                self._jobs[key] = job
+                self._run_interval(monitor)
+
+        self._reschedule_watches()
+        print("Monitors: %d" % len(self._monitors))
+
+    def _reschedule_watches(self):
+        self._observer.unschedule_all()
+
+        watches = {os.path.dirname(self.config_path): False}
+        for monitor in self._monitors.values():
+            if monitor["interval"] != "onchange":
+                continue
+
+            if monitor["type"] == "dir":
+                dirpath = monitor["path"]
+                recursive = monitor["recursive"]
+            else:
+                dirpath = os.path.dirname(monitor["path"])
+                recursive = False
+            watches[dirpath] = watches.get(dirpath, False) or recursive
+
+        for dirpath, recursive in watches.items():
+            if not os.path.isdir(dirpath):
+                print(
+                    "[ERROR] Directory '%s' doesn't exist, "
+                    "reload config when it appear..." % dirpath
+                )
+                continue
+            self._observer.schedule(
+                self._handler, dirpath, recursive=recursive
+            )
+
+    def _run_interval(self, monitor):
+        try:
+            self._publish_interval(monitor)
+        except Exception as e:
+            print(
+                "[ERROR] Monitor '%s' of '%s' failed: %s"
+                % (monitor["type"], monitor["path"], e)
+            )
+
+    def _publish_interval(self, monitor):
+        if monitor["type"] == "tail":
+            publish_tail(monitor["path"], monitor["lines"])
+        elif os.path.isfile(monitor["path"]):
+            send_file(
+                monitor["path"],
+                "File '%s' on interval '%s'"
+                % (monitor["path"], monitor["interval"]),
+            )
+
+    def _matches(self, monitor, path):
+        if monitor["interval"] != "onchange":
+            return False
+        if monitor["type"] == "file":
+            return monitor["path"] == path
+        if monitor["recursive"]:
+            return path.startswith(monitor["path"] + os.sep)
+        return os.path.dirname(path) == monitor["path"]
+
+    def _run_pending_changes(self):
+        now = time.time()
+        with self._lock:
+            ready = [
+                (path, event_type)
+                for path, (deadline, event_type) in self._pending.items()
+                if deadline <= now
+            ]
+            for path, _ in ready:
+                del self._pending[path]
+
+        for path, event_type in ready:
+            monitors = [
+                m for m in self._monitors.values() if self._matches(m, path)
+            ]
+            if not monitors or not os.path.isfile(path):
+                continue
+
+            if any(m["type"] == "file" for m in monitors):
+                text = "File '%s' was changed..." % path
+            elif event_type == "created":
+                text = "File '%s' was created..." % path
+            else:
+                text = "File '%s' was changed..." % path
+
+            try:
+                send_file(path, text)
+            except Exception as e:
+                print("[ERROR] Can't send file '%s': %s" % (path, e))
+
+    def _next_timeout(self):
+        timeouts = []
+
+        idle = self._scheduler.idle_seconds
+        if idle is not None:
+            timeouts.append(max(idle, 0))
+
+        with self._lock:
+            if self._pending:
+                deadline = min(d for d, _ in self._pending.values())
+                timeouts.append(max(deadline - time.time(), 0))
+
+        return min(timeouts) if timeouts else None
+
+    def run(self):
+        self.reload()
+        self._observer.start()
+
+        try:
+            while self._running:
+                self._wakeup.wait(self._next_timeout())
+                self._wakeup.clear()
+
+                if self._reload_requested:
+                    self._reload_requested = False
+                    self.reload()
+
+                self._scheduler.run_pending()
+                self._run_pending_changes()
+        finally:
+            self._observer.stop()
+            self._observer.join()
+
+
+def main():
+    description_str = """
+Run many monitors in one process from config file (YAML or TOML).
+
+Config is reloaded on change or on SIGHUP.
+
+Examples:
+    $ tgcli_monitor ./monitors.yaml
+
+    $ cat ./monitors.yaml
+    monitors:
+      - type: file        # send file on interval or on change
+        path: ./image.png
+        interval: 10m
+      - type: tail        # send tail on interval
+        path: ./my_app.log
+        interval: 5s
+        lines: 30
+      - type: dir         # send changed files in directory
+        path: ./results
+
+"""
+    parser = argparse.ArgumentParser(
+        description=description_str,
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser.add_argument(
+        "config",
+        type=str,
+        help="Path to config file (.yaml, .yml or .toml)",
+    )
+
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.config):
+        print("[ERROR] Config '%s' doesn't exist!" % args.config)
+        return
+
+    daemon = MonitorDaemon(args.config)
+
+    signal.signal(signal.SIGHUP, lambda *_: daemon.request_reload())
+    signal.signal(signal.SIGTERM, lambda *_: daemon.stop())
+
+    try:
+        daemon.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -5,14 +5,7 @@ import time
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 
-import tgcli
-
-
-def _send_file(filepath, text):
-    with open(filepath, "rb") as f:
-        return tgcli.send(
-            text, filename=os.path.basename(filepath), data=f.read()
-        )
+from utils import send_file
 
 
 class Handler(FileSystemEventHandler):
@@ -23,11 +16,11 @@ class Handler(FileSystemEventHandler):
         if event.is_directory:
             return None
         elif event.event_type == "created":
-            _send_file(
+            send_file(
                 event.src_path, "File '%s' was created..." % event.src_path
             )
         elif event.event_type == "modified":
-            _send_file(
+            send_file(
                 event.src_path, "File '%s' was changed..." % event.src_path
             )
 
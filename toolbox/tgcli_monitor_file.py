@@ -6,23 +6,14 @@ import schedule
 from watchdog.observers import Observer
 from watchdog.events import PatternMatchingEventHandler
 
-import tgcli
-
-from utils import str_to_interval
-
-
-def _send_file(filepath, text):
-    with open(filepath, "rb") as f:
-        return tgcli.send(
-            text, filename=os.path.basename(filepath), data=f.read()
-        )
+from utils import str_to_interval, send_file
 
 
 def run_interval(args):
     interval = str_to_interval(args.interval)
     main_scheduler = schedule.Scheduler()
     main_scheduler.every(interval).seconds.do(
-        _send_file,
+        send_file,
         filepath=args.filepath,
         text="File '%s' on interval '%s'" % (args.filepath, args.interval),
     )
@@ -41,7 +32,7 @@ class Handler(PatternMatchingEventHandler):
         if event.is_directory:
             return None
         elif event.event_type == "created" or event.event_type == "modified":
-            _send_file(
+            send_file(
                 event.src_path, "File '%s' was changed..." % event.src_path
             )
 
@@ -1,34 +1,10 @@
 import argparse
-import subprocess
 import os
 import time
 
 import schedule
 
-import tgcli
-
-from utils import str_to_interval
-
-
-def _publish_tail(filepath, lines):
-    if not os.path.isfile(filepath):
-        print("[ERROR] no such file '%s'" % filepath)
-        return
-
-    with subprocess.Popen(
-        ["tail", "-n", str(lines), filepath],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-    ) as f:
-        text = ""
-        line = f.stdout.read()
-        if line:
-            text += line.decode("utf-8") + "\n"
-
-    tgcli.send(
-        text="Tail for file '```%s```':\n---\n```\n%s\n```" % (filepath, text),
-        markdown=True,
-    )
+from utils import str_to_interval, publish_tail
 
 
 def main():
@@ -73,7 +49,7 @@ Examples:
 
     main_scheduler = schedule.Scheduler()
     main_scheduler.every(interval).seconds.do(
-        _publish_tail, filepath=args.filepath, lines=args.lines
+        publish_tail, filepath=args.filepath, lines=args.lines
     )
     main_scheduler.run_all()
 
@@ -1,6 +1,11 @@
+import os
+import subprocess
 from datetime import datetime
+
 import parsedatetime as pdt
 
+import tgcli
+
 
 def str_to_interval(cfg):
     str_interval = "1200s"
@@ -20,3 +25,31 @@ def str_to_interval(cfg):
         interval = day_in_secs
 
     return interval
+
+
+def send_file(filepath, text):
+    with open(filepath, "rb") as f:
+        return tgcli.send(
+            text, filename=os.path.basename(filepath), data=f.read()
+        )
+
+
+def publish_tail(filepath, lines):
+    if not os.path.isfile(filepath):
+        print("[ERROR] no such file '%s'" % filepath)
+        return
+
+    with subprocess.Popen(
+        ["tail", "-n", str(lines), filepath],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    ) as f:
+        text = ""
+        line = f.stdout.read()
+        if line:
+            text += line.decode("utf-8") + "\n"
+
+    tgcli.send(
+        text="Tail for file '```%s```':\n---\n```\n%s\n```" % (filepath, text),
+        markdown=True,
+    )